@@ -3,6 +3,8 @@
 #include <Adafruit_BNO055.h>
 #include <utility/imumaths.h>
 
+#define BINARY_PROTOCOL 0  // 1: framed packets (bruxbench/framing.py), 0: CSV lines
+
 //                                   id, address
 Adafruit_BNO055 bno0 = Adafruit_BNO055(-1, 0x28);
 Adafruit_BNO055 bno1 = Adafruit_BNO055(-1, 0x29);
@@ -13,6 +15,9 @@ adafruit_bno055_offsets_t bno_offset29 = { -12, -28, -46, 25, 437, -66, -2, 1, 0
 sensors_event_t orientationData[2], angVelocityData[2], linearAccelData[2], magnetometerData[2], accelerometerData[2], gravityData[2];
 imu::Quaternion quat[2];
 
+uint16_t seq = 0;   // Frame sequence counter
+float values[20];   // Binary payload, per sensor: gyro xyz, acceleration xyz, quaternion wxyz
+
 void setup(void)
 {
   Serial.begin(500000);
@@ -27,11 +32,44 @@ void loop(void)
   readData(&bno0, 0);
   readData(&bno1, 1);
 
+#if BINARY_PROTOCOL
+  packData(0, values);
+  packData(1, values + 10);
+  sendFrame((uint8_t*) values, sizeof(values));
+#else
   printData(0);
   Serial.print(",");
   printData(1);
 
   Serial.println();
+#endif
+}
+
+void packData(byte index, float* out) {
+  out[0] = angVelocityData[index].gyro.x;
+  out[1] = angVelocityData[index].gyro.y;
+  out[2] = angVelocityData[index].gyro.z;
+  out[3] = accelerometerData[index].acceleration.x;
+  out[4] = accelerometerData[index].acceleration.y;
+  out[5] = accelerometerData[index].acceleration.z;
+  out[6] = quat[index].w();
+  out[7] = quat[index].x();
+  out[8] = quat[index].y();
+  out[9] = quat[index].z();
+}
+
+// 0xA5 0x5A | seq | payload | sum8 of seq and payload, see bruxbench/framing.py
+void sendFrame(const uint8_t* payload, uint8_t len) {
+  uint8_t header[4] = { 0xA5, 0x5A, (uint8_t)(seq & 0xFF), (uint8_t)(seq >> 8) };
+  uint8_t checksum = header[2] + header[3];
+  for (uint8_t i = 0; i < len; i++) {
+    checksum += payload[i];
+  }
+
+  Serial.write(header, sizeof(header));
+  Serial.write(payload, len);
+  Serial.write(checksum);
+  seq++;
 }
 
 void setupBNO(Adafruit_BNO055* bno, adafruit_bno055_offsets_t* offsets) {
@@ -2,10 +2,13 @@
 #define NUMCHANNELS 4
 #define SAMPFREQ 256                      // ADC sampling rate 256
 #define PERIOD_us (1000000/(SAMPFREQ))    // Set 256Hz sampling frequency       
+#define BINARY_PROTOCOL 0                 // 1: framed packets (bruxbench/framing.py), 0: CSV lines
 
 // Global constants and variables
 unsigned char CurrentCh;         //Current channel being sampled.
 unsigned long last_us = 0L;      // Helper for the sample rate
+uint16_t seq = 0;                // Frame sequence counter
+uint16_t values[NUMCHANNELS];    // Binary payload
 
 //~~~~~~~~~~
 // Functions
@@ -35,6 +38,12 @@ void loop() {
   if (micros() - last_us > PERIOD_us) {
     last_us += PERIOD_us;
 
+#if BINARY_PROTOCOL
+    for(CurrentCh = 0; CurrentCh < NUMCHANNELS; CurrentCh++){
+      values[CurrentCh] = analogRead(CurrentCh);
+    }
+    sendFrame((uint8_t*) values, sizeof(values));
+#else
     //Read the 4 ADC inputs
     for(CurrentCh = 0; CurrentCh < NUMCHANNELS; CurrentCh++){
         Serial.print(analogRead(CurrentCh)); 
@@ -44,5 +53,27 @@ void loop() {
       }
     }
     Serial.println();
+#endif
   }
+}
+
+
+/****************************************************/
+/*  Function name: sendFrame                        */
+/*  Parameters                                      */
+/*    Input   :  payload, payload length            */
+/*    Output  :  No                                 */
+/*    Action  :  0xA5 0x5A | seq | payload | sum8   */
+/****************************************************/
+void sendFrame(const uint8_t* payload, uint8_t len) {
+  uint8_t header[4] = { 0xA5, 0x5A, (uint8_t)(seq & 0xFF), (uint8_t)(seq >> 8) };
+  uint8_t checksum = header[2] + header[3];
+  for (uint8_t i = 0; i < len; i++) {
+    checksum += payload[i];
+  }
+
+  Serial.write(header, sizeof(header));
+  Serial.write(payload, len);
+  Serial.write(checksum);
+  seq++;
 }
\ No newline at end of file
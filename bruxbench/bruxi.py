@@ -1,46 +1,147 @@
 import asyncio
 import logging
 from typing import List
-from sensor import Sensor
+from sensor import Sensor, init_sensors, resolve_ble_devices
+from reactor import WriterPool
+from scheduler import PollScheduler
+from drivers import shutdown_buses
+from workers import SensorGroup
+from recording import Schema
+from ringbuffer import RingWriter, ring_dir, remove_session_rings
+from telemetry import Telemetry
+from supervisor import Supervisor
+from segments import shutdown_compressor
 
 logger = logging.getLogger("bruxi")
 
 
 class Bruxi:
-    def __init__(self, dir_name: str, sensors: List[Sensor], halt_event: asyncio.Event) -> None:
+    def __init__(self, dir_name: str, sensors: List[Sensor], halt_event: asyncio.Event, writer_threads: int = 1,
+                 process_groups: List[List[Sensor]] = None, live_rings: bool = True,
+                 telemetry_interval_s: float = 1.0, supervise: bool = True,
+                 segment_s: float = None, compression: str = None) -> None:
+        """`writer_threads` sets the number of threads doing the file I/O of
+        the consumers, 0 writes on the event loop.
+        Every list of `process_groups` is initialized and streamed in its own
+        worker process, its samples are still written by this process.
+        With `live_rings` every sensor also publishes its samples into a
+        shared-memory ring buffer for live viewers (see `ringbuffer.py`).
+        Every `telemetry_interval_s` the health of the session is written to
+        `metrics.jsonl` in the session directory (see `telemetry.py`), 0 turns it off.
+        With `supervise` dead sensor streams are reconnected and restarted
+        (see `supervisor.py`).
+        With `segment_s` the recordings are rotated into segments of that
+        many seconds and closed ones compressed with `compression` (see `segments.py`).
+        """
+        self.segment_s = segment_s
+        self.compression = compression
+        self.supervisor = Supervisor() if supervise else None
+        self.live_rings = live_rings
+        self.telemetry_interval_s = telemetry_interval_s
+        self.telemetry = None
+        # seconds from the start of `initialize_sensors` until each sensor was ready
+        self.startup = {}
         self.sensors = []
+        self.groups = []
         self.dir_name = dir_name
         self.halt_event = halt_event
+        self.writer_pool = WriterPool(writer_threads) if writer_threads > 0 else None
+        # one timer for all polled sensors
+        self.scheduler = PollScheduler()
         self.add_sensors(sensors)
+        for group in process_groups or []:
+            self.add_process_group(group)
+
+    def add_process_group(self, sensors: List[Sensor]):
+        self.add_sensors(sensors)
+        self.groups.append(SensorGroup(sensors, supervisor=self.supervisor))
+
+    def local_sensors(self) -> List[Sensor]:
+        """Sensors streamed by this process"""
+        remote = {id(s) for g in self.groups for s in g.sensors}
+        return [s for s in self.sensors if id(s) not in remote]
 
     def add_sensor(self, sensor: Sensor):
+        if self.segment_s:
+            sensor.consumer.segment_s = self.segment_s
+            sensor.consumer.compression = self.compression
         sensor.consumer.set_dir_name(self.dir_name)
+        # spilled samples stay on the same disk as the session
+        sensor.producer.queue.spill_dir = sensor.consumer.dir
+        if self.writer_pool:
+            sensor.consumer.executor = self.writer_pool.assign()
+        if self.live_rings:
+            sensor.producer.ring = RingWriter(
+                f"{ring_dir(sensor.consumer.dir)}/{sensor.name}.ring",
+                Schema(sensor.csv_headers, sensor.consumer.column_types))
         self.sensors.append(sensor)
 
     def add_sensors(self, sensors: List[Sensor]):
         for s in sensors:
             self.add_sensor(s)
 
-    async def initialize_sensors(self) -> None:
-        for s in self.sensors:
-            await s._init()
-
-        
+    async def initialize_sensors(self, timeout_s: float = 30.0) -> None:
+        """Initialize the local sensors concurrently, see `sensor.init_sensors`"""
+        # one BLE scan for all sensors, the workers inherit the found devices
+        await resolve_ble_devices(self.sensors)
+        # sensors of process groups are initialized by their worker
+        self.startup = await init_sensors(self.local_sensors(), timeout_s)
 
     async def halt_event_listener(self) -> None:
         while not self.halt_event.is_set():
+            if all(s.producer.finished_execution.is_set() for s in self.sensors):
+                # e.g. replays that reached their end
+                break
             await asyncio.sleep(1)
 
         logger.info("Halt received! Shuting down..")
-        for s in self.sensors:
+        for g in self.groups:
+            g.halt()
+        for s in self.local_sensors():
             if not s.producer.finished_execution.is_set():
                 s.producer.stop_producer()
         logger.info("Producers stoped!")
 
+    def stream(self, sensor: Sensor):
+        if self.supervisor is None:
+            return sensor.start_stream()
+        return self.supervisor.supervise(sensor)
+
+    async def poll_sensors(self) -> None:
+        await self.scheduler.run()
+        self.scheduler.log_stats()
+
     def spawn_coroutines(self) -> list:
-        stream_futures = [s.start_stream() for s in self.sensors]
+        local_sensors = self.local_sensors()
+        stream_futures = [self.stream(s) for s in local_sensors if not s.polled]
+        for s in local_sensors:
+            if s.polled:
+                self.scheduler.add(s)
+        if self.scheduler.sensors:
+            stream_futures.append(self.poll_sensors())
+        for g in self.groups:
+            g.start()
+            stream_futures.append(g.receive())
         consumer_futures = [s.consumer.consume() for s in self.sensors]
+        # live viewers get the samples within milliseconds, not once per written batch
+        consumer_futures += [s.producer.publish() for s in self.sensors if s.producer.ring is not None]
         event_listener_futures = [self.halt_event_listener()]
+        if self.telemetry_interval_s > 0 and self.sensors:
+            # next to the recordings
+            self.telemetry = Telemetry(self.sensors, self.sensors[0].consumer.dir,
+                                       interval_s=self.telemetry_interval_s)
+            event_listener_futures.append(self.telemetry.run())
 
         futures = stream_futures + consumer_futures + event_listener_futures
         return futures
+
+    def close(self) -> None:
+        """Wait for the writer and bus threads, call after all workers exited"""
+        if self.writer_pool:
+            self.writer_pool.shutdown()
+        shutdown_buses()
+        shutdown_compressor()
+        for s in self.sensors:
+            if s.producer.ring is not None:
+                s.producer.ring.close()
+                remove_session_rings(s.consumer.dir)
@@ -0,0 +1,84 @@
+"""Decoded recording data shared by all connections of the server
+
+Recordings are read in blocks of `block_s` seconds of `dt`, decoded once
+into structured arrays (see `timeindex.read_range`) and kept in a least
+recently used cache bounded by `max_bytes`. Concurrent requests for a
+block that is being read wait for that read, so disk reads and parsing
+scale with the distinct sessions looked at, not with the clients.
+
+Blocks that may still grow (ending less than `settle_s` ago) are read
+but not cached.
+"""
+import asyncio
+from collections import OrderedDict
+from time import time_ns
+from typing import Dict, Tuple
+
+import numpy as np
+
+from timeindex import read_range, time_bounds
+
+NS = 1_000_000_000
+
+
+class BlockCache:
+    def __init__(self, max_bytes: int = 256 << 20, block_s: int = 60, settle_s: float = 10.0):
+        self.max_bytes = max_bytes
+        self.block_ns = block_s * NS
+        self.settle_ns = int(settle_s * NS)
+        self._blocks: "OrderedDict[Tuple[str, int], np.ndarray]" = OrderedDict()
+        self._loading: Dict[Tuple[str, int], asyncio.Future] = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    async def read(self, path: str, t0: int, t1: int) -> np.ndarray:
+        """Rows of a recording (file or manifest) with `t0 <= dt < t1`"""
+        loop = asyncio.get_running_loop()
+        # reads the index files, off the event loop like the blocks
+        bounds = await loop.run_in_executor(None, time_bounds, path)
+        if bounds is None:
+            # not indexed, blocks can't be read on their own
+            return await loop.run_in_executor(None, read_range, path, t0, t1)
+        t0, t1 = max(t0, bounds[0]), min(t1, bounds[1])
+        if t1 <= t0:
+            # no rows, but their type
+            return await loop.run_in_executor(None, read_range, path, t0, t0)
+        first, last = t0 // self.block_ns, (t1 - 1) // self.block_ns
+        parts = await asyncio.gather(*[self._block(path, b) for b in range(first, last + 1)])
+        data = np.concatenate(parts) if len(parts) > 1 else parts[0]
+        return data[(data["dt"] >= t0) & (data["dt"] < t1)]
+
+    async def _block(self, path: str, block: int) -> np.ndarray:
+        key = (path, block)
+        if key in self._blocks:
+            self.hits += 1
+            self._blocks.move_to_end(key)
+            return self._blocks[key]
+        if key in self._loading:
+            self.hits += 1
+            return await asyncio.shield(self._loading[key])
+
+        self.misses += 1
+        start = block * self.block_ns
+        loading = self._loading[key] = asyncio.get_running_loop().run_in_executor(
+            None, read_range, path, start, start + self.block_ns)
+        try:
+            data = await asyncio.shield(loading)
+        finally:
+            del self._loading[key]
+        if start + self.block_ns <= time_ns() - self.settle_ns:
+            self._put(key, data)
+        return data
+
+    def _put(self, key, data: np.ndarray):
+        if data.nbytes > self.max_bytes:
+            return
+        self._blocks[key] = data
+        self.bytes += data.nbytes
+        while self.bytes > self.max_bytes:
+            _, evicted = self._blocks.popitem(last=False)
+            self.bytes -= evicted.nbytes
+
+    def stats(self) -> dict:
+        return {"blocks": len(self._blocks), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
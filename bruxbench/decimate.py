@@ -0,0 +1,111 @@
+"""Min/max decimation of live series
+
+A `MinMaxView` keeps a sensor's last `span_ns` as two points per time
+bucket, the minimum and the maximum of every column, with `width // 2`
+buckets: the same number of points a chart `width` pixels wide can show,
+however many samples the span holds. It is updated incrementally: new
+samples are merged into the newest (open) bucket or start new ones.
+
+Points are numbered like `server.Series` samples, except that the two
+points of the open bucket change until the bucket is complete. They are
+sent again from `stable_seq` on, see `protocol.py`.
+"""
+import numpy as np
+
+from protocol import float32_values, value_columns
+
+
+def view_dtype(dtype: np.dtype) -> np.dtype:
+    """`dt` and the charted columns as float32"""
+    return np.dtype([("dt", "<i8")] + [(c, "<f4") for c in value_columns(dtype)])
+
+
+def as_view_rows(rows: np.ndarray, dtype: np.dtype) -> np.ndarray:
+    out = np.empty(len(rows), dtype=dtype)
+    out["dt"] = rows["dt"]
+    for c in dtype.names[1:]:
+        out[c] = float32_values(rows[c])
+    return out
+
+
+class MinMaxView:
+    def __init__(self, sensor_id: int, dtype: np.dtype, span_ns: int, width: int):
+        self.id = sensor_id
+        self.span_ns = span_ns
+        self.width = width
+        self.buckets = max(1, width // 2)
+        self.bucket_ns = max(1, span_ns // self.buckets)
+        self.size = 2 * self.buckets
+        self.dtype = view_dtype(dtype)
+        self.window = np.empty(0, dtype=self.dtype)
+        # sequence number of the next point
+        self.seq = 0
+        self.revision = 0
+        self._open_bucket = None
+        # samples that arrive while the history is read, see `seed`
+        self._pending = []
+        self.seeding = False
+
+    @property
+    def stable_seq(self) -> int:
+        """First point that may still change"""
+        return self.seq - 2 if self._open_bucket is not None else self.seq
+
+    def append(self, rows: np.ndarray):
+        if len(rows) == 0:
+            return
+        rows = as_view_rows(rows, self.dtype)
+        if self.seeding:
+            self._pending.append(rows)
+            return
+        self._add(rows)
+
+    def seed(self, history: np.ndarray):
+        """Adds the samples recorded before the view was created, followed by
+        the ones that arrived in the meantime
+        """
+        self.seeding = False
+        pending = np.concatenate(self._pending) if self._pending else np.empty(0, dtype=self.dtype)
+        self._pending = []
+        if history is not None and len(history):
+            history = as_view_rows(history, self.dtype)
+            if len(pending):
+                history = history[history["dt"] < pending["dt"][0]]
+            pending = np.concatenate((history, pending))
+        self._add(pending)
+
+    def _add(self, rows: np.ndarray):
+        if len(rows) == 0:
+            return
+        # a backwards step of the wall clock goes into the newest bucket, the points stay ordered
+        buckets = np.maximum.accumulate(rows["dt"] // self.bucket_ns)
+        if self._open_bucket is not None and buckets[0] <= self._open_bucket:
+            # reopen the newest bucket, its min/max points take part in the reduction
+            rows = np.concatenate((self.window[-2:], rows))
+            self.window = self.window[:-2]
+            self.seq -= 2
+            buckets = np.maximum.accumulate(np.maximum(rows["dt"] // self.bucket_ns, self._open_bucket))
+
+        starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+        bucket_ids = buckets[starts]
+        points = np.empty(2 * len(starts), dtype=self.dtype)
+        points["dt"][0::2] = bucket_ids * self.bucket_ns
+        points["dt"][1::2] = bucket_ids * self.bucket_ns + self.bucket_ns // 2
+        for c in self.dtype.names[1:]:
+            # fmin/fmax skip missing (NaN) values
+            points[c][0::2] = np.fmin.reduceat(rows[c], starts)
+            points[c][1::2] = np.fmax.reduceat(rows[c], starts)
+
+        self._open_bucket = int(bucket_ids[-1])
+        # the span, not a number of points: after a gap older points are dropped
+        window = np.concatenate((self.window, points))
+        oldest = (self._open_bucket - self.buckets + 1) * self.bucket_ns
+        self.window = window[np.searchsorted(window["dt"], oldest, side='left'):][-self.size:]
+        self.seq += len(points)
+        self.revision += 1
+
+    def since(self, seq: int):
+        """Sequence number of the first point from `seq` on still in the window, and the points"""
+        first = self.seq - len(self.window)
+        start = max(seq, first)
+        return start, self.window[start - first:]
@@ -0,0 +1,28 @@
+import os
+from asyncio import get_running_loop
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict
+
+# One worker thread per hardware bus: transactions on the same bus are
+# serialized, different buses run in parallel, the event loop never blocks.
+_BUS_EXECUTORS: Dict[str, ThreadPoolExecutor] = {}
+# threads don't survive a fork, worker processes start their own
+os.register_at_fork(after_in_child=_BUS_EXECUTORS.clear)
+
+
+def bus_executor(bus: str) -> ThreadPoolExecutor:
+    if bus not in _BUS_EXECUTORS:
+        _BUS_EXECUTORS[bus] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"bus-{bus}")
+    return _BUS_EXECUTORS[bus]
+
+
+async def run_on_bus(bus: str, fn, *args, **kwargs):
+    """Run a blocking driver call on the worker thread of `bus`"""
+    return await get_running_loop().run_in_executor(bus_executor(bus), partial(fn, *args, **kwargs))
+
+
+def shutdown_buses():
+    for executor in _BUS_EXECUTORS.values():
+        executor.shutdown(wait=True)
+    _BUS_EXECUTORS.clear()
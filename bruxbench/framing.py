@@ -0,0 +1,96 @@
+"""Binary framed serial protocol of the Arduino sensors
+
+    0xA5 0x5A | u16 seq | payload | u8 checksum
+
+Everything is little-endian. The payload has a fixed layout per device
+(see `arduino/emg.ino` and `arduino/bno.ino`) and the checksum is the
+8-bit sum of the sequence and payload bytes.
+"""
+import struct
+from typing import List, Tuple
+
+SYNC = b"\xa5\x5a"
+SEQ_MODULO = 1 << 16
+
+# 4 x 10 bit ADC counts
+EMG_PAYLOAD = "<4H"
+# 2 x (gyro xyz, acceleration xyz, quaternion wxyz)
+BNO_PAYLOAD = "<20f"
+
+
+class FrameParser:
+    """Incremental frame decoder.
+    Feed it whatever bytes arrived and it returns all complete frames. After
+    corrupted or missing bytes it resynchronizes on the next sync word.
+    """
+
+    def __init__(self, payload_format: str):
+        self._frame = struct.Struct("<H" + payload_format.lstrip("<"))
+        self.frame_size = len(SYNC) + self._frame.size + 1
+        self._buffer = bytearray()
+        self.last_seq = None
+        self.frames = 0
+        self.lost_frames = 0
+        self.checksum_errors = 0
+        self.skipped_bytes = 0
+
+    def reset(self):
+        """Forget partial data and the sequence number (device restarted),
+        the counters keep counting
+        """
+        self._buffer.clear()
+        self.last_seq = None
+
+    def feed(self, data: bytes) -> List[Tuple[int, tuple]]:
+        """Returns `(seq, values)` of every complete frame in the buffer"""
+        buf = self._buffer
+        buf += data
+        frames = []
+        pos = 0
+        end = len(buf)
+        body = len(SYNC)
+        check = self.frame_size - 1
+
+        while True:
+            start = buf.find(SYNC, pos)
+            if start < 0:
+                # keep a trailing half sync word
+                keep = 1 if end > pos and buf[end - 1] == SYNC[0] else 0
+                self.skipped_bytes += end - pos - keep
+                pos = end - keep
+                break
+
+            self.skipped_bytes += start - pos
+            if start + self.frame_size > end:
+                pos = start
+                break
+
+            if sum(buf[start + body:start + check]) & 0xFF != buf[start + check]:
+                self.checksum_errors += 1
+                pos = start + 1
+                continue
+
+            seq, *values = self._frame.unpack_from(buf, start + body)
+            if self.last_seq is not None:
+                self.lost_frames += (seq - self.last_seq - 1) % SEQ_MODULO
+            self.last_seq = seq
+            self.frames += 1
+            frames.append((seq, tuple(values)))
+            pos = start + self.frame_size
+
+        del buf[:pos]
+        return frames
+
+    def stats(self) -> dict:
+        return {
+            "frames": self.frames,
+            "lost_frames": self.lost_frames,
+            "checksum_errors": self.checksum_errors,
+            "skipped_bytes": self.skipped_bytes,
+        }
+
+
+def encode_frame(seq: int, payload_format: str, values) -> bytes:
+    """Host side encoder, mirrors `sendFrame` of the sketches"""
+    body = struct.pack("<H" + payload_format.lstrip("<"), seq % SEQ_MODULO, *values)
+    return SYNC + body + bytes([sum(body) & 0xFF])
@@ -22,6 +22,8 @@ async def main(dir_name, halt_event):
         # Sensor(name="mock-s2"),
         # Sensor(name="mock-s3"),
         # Sensor(name="mock-s4"),
+        # ReplaySensor(name="emg-replay", path="out/<session>/emg.csv", speed=1.0),
+        # SyntheticSensor(name="synthetic", rate_hz=2000, channels=16),
         BLE_eSense(name="ble-left", ble_device_name="eSense-0091"),
         BLE_eSense(name="ble-right", ble_device_name="eSense-0398"),
         GSR_Grovepi(name="gsr"),
@@ -41,6 +43,7 @@ async def main(dir_name, halt_event):
 
     logger.info("Spawning workers..")
     await asyncio.gather(*device.spawn_coroutines(), cli_event_handler)
+    device.close()
     logger.info("All workers exited.")
 
 
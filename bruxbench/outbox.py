@@ -0,0 +1,123 @@
+"""Per-connection send queue of the server
+
+Every connection gets an `Outbox` drained by its own task, so a client that
+reads slowly only holds up itself. Frames are queued under a key, a newer
+frame with the key of a pending one takes its place: the newest state
+replaces an older one (chart payloads, metrics, schema), or with a `merge`
+function both are combined (sample deltas, see `protocol.merge_samples`).
+The queue is bounded by `max_depth` frames, beyond that the oldest is
+dropped.
+
+The update rate adapts to the client: while frames of the previous update
+are still queued when the next one is due, the interval between updates
+doubles, otherwise it shrinks again towards `MIN_INTERVAL`.
+"""
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+from time import monotonic
+
+import websockets
+
+# one update per tick of the stream loop
+MIN_INTERVAL = 0.0166
+MAX_INTERVAL = 2.0
+_unique = itertools.count()
+
+
+class Outbox:
+    def __init__(self, websocket, max_depth: int = 64):
+        self.websocket = websocket
+        self.max_depth = max_depth
+        # frame and time it was first queued, by key
+        self._frames: "OrderedDict[object, tuple]" = OrderedDict()
+        self._ready = asyncio.Event()
+        self.interval = MIN_INTERVAL
+        self._next_update = 0.0
+        self.bytes = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.coalesced = 0
+        self.dropped = 0
+        # seconds from queueing to written, last and smoothed
+        self.lag = 0.0
+        self.lag_avg = 0.0
+
+    def put(self, key, frame, merge=None):
+        """Queues a frame, `key=None` for one that never replaces another.
+        `merge(pending, frame)` combines it with a pending frame of the key,
+        without it the pending frame is replaced
+        """
+        if key is None:
+            key = ("unique", next(_unique))
+        queued_at = monotonic()
+        if key in self._frames:
+            pending, queued_at = self._frames[key]
+            self.bytes -= len(pending)
+            frame = merge(pending, frame) if merge is not None else frame
+            self.coalesced += 1
+        # a replaced frame keeps its place, frames that must follow it still do
+        self._frames[key] = (frame, queued_at)
+        self.bytes += len(frame)
+        while len(self._frames) > self.max_depth:
+            _, (dropped, _) = self._frames.popitem(last=False)
+            self.bytes -= len(dropped)
+            self.dropped += 1
+        self._ready.set()
+
+    def clear(self):
+        self._frames.clear()
+        self.bytes = 0
+        self._ready.clear()
+
+    def due(self, now: float) -> bool:
+        """Whether the client gets an update this tick, adapts the interval"""
+        if now < self._next_update:
+            return False
+        if self._frames:
+            # the previous update is not written yet
+            self.interval = min(MAX_INTERVAL, self.interval * 2)
+        else:
+            self.interval = max(MIN_INTERVAL, self.interval * 0.75)
+        self._next_update = now + self.interval
+        return True
+
+    async def run(self):
+        """Writes the queued frames until the connection closes"""
+        try:
+            while True:
+                await self._ready.wait()
+                if not self._frames:
+                    # cleared after it was set
+                    self._ready.clear()
+                    continue
+                _, (frame, queued_at) = self._frames.popitem(last=False)
+                self.bytes -= len(frame)
+                if not self._frames:
+                    self._ready.clear()
+                await self.websocket.send(frame)
+                self.sent += 1
+                self.sent_bytes += len(frame)
+                self.lag = monotonic() - queued_at
+                self.lag_avg += 0.1 * (self.lag - self.lag_avg)
+        except websockets.ConnectionClosed:
+            pass
+        except Exception as e:
+            logging.error(f"Sending to {self.websocket.remote_address} failed: {e!r}")
+
+    def stats(self) -> dict:
+        oldest = next(iter(self._frames.values()), (None, None))[1]
+        return {
+            "queued": len(self._frames),
+            "queued_bytes": self.bytes,
+            "sent": self.sent,
+            "sent_bytes": self.sent_bytes,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "lag_s": round(self.lag, 4),
+            "lag_avg_s": round(self.lag_avg, 4),
+            # age of the oldest frame not written yet
+            "waiting_s": round(monotonic() - oldest, 4) if oldest is not None else 0.0,
+            "rate_hz": round(1 / self.interval, 1),
+        }
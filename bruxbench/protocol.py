@@ -0,0 +1,145 @@
+"""Live view websocket protocol
+
+Version 1 (the default) sends the complete chart data of every sensor as
+JSON on every update. A client asking for version 2
+
+    {"action": "stream", "dir": "<session>", "protocol": 2}
+
+gets the schema and colors of the sensors once, as JSON
+
+    {"type": "schema", "sensors": {"emg": {"id": 0, "columns": [...], "colors": [...],
+                                           "background_colors": [...]}, ...}, "window": 100}
+
+(again whenever a sensor is added), followed by binary frames holding only
+the samples it has not seen yet. All little-endian:
+
+    u8 version | u8 type | u16 sensor id | u64 sequence number of the first sample |
+    u32 sample count n | u16 column count c | i16 level | 4 bytes padding |
+    i64 dt[n] | f32 column 0 [n] | ... | f32 column c-1 [n]
+
+Sequence numbers count the samples of a sensor since the stream started, a
+first sequence number past the last one received means samples were
+skipped. Missing values are NaN. Telemetry follows as JSON
+`{"type": "metrics", "metrics": {...}}`.
+
+With `"span_s"` and `"width"` in the stream action (or a later
+`{"action": "view", "span_s": 300, "width": 800}`) the frames hold the
+min/max points of a decimated view of the last `span_s` instead of the raw
+samples, see `decimate.py`. Its newest points change until their bucket is
+complete: a frame starting before the next expected sequence number
+replaces the points from there on.
+
+`{"action": "range", "id": 7, "sensor": "emg", "t0": ..., "t1": ..., "points": 1000}`
+(optionally with a `"dir"`, by default the streamed or replayed session) asks for
+`[t0, t1)` of a recording at about `points` points, answered from its
+summary pyramid (see `pyramid.py`) with one summary frame: type 2, the
+request id in place of the sequence number, the pyramid level (-1 for
+samples), `dt` the bucket starts and `3 * columns` columns, all minimums,
+then all maximums, then all means.
+
+Frames a client has not read yet are combined with newer ones, a client
+that reads slowly gets fewer, larger sample frames and the newest payload,
+schema and metrics only (see `outbox.py`). `{"action": "stats"}` is
+answered with the queue and lag of every connection,
+`{"type": "stats", "clients": [...], "cache": {...}}`.
+
+`{"action": "replay", "dir": "<session>", "speed": 1}` (optionally with
+`"t"`, a `dt` to start from, and like `stream` with `"protocol"`,
+`"span_s"` and `"width"`) plays a finished session back to the client at
+0.5x to 20x, see `replay.py`. Its state follows as JSON whenever it changes,
+
+    {"type": "replay", "dir": "<session>", "start": ..., "end": ..., "position": ...,
+     "speed": 1, "playing": true, "episodes": [[t0, t1], ...]}
+
+and `{"action": "seek", "t": ...}`, `{"action": "seek", "episode": 3}`,
+`{"action": "pause"}`, `{"action": "resume"}` and
+`{"action": "speed", "speed": 4}` control it. After a seek the schema and
+the samples are sent from scratch.
+"""
+import json
+import struct
+from typing import Dict, List
+
+import numpy as np
+
+PROTOCOL_JSON = 1
+PROTOCOL_BINARY = 2
+
+FRAME_VERSION = 1
+FRAME_SAMPLES = 1
+FRAME_SUMMARY = 2
+FRAME_HEADER = struct.Struct("<BBHQIHh4x")
+
+
+def value_columns(dtype: np.dtype) -> List[str]:
+    """The charted columns, numeric ones besides `dt`"""
+    return [c for c in dtype.names[1:] if dtype[c].kind == 'f' or dtype[c].kind == 'i']
+
+
+def float32_values(column: np.ndarray) -> np.ndarray:
+    if column.dtype.kind == 'f':
+        return column.astype('<f4')
+    # missing integers are stored as the type minimum
+    values = column.astype('<f4')
+    values[column == np.iinfo(column.dtype).min] = np.nan
+    return values
+
+
+def encode_samples(sensor_id: int, first_seq: int, data: np.ndarray) -> bytes:
+    columns = value_columns(data.dtype)
+    parts = [FRAME_HEADER.pack(FRAME_VERSION, FRAME_SAMPLES, sensor_id, first_seq, len(data), len(columns), 0),
+             data['dt'].astype('<i8').tobytes()]
+    parts += [float32_values(data[c]).tobytes() for c in columns]
+    return b"".join(parts)
+
+
+def encode_summary(sensor_id: int, request_id: int, level: int, records: np.ndarray) -> bytes:
+    """Records of `pyramid.read_summary` as a summary frame"""
+    columns = records.dtype["min"].shape[0]
+    parts = [FRAME_HEADER.pack(FRAME_VERSION, FRAME_SUMMARY, sensor_id, request_id, len(records), 3 * columns, level),
+             records["t"].astype('<i8').tobytes()]
+    for field in ("min", "max", "mean"):
+        parts += [np.ascontiguousarray(records[field][:, i], dtype='<f4').tobytes() for i in range(columns)]
+    return b"".join(parts)
+
+
+def decode_samples(frame: bytes) -> Dict:
+    """Inverse of `encode_samples` and `encode_summary`, for tests and Python clients"""
+    version, frame_type, sensor_id, first_seq, count, n_columns, level = FRAME_HEADER.unpack_from(frame)
+    offset = FRAME_HEADER.size
+    dt = np.frombuffer(frame, dtype='<i8', count=count, offset=offset)
+    offset += 8 * count
+    values = []
+    for _ in range(n_columns):
+        values.append(np.frombuffer(frame, dtype='<f4', count=count, offset=offset))
+        offset += 4 * count
+    return {"type": frame_type, "id": sensor_id, "seq": first_seq, "level": level, "dt": dt, "values": values}
+
+
+def merge_samples(older: bytes, newer: bytes, window: int) -> bytes:
+    """Sample frame of a sensor holding what two consecutive frames hold,
+    at most the last `window` samples. A newer frame that starts at or
+    before the older one or after a gap replaces it
+    """
+    old, new = decode_samples(older), decode_samples(newer)
+    keep = new["seq"] - old["seq"]
+    if keep <= 0 or keep > len(old["dt"]):
+        return newer
+    dt = np.concatenate((old["dt"][:keep], new["dt"]))[-window:]
+    first_seq = new["seq"] + len(new["dt"]) - len(dt)
+    parts = [FRAME_HEADER.pack(FRAME_VERSION, FRAME_SAMPLES, new["id"], first_seq, len(dt), len(new["values"]), 0),
+             dt.tobytes()]
+    parts += [np.concatenate((o[:keep], n))[-window:].tobytes() for o, n in zip(old["values"], new["values"])]
+    return b"".join(parts)
+
+
+def replay_message(state: Dict) -> str:
+    return json.dumps({"type": "replay", **state})
+
+
+def schema_message(sensors: Dict[str, Dict], window: int) -> str:
+    return json.dumps({"type": "schema", "sensors": sensors, "window": window})
+
+
+def metrics_message(metrics: Dict) -> str:
+    return json.dumps({"type": "metrics", "metrics": metrics})
@@ -0,0 +1,281 @@
+"""Multi-resolution summary pyramid of recordings
+
+Next to every sensor recording the consumer writes `<sensor>.pyramid/`:
+level `k` holds one record per `2 ** (BASE_SHIFT + k)` ns time bucket that
+has samples (level 0 about 1 ms, the last level about 69 s),
+
+    i8 bucket start (ns) | u4 rows | f4 min [columns] | f4 max [columns] | f4 mean [columns]
+
+in `level_<k>.bin`, and `meta.json` lists the columns. Buckets are closed
+and appended as the recording grows, each level is built from the
+closed buckets of the level below, so the cost per sample is that of
+level 0.
+
+`read_summary(path, t0, t1, points)` answers "`[t0, t1)` at about `points`
+points" from the level whose buckets are just small enough, reading only
+that slice of it: the same time for any span of any session length.
+Finer than level 0 it falls back to the samples (`timeindex.read_range`).
+
+Usage to build the pyramids of existing sessions:
+    python pyramid.py out/<dir>@<ts>
+"""
+import glob
+import json
+import os
+import sys
+from math import ceil, log2
+from typing import Dict, List
+
+import numpy as np
+
+from recording import FORMAT_BIN, FORMAT_CSV, Schema, read_csv_recording, read_recording
+from segments import MANIFEST_SUFFIX, read_segments
+from timeindex import read_range
+
+PYRAMID_SUFFIX = ".pyramid"
+META_FILE = "meta.json"
+BASE_SHIFT = 20
+LEVELS = 17
+_BUILD_CHUNK = 1 << 20
+
+
+def summary_dtype(columns: int) -> np.dtype:
+    return np.dtype([("t", "<i8"), ("rows", "<u4"), ("min", "<f4", (columns,)), ("max", "<f4", (columns,)),
+                     ("mean", "<f4", (columns,))])
+
+
+def level_path(pyramid_dir: str, level: int) -> str:
+    return os.path.join(pyramid_dir, f"level_{level:02d}.bin")
+
+
+def numeric_columns(schema: Schema) -> List[str]:
+    return [c for c, t in zip(schema.columns[1:], schema.types[1:]) if np.dtype(t).kind in "fiu"]
+
+
+class _Level:
+    """Open bucket and file of one level. Takes partial summaries ordered by
+    bucket, returns the buckets that got closed
+    """
+
+    def __init__(self, shift: int, path: str, dtype: np.dtype):
+        self.shift = shift
+        self.dtype = dtype
+        self._f = open(path, 'ab')
+        self._open = None
+
+    def add(self, buckets, rows, mins, maxs, sums, counts):
+        # a backwards step of the wall clock goes into the newest bucket, the records stay sorted
+        floor = self._open[0][0] if self._open is not None else buckets[0]
+        buckets = np.maximum.accumulate(np.maximum(buckets, floor))
+        if self._open is not None:
+            buckets, rows, mins, maxs, sums, counts = [np.concatenate((o, a)) for o, a in
+                                                       zip(self._open, (buckets, rows, mins, maxs, sums, counts))]
+        starts = np.flatnonzero(np.diff(buckets, prepend=buckets[0] - 1))
+        merged = (buckets[starts], np.add.reduceat(rows, starts), np.fmin.reduceat(mins, starts),
+                  np.fmax.reduceat(maxs, starts), np.add.reduceat(sums, starts), np.add.reduceat(counts, starts))
+        # the newest bucket may get more samples
+        self._open = [a[-1:] for a in merged]
+        closed = [a[:-1] for a in merged]
+        self._write(closed)
+        return closed
+
+    def close(self):
+        """Writes the open bucket, returns it as closed"""
+        closed = self._open
+        if closed is not None:
+            self._write(closed)
+        self._open = None
+        self._f.close()
+        return closed
+
+    def _write(self, summary):
+        buckets, rows, mins, maxs, sums, counts = summary
+        if not len(buckets):
+            return
+        out = np.empty(len(buckets), dtype=self.dtype)
+        out["t"] = buckets << self.shift
+        out["rows"] = rows
+        out["min"] = mins
+        out["max"] = maxs
+        with np.errstate(invalid='ignore', divide='ignore'):
+            out["mean"] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+        self._f.write(out.tobytes())
+        self._f.flush()
+
+
+class PyramidBuilder:
+    """Feeds samples (structured arrays ordered by `dt`) into all levels"""
+
+    def __init__(self, pyramid_dir: str, columns: List[str]):
+        os.makedirs(pyramid_dir, exist_ok=True)
+        self.columns = columns
+        self.dtype = summary_dtype(len(columns))
+        with open(os.path.join(pyramid_dir, META_FILE), 'w') as f:
+            json.dump({"columns": columns, "base_shift": BASE_SHIFT, "levels": LEVELS}, f)
+        self.levels = [_Level(BASE_SHIFT + k, level_path(pyramid_dir, k), self.dtype) for k in range(LEVELS)]
+
+    def add(self, data: np.ndarray):
+        if len(data) == 0:
+            return
+        values = np.empty((len(data), len(self.columns)), dtype=np.float64)
+        for i, c in enumerate(self.columns):
+            values[:, i] = data[c]
+            if data.dtype[c].kind in "iu":
+                # missing integers are stored as the type minimum
+                values[data[c] == np.iinfo(data.dtype[c]).min, i] = np.nan
+        missing = np.isnan(values)
+        summary = (data["dt"] >> BASE_SHIFT, np.ones(len(data), dtype=np.uint32), values, values,
+                   np.where(missing, 0, values), (~missing).astype(np.uint32))
+        self._cascade(0, summary)
+
+    def _cascade(self, level: int, summary):
+        while level < len(self.levels) and len(summary[0]):
+            summary = self.levels[level].add(*summary)
+            level += 1
+            summary = (summary[0] >> 1, *summary[1:])
+
+    def close(self):
+        """Closes the open buckets of all levels"""
+        carry = None
+        for level in self.levels:
+            parts = []
+            if carry is not None and len(carry[0]):
+                parts.append(level.add(carry[0] >> 1, *carry[1:]))
+            last = level.close()
+            if last is not None:
+                parts.append(last)
+            carry = [np.concatenate(a) for a in zip(*parts)] if parts else None
+
+
+class PyramidWriter:
+    """Wraps a record writer (see `recording.WRITERS`) and builds the pyramid
+    of what it writes, on the writer thread
+    """
+
+    def __init__(self, writer, path: str, columns: List[str], column_types: Dict[str, str] = None):
+        self.writer = writer
+        self.schema = Schema(columns, column_types)
+        self.columns = numeric_columns(self.schema)
+        self.pyramid_dir = pyramid_dir_of(path)
+        self.builder = None
+
+    def create(self):
+        self.writer.create()
+
+    def open(self):
+        self.writer.open()
+        self.builder = PyramidBuilder(self.pyramid_dir, self.columns)
+
+    def write_rows(self, batch: list):
+        self.writer.write_rows(batch)
+        if batch:
+            self.builder.add(self.schema.pack_array(batch))
+
+    def flush(self):
+        self.writer.flush()
+
+    def fileno(self) -> int:
+        return self.writer.fileno()
+
+    def close(self):
+        self.writer.close()
+        self.builder.close()
+
+
+def recording_paths(session_dir: str) -> Dict[str, str]:
+    """Recording of every sensor of a session: its manifest or its file"""
+    paths = {}
+    for path in sorted(glob.glob(f"{session_dir}/*.{FORMAT_CSV}") + glob.glob(f"{session_dir}/*.{FORMAT_BIN}")):
+        paths.setdefault(os.path.basename(path).split('.')[0], path)
+    for path in glob.glob(f"{session_dir}/*{MANIFEST_SUFFIX}"):
+        paths[os.path.basename(path)[:-len(MANIFEST_SUFFIX)]] = path
+    return paths
+
+
+def build_pyramid(path: str, column_types: Dict[str, str] = None) -> str:
+    """Pyramid of a finished recording (file or manifest)"""
+    if path.endswith(MANIFEST_SUFFIX):
+        data = read_segments(path, column_types)
+    elif path.endswith(f".{FORMAT_BIN}"):
+        data = read_recording(path)
+    else:
+        data = read_csv_recording(path, column_types)
+
+    pyramid_dir = pyramid_dir_of(path)
+    for level in range(LEVELS):
+        if os.path.exists(level_path(pyramid_dir, level)):
+            os.remove(level_path(pyramid_dir, level))
+    schema = Schema(data.dtype.names, {c: data.dtype[c].str for c in data.dtype.names})
+    builder = PyramidBuilder(pyramid_dir, numeric_columns(schema))
+    for start in range(0, len(data), _BUILD_CHUNK):
+        builder.add(data[start:start + _BUILD_CHUNK])
+    builder.close()
+    return pyramid_dir
+
+
+def read_level(pyramid_dir: str, level: int, t0: int, t1: int) -> np.ndarray:
+    with open(os.path.join(pyramid_dir, META_FILE)) as f:
+        meta = json.load(f)
+    dtype = summary_dtype(len(meta["columns"]))
+    path = level_path(pyramid_dir, level)
+    count = os.path.getsize(path) // dtype.itemsize
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+    records = np.memmap(path, dtype=dtype, mode='r', shape=(count,))
+    # a bucket overlapping t0 is included
+    start = int(np.searchsorted(records["t"], t0 - (1 << (meta["base_shift"] + level)), side='right'))
+    end = int(np.searchsorted(records["t"], t1, side='left'))
+    return np.array(records[start:end])
+
+
+def pick_level(t0: int, t1: int, points: int) -> int:
+    """Level with the smallest buckets giving at most about `points` buckets, -1 for the samples"""
+    bucket_ns = max(1, (t1 - t0) // max(1, points))
+    return min(LEVELS - 1, ceil(log2(bucket_ns)) - BASE_SHIFT) if bucket_ns > 1 << BASE_SHIFT else -1
+
+
+def pyramid_dir_of(path: str) -> str:
+    """Pyramid of a recording (file or manifest)"""
+    stem = path[:-len(MANIFEST_SUFFIX)] if path.endswith(MANIFEST_SUFFIX) else os.path.splitext(path)[0]
+    return stem + PYRAMID_SUFFIX
+
+
+def has_pyramid(path: str) -> bool:
+    return os.path.exists(os.path.join(pyramid_dir_of(path), META_FILE))
+
+
+def samples_summary(data: np.ndarray) -> np.ndarray:
+    """Samples as pyramid records, min = max = mean"""
+    schema = Schema(data.dtype.names, {c: data.dtype[c].str for c in data.dtype.names})
+    columns = numeric_columns(schema)
+    out = np.empty(len(data), dtype=summary_dtype(len(columns)))
+    out["t"] = data["dt"]
+    out["rows"] = 1
+    for i, c in enumerate(columns):
+        out["min"][:, i] = out["max"][:, i] = out["mean"][:, i] = data[c]
+    return out
+
+
+def read_summary(path: str, t0: int, t1: int, points: int):
+    """`[t0, t1)` of a recording (file or manifest) at about `points` points.
+    Returns the level (-1 for samples) and the records of that level, see
+    `samples_summary` for the samples
+    """
+    level = pick_level(t0, t1, points)
+    if level >= 0 and has_pyramid(path):
+        return level, read_level(pyramid_dir_of(path), level, t0, t1)
+    return -1, samples_summary(read_range(path, t0, t1))
+
+
+def pyramid_session(session_dir: str) -> List[str]:
+    """Builds the pyramid of every recording of a session that has none"""
+    built = []
+    for path in recording_paths(session_dir).values():
+        if not has_pyramid(path):
+            built.append(build_pyramid(path))
+    return built
+
+
+if __name__ == "__main__":
+    for pyramid_dir in pyramid_session(sys.argv[1]):
+        print(pyramid_dir)
@@ -1,42 +1,443 @@
-import csv
+import json
 import os
-from asyncio import Queue, Event
+import pickle
+import tempfile
+from asyncio import Queue, QueueFull, Event, wait_for, TimeoutError, get_running_loop, sleep
+from concurrent.futures import Executor, ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+from logging import getLogger
+from time import monotonic, perf_counter
+from recording import WRITERS, FORMAT_CSV, row_dt
+from segments import SegmentedWriter
+from timeindex import IndexedWriter
+from pyramid import PyramidWriter
+from telemetry import IntervalStats
+
+logger = getLogger("reactor")
+
+# Durability policies for the consumer output files
+FSYNC_NONE = "none"          # leave it to the OS page cache
+FSYNC_PERIODIC = "periodic"  # fsync at most every `fsync_interval_s`
+FSYNC_BATCH = "batch"        # fsync after every written batch
+
+# What a full producer queue does with new samples
+OVERFLOW_BLOCK = "block"              # wait for the consumer to make room
+OVERFLOW_DROP_OLDEST = "drop-oldest"  # evict the oldest queued sample
+OVERFLOW_DROP_NEWEST = "drop-newest"  # discard the new sample
+OVERFLOW_SPILL = "spill"              # park samples in a file until there is room
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_SPILL)
+
+
+def _samples(item) -> int:
+    """Queue entries are single samples or batches (lists) of them"""
+    return len(item) if isinstance(item, list) else 1
+
+
+class SampleQueue(Queue):
+    """Bounded queue with an overflow policy and loss accounting.
+    Capacity and depth count queue entries, `dropped` counts samples.
+
+    Spilled samples are pickled into a temporary file and moved back into the
+    queue in FIFO order as the consumer takes items out; while anything is
+    spilled the in-memory part is kept full, so ordering is preserved.
+    """
+
+    def __init__(self, maxsize: int = 0, overflow: str = OVERFLOW_BLOCK, spill_dir: str = None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {overflow}")
+        super().__init__(maxsize)
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.high_water_mark = 0
+        self.dropped = 0
+        self.spilled = 0
+        self._spill = None
+        self._spill_pending = 0
+        self._spill_read_pos = 0
+
+    def depth(self) -> int:
+        return self.qsize() + self._spill_pending
+
+    def offer(self, item) -> bool:
+        """Non-blocking put applying the overflow policy.
+        `block` can't wait here and behaves like `drop-newest`.
+        Returns False if the item was dropped.
+        """
+        if self._spill_pending:
+            self._spill_item(item)
+            return True
+
+        try:
+            self.put_nowait(item)
+            return True
+        except QueueFull:
+            pass
+
+        if self.overflow == OVERFLOW_SPILL:
+            self._spill_item(item)
+            return True
+
+        if self.overflow == OVERFLOW_DROP_OLDEST:
+            self.dropped += _samples(self.get_nowait())
+            self.task_done()
+            self.put_nowait(item)
+            return True
+        self.dropped += _samples(item)
+        return False
+
+    def force(self, item):
+        """Put that never drops `item`, past the capacity if need be, for
+        records that must not get lost (gap records, see `supervisor.py`)
+        """
+        if self._spill_pending:
+            # behind the spilled items, in order
+            self._spill_item(item)
+            return
+        self._put(item)
+        # same bookkeeping `put_nowait` does, so `task_done` stays balanced
+        self._unfinished_tasks += 1
+        self._finished.clear()
+        self._wakeup_next(self._getters)
+        self.high_water_mark = max(self.high_water_mark, self.depth())
+
+    def put_nowait(self, item):
+        super().put_nowait(item)
+        self.high_water_mark = max(self.high_water_mark, self.depth())
+
+    def _get(self):
+        item = super()._get()
+        if self._spill_pending:
+            # refill the freed slot, the spill file continues where the queue ends
+            self._put(self._unspill_item())
+        return item
+
+    def _spill_item(self, item):
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile(dir=self.spill_dir, suffix=".spill")
+        self._spill.seek(0, os.SEEK_END)
+        pickle.dump(item, self._spill, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spill_pending += 1
+        self.spilled += 1
+        # same bookkeeping `put_nowait` does, so `task_done` stays balanced
+        self._unfinished_tasks += 1
+        self._finished.clear()
+        self.high_water_mark = max(self.high_water_mark, self.depth())
+
+    def _unspill_item(self):
+        self._spill.seek(self._spill_read_pos)
+        item = pickle.load(self._spill)
+        self._spill_read_pos = self._spill.tell()
+        self._spill_pending -= 1
+        if self._spill_pending == 0:
+            self._spill.seek(0)
+            self._spill.truncate()
+            self._spill_read_pos = 0
+        return item
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.maxsize,
+            "overflow": self.overflow,
+            "depth": self.depth(),
+            "high_water_mark": self.high_water_mark,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+        }
 
 
 class Producer:
-    def __init__(self):
-        self.queue = Queue()
+    def __init__(self, capacity: int = 0, overflow: str = OVERFLOW_BLOCK):
+        """`capacity` bounds the queue (0 is unbounded), `overflow` is one of
+        `OVERFLOW_POLICIES` and decides what happens to samples once it is full
+        """
+        self.queue = SampleQueue(maxsize=capacity, overflow=overflow)
         self.finished_execution = Event()
+        # read by `telemetry.Telemetry`
+        self.samples = 0
+        self.intervals = IntervalStats()
+        # live ring (`ringbuffer.RingWriter`) written by `publish`, and the samples not in it yet
+        self.ring = None
+        self._unpublished = []
+
+    def _publish(self, data):
+        rows = data if isinstance(data, list) else [data]
+        if not rows:
+            return
+        self.samples += len(rows)
+        self.intervals.add(row_dt(rows[-1]), len(rows))
+        if self.ring is not None:
+            self._unpublished.extend(rows)
+
+    async def publish(self, interval_s: float = 0.01):
+        """Writes the samples produced since the last write into `ring` every
+        `interval_s` until the producer finished. They are packed together in
+        one numpy call (`Schema.pack_array`), not on every produced sample,
+        and independently of the batches of the consumer.
+        """
+        while not self.finished_execution.is_set():
+            await sleep(interval_s)
+            self._write_ring()
+        self._write_ring()
+
+    def _write_ring(self):
+        if self._unpublished:
+            rows, self._unpublished = self._unpublished, []
+            self.ring.write(rows)
 
     async def produce(self, data):
-        self.queue.put_nowait(data)
+        self._publish(data)
+        if self.queue.overflow == OVERFLOW_BLOCK:
+            await self.queue.put(data)
+        else:
+            self.queue.offer(data)
+
+    async def produce_batch(self, items: list):
+        """Enqueue many samples as one queue entry, the consumer writes them
+        with a single wake-up
+        """
+        await self.produce(items)
+
+    def produce_nowait(self, data) -> bool:
+        """For callbacks that can't await, see `SampleQueue.offer`"""
+        self._publish(data)
+        return self.queue.offer(data)
 
     def stop_producer(self):
         self.finished_execution.set()
 
 
+class WriterStats:
+    """Throughput and latency bookkeeping of a consumer"""
+
+    def __init__(self):
+        self.rows = 0
+        self.batches = 0
+        self.fsyncs = 0
+        self.batch_latency_total_s = 0.0
+        self.batch_latency_max_s = 0.0
+        self.batch_latency_recent_max_s = 0.0
+        self.started_at = None
+        self.last_write_at = None
+
+    def add_batch(self, rows: int, latency_s: float):
+        now = monotonic()
+        if self.started_at is None:
+            self.started_at = now
+        self.last_write_at = now
+        self.rows += rows
+        self.batches += 1
+        self.batch_latency_total_s += latency_s
+        self.batch_latency_max_s = max(self.batch_latency_max_s, latency_s)
+        self.batch_latency_recent_max_s = max(self.batch_latency_recent_max_s, latency_s)
+
+    def take_recent_max(self) -> float:
+        """Slowest batch since the previous call"""
+        latency_s, self.batch_latency_recent_max_s = self.batch_latency_recent_max_s, 0.0
+        return latency_s
+
+    def rows_per_s(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        elapsed = monotonic() - self.started_at
+        return self.rows / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "rows": self.rows,
+            "batches": self.batches,
+            "fsyncs": self.fsyncs,
+            "rows_per_s": round(self.rows_per_s(), 2),
+            "avg_batch_rows": round(self.rows / self.batches, 2) if self.batches else 0,
+            "avg_batch_latency_ms": round(1000 * self.batch_latency_total_s / self.batches, 3) if self.batches else 0,
+            "max_batch_latency_ms": round(1000 * self.batch_latency_max_s, 3),
+        }
+
+
+class WriterPool:
+    """Writer threads that keep the file I/O off the event loop.
+    Every consumer is pinned to one single-threaded executor, so its batches
+    are written in order while different files can be written in parallel.
+    """
+
+    def __init__(self, workers: int = 1):
+        self._executors = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"writer{i}")
+                           for i in range(max(1, workers))]
+        self._next = 0
+
+    def assign(self) -> Executor:
+        executor = self._executors[self._next % len(self._executors)]
+        self._next += 1
+        return executor
+
+    def shutdown(self):
+        for executor in self._executors:
+            executor.shutdown(wait=True)
+
+
 class Consumer:
-    def __init__(self, filename: str, queue: Queue, finished_execution: Event, csv_headers: list):
+    """Drains the producer queue into the sensor output file.
+
+    Rows are written in batches (group commit): a batch is closed either when
+    `batch_size` rows were collected or `flush_interval_s` passed since the
+    first row of the batch arrived, then written with a single `writerows`
+    and buffer flush. After the producer finished, the queue is drained
+    completely before the file is closed.
+
+    With an `executor` set (see `WriterPool`) the writes run on that thread
+    and the event loop only collects batches: the next batch is gathered
+    while the previous one is being written.
+    """
+
+    def __init__(self, filename: str, queue: Queue, finished_execution: Event, csv_headers: list,
+                 batch_size: int = 512, flush_interval_s: float = 0.25,
+                 fsync: str = FSYNC_PERIODIC, fsync_interval_s: float = 5.0,
+                 output_format: str = FORMAT_CSV, column_types: dict = None,
+                 segment_s: float = None, compression: str = None, time_index: bool = True,
+                 pyramid: bool = True):
+        """With `segment_s` the output is rotated into segments of that many
+        seconds, closed segments are compressed with `compression` (`gzip`
+        or `zstd`) in the background, see `segments.py`.
+        With `time_index` a sparse per-second index is written next to every
+        output file, see `timeindex.py`, and with `pyramid` a multi-resolution
+        summary of the recording, see `pyramid.py`
+        """
+        if output_format not in WRITERS:
+            raise ValueError(f"Unknown output format {output_format}")
+        if fsync not in (FSYNC_NONE, FSYNC_PERIODIC, FSYNC_BATCH):
+            raise ValueError(f"Unknown fsync policy {fsync}")
+
         self.filename = filename
         self.queue = queue
         self.finished_execution = finished_execution
         self.csv_headers = csv_headers
-        self.buffer = []
+        self.batch_size = batch_size
+        self.flush_interval_s = flush_interval_s
+        self.fsync = fsync
+        self.fsync_interval_s = fsync_interval_s
+        self.output_format = output_format
+        self.column_types = column_types
+        self.segment_s = segment_s
+        self.compression = compression
+        self.time_index = time_index
+        self.pyramid = pyramid
+        self.writer = None
+        self.executor = None
+        self.stats = WriterStats()
+        # outages of the sensor, see `supervisor.py`
+        self.gaps = []
+        # queue counters of the worker process the samples came through, see `workers.py`
+        self.worker_queue = None
+        self._last_fsync = monotonic()
 
     async def consume(self):
-        with open(f"{self.dir}/{self.filename}", 'a') as f:
-            writer = csv.writer(f)
-            while not self.finished_execution.is_set():
-                # wait for an item from the producer
-                item = await self.queue.get()
-                # self.buffer.append(item.values())
-                writer.writerow(item.values())
+        await self._run_io(self.writer.open)
+        try:
+            in_flight = None
+            while True:
+                batch = await self._next_batch()
+                if in_flight is not None:
+                    # at most one batch is handed to the writer thread at a time
+                    await in_flight
+                    in_flight = None
+
+                if batch:
+                    in_flight = self._submit(batch)
+                elif self.finished_execution.is_set():
+                    # producer stopped and nothing left in the queue
+                    break
+
+            if self.fsync != FSYNC_NONE:
+                await self._run_io(self._fsync)
+        finally:
+            await self._run_io(self.writer.close)
+
+        await self._run_io(self._write_stats)
+        logger.info(f"{self.filename} closed: {self.stats.as_dict()}")
+
+    async def _next_batch(self) -> list:
+        """Collect up to `batch_size` rows, a queued batch is never split.
+        Waits at most `flush_interval_s` for the batch to fill up and never
+        blocks once the producer finished.
+        """
+        batch = []
+        deadline = monotonic() + self.flush_interval_s
+        while len(batch) < self.batch_size:
+            if not self.queue.empty():
+                self._add(batch, self.queue.get_nowait())
+                self.queue.task_done()
+                continue
+
+            if self.finished_execution.is_set():
+                break
+
+            timeout = deadline - monotonic()
+            if timeout <= 0:
+                break
+
+            try:
+                self._add(batch, await wait_for(self.queue.get(), timeout))
                 self.queue.task_done()
+            except TimeoutError:
+                break
+
+        return batch
+
+    @staticmethod
+    def _add(batch: list, item):
+        if isinstance(item, list):
+            batch.extend(item)
+        else:
+            batch.append(item)
+
+    def _submit(self, batch: list):
+        """Write the batch inline, or return a future if it runs on the executor"""
+        if self.executor is None:
+            self._write_batch(batch)
+            return None
+        return get_running_loop().run_in_executor(self.executor, self._write_batch, batch)
+
+    async def _run_io(self, fn):
+        if self.executor is None:
+            return fn()
+        return await get_running_loop().run_in_executor(self.executor, fn)
+
+    def _write_batch(self, batch: list):
+        start = perf_counter()
+        self.writer.write_rows(batch)
+        self.writer.flush()
+
+        if self.fsync == FSYNC_BATCH or \
+                (self.fsync == FSYNC_PERIODIC and monotonic() - self._last_fsync >= self.fsync_interval_s):
+            self._fsync()
+
+        self.stats.add_batch(len(batch), perf_counter() - start)
+
+    def _write_stats(self):
+        """Persist writer and queue counters next to the recording,
+        so losses can be checked after the session
+        """
+        stats = {"writer": self.stats.as_dict()}
+        if self.gaps:
+            stats["gaps"] = self.gaps
+        if isinstance(self.queue, SampleQueue):
+            stats["queue"] = self.queue.stats()
+            self.queue.close()
+        if self.worker_queue is not None:
+            stats["worker_queue"] = self.worker_queue
+
+        with open(f"{self.dir}/{os.path.splitext(self.filename)[0]}.stats.json", 'w') as f:
+            json.dump(stats, f, indent=2)
 
-        # with open(f"{self.dir}/{self.filename}", 'a') as f:
-        #     writer = csv.writer(f)
-        #     writer.writerows(self.buffer)
+    def _fsync(self):
+        os.fsync(self.writer.fileno())
+        self._last_fsync = monotonic()
+        self.stats.fsyncs += 1
 
     def set_dir_name(self, dir):
         self.dir = f"out/{self._hash_dir_name(dir)}"
@@ -45,10 +446,18 @@ class Consumer:
     def _init_out_file(self):
         if not os.path.exists(self.dir):
             os.makedirs(self.dir)
-        with open(f"{self.dir}/{self.filename}", 'a') as f:
-            writer = csv.writer(f)
-            # write the header
-            writer.writerow(self.csv_headers)
+        path = f"{self.dir}/{self.filename}"
+        writer_cls = WRITERS[self.output_format]
+        if self.time_index:
+            writer_cls = partial(IndexedWriter, writer_cls)
+        if self.segment_s:
+            self.writer = SegmentedWriter(writer_cls, path, self.csv_headers, self.column_types,
+                                          self.segment_s, self.compression)
+        else:
+            self.writer = writer_cls(path, self.csv_headers, self.column_types)
+        if self.pyramid:
+            self.writer = PyramidWriter(self.writer, path, self.csv_headers, self.column_types)
+        self.writer.create()
 
     def _hash_dir_name(self, dir):
         return f"{dir}@{datetime.now().strftime('%Y_%m_%d__%H_%M_%S')}"
@@ -0,0 +1,364 @@
+"""Compact binary recording format
+
+A `.bin` recording starts with a small header followed by fixed-width,
+little-endian records: an int64 `dt` and one typed column per remaining
+`csv_headers` entry (float32 by default, int16 for ADC counts).
+
+    b"BRUX" | u16 version | u32 meta length | JSON meta (padded to 8 bytes) | records...
+
+The JSON meta holds the column names and their numpy dtype strings, so a
+recording can be opened without knowing which sensor wrote it.
+
+Usage to convert existing sessions:
+    python recording.py to-bin out/<dir>@<ts>
+    python recording.py to-csv out/<dir>@<ts>
+"""
+import csv
+import glob
+import json
+import os
+import struct
+import sys
+from math import nan
+from typing import BinaryIO, Dict, Iterable, List, Sequence, TextIO, Tuple
+
+import numpy as np
+
+FORMAT_CSV = "csv"
+FORMAT_BIN = "bin"
+
+MAGIC = b"BRUX"
+VERSION = 1
+DT_TYPE = "<i8"
+DEFAULT_TYPE = "<f4"
+
+# eSense IMU notification, see `sensor.BLE_eSense._decode`
+ESENSE_PACKET_SIZE = 16
+ESENSE_ACC_SCALE = 8192
+ESENSE_GYRO_SCALE = 65.5
+
+# (numpy kind, itemsize) -> struct code, explicit to avoid platform sized codes
+_STRUCT_CODES = {
+    ("i", 1): "b", ("u", 1): "B",
+    ("i", 2): "h", ("u", 2): "H",
+    ("i", 4): "i", ("u", 4): "I",
+    ("i", 8): "q", ("u", 8): "Q",
+    ("f", 4): "f", ("f", 8): "d",
+}
+
+
+class Schema:
+    """Column names and types of a recording"""
+
+    def __init__(self, columns: Sequence[str], column_types: Dict[str, str] = None):
+        column_types = column_types or {}
+        self.columns = list(columns)
+        self.types = [column_types.get(c, DT_TYPE if c == "dt" else DEFAULT_TYPE)
+                      for c in self.columns]
+        self.dtype = np.dtype([(c, t) for c, t in zip(self.columns, self.types)])
+
+        codes, self._converters, self._fill = [], [], []
+        for t in self.types:
+            dt = np.dtype(t)
+            if dt.kind == "S":
+                codes.append(f"{dt.itemsize}s")
+                self._converters.append(bytes)
+                self._fill.append(b"")
+            elif dt.kind == "f":
+                codes.append(_STRUCT_CODES[(dt.kind, dt.itemsize)])
+                self._converters.append(float)
+                self._fill.append(nan)
+            else:
+                codes.append(_STRUCT_CODES[(dt.kind, dt.itemsize)])
+                self._converters.append(_to_int)
+                self._fill.append(int(np.iinfo(dt).min))
+        self._struct = struct.Struct("<" + "".join(codes))
+        # single columns, to find the values of a row that don't fit their type
+        self._fields = [struct.Struct("<" + code) for code in codes]
+
+    @property
+    def record_size(self) -> int:
+        return self._struct.size
+
+    def pack_rows(self, rows: Iterable[Iterable]) -> bytes:
+        """Pack rows given as value sequences in column order.
+        Missing or malformed values are stored as NaN (floats) or the
+        type minimum (integers).
+        """
+        out = bytearray()
+        for values in rows:
+            out += self._pack_row(list(values))
+        return bytes(out)
+
+    def pack_array(self, rows: Sequence) -> np.ndarray:
+        """Rows (sample dicts or value tuples in column order) as one
+        structured array, converted by numpy in a single call. A batch numpy
+        can't convert (missing or malformed values) goes through `pack_rows`.
+        """
+        try:
+            with np.errstate(over='raise', invalid='raise'):
+                return np.array([tuple(_values(r)) for r in rows], dtype=self.dtype)
+        except (TypeError, ValueError, OverflowError, FloatingPointError):
+            return np.frombuffer(self.pack_rows(_values(r) for r in rows), dtype=self.dtype)
+
+    def _pack_row(self, values: list) -> bytes:
+        if len(values) == len(self.columns):
+            try:
+                return self._struct.pack(*[conv(v) for conv, v in zip(self._converters, values)])
+            except (TypeError, ValueError, OverflowError, struct.error):
+                pass
+
+        safe = []
+        for i, conv in enumerate(self._converters):
+            try:
+                value = conv(values[i])
+                # out of the range of the column type
+                self._fields[i].pack(value)
+                safe.append(value)
+            except (IndexError, TypeError, ValueError, OverflowError, struct.error):
+                safe.append(self._fill[i])
+        return self._struct.pack(*safe)
+
+    def header(self) -> bytes:
+        meta = json.dumps({"version": VERSION, "columns": [
+                          [c, t] for c, t in zip(self.columns, self.types)]}).encode("utf8")
+        # keep the records 8-byte aligned
+        pad = -(len(MAGIC) + 6 + len(meta)) % 8
+        meta += b" " * pad
+        return MAGIC + struct.pack("<HI", VERSION, len(meta)) + meta
+
+
+def _values(item):
+    """Rows are dicts from the sensors or tuples in column order (worker processes)"""
+    return item.values() if isinstance(item, dict) else item
+
+
+def row_dt(item):
+    """`dt` of a row, always its first value"""
+    return next(iter(item.values())) if isinstance(item, dict) else item[0]
+
+
+def _to_int(v) -> int:
+    if isinstance(v, int):
+        return v
+    try:
+        return int(v)
+    except ValueError:
+        return int(float(v))
+
+
+class CsvRecordWriter:
+    """Appends rows as CSV text"""
+    extension = FORMAT_CSV
+
+    def __init__(self, path: str, columns: List[str], column_types: Dict[str, str] = None):
+        self.path = path
+        self.columns = columns
+        self.f = None
+
+    def create(self):
+        with open(self.path, 'a') as f:
+            writer = csv.writer(f)
+            # write the header
+            writer.writerow(self.columns)
+
+    def open(self):
+        self.f = open(self.path, 'a')
+        self._writer = csv.writer(self.f)
+
+    def write_rows(self, batch: list):
+        self._writer.writerows(_values(item) for item in batch)
+
+    def tell(self) -> int:
+        return self.f.tell()
+
+    def flush(self):
+        self.f.flush()
+
+    def fileno(self) -> int:
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+
+class BinaryRecordWriter:
+    """Appends rows as fixed-width binary records"""
+    extension = FORMAT_BIN
+
+    def __init__(self, path: str, columns: List[str], column_types: Dict[str, str] = None):
+        self.path = path
+        self.schema = Schema(columns, column_types)
+        self.f = None
+
+    def create(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            return
+        with open(self.path, 'ab') as f:
+            f.write(self.schema.header())
+
+    def open(self):
+        self.f = open(self.path, 'ab')
+
+    def write_rows(self, batch: list):
+        self.f.write(self.schema.pack_rows(_values(item) for item in batch))
+
+    def tell(self) -> int:
+        return self.f.tell()
+
+    def flush(self):
+        self.f.flush()
+
+    def fileno(self) -> int:
+        return self.f.fileno()
+
+    def close(self):
+        self.f.close()
+
+
+WRITERS = {
+    FORMAT_CSV: CsvRecordWriter,
+    FORMAT_BIN: BinaryRecordWriter,
+}
+
+
+def read_header(path: str, offset: int = 0) -> Tuple[Schema, int]:
+    """Returns the schema of a binary recording and the byte offset of its first record,
+    `offset` is where the header starts in the file
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return read_header_from(f, path, offset)
+
+
+def read_header_from(f: BinaryIO, name: str, offset: int = 0) -> Tuple[Schema, int]:
+    """`read_header` of an open (possibly decompressing) file positioned at the header"""
+    head = f.read(len(MAGIC) + 6)
+    if head[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{name} is not a binary recording")
+    version, meta_len = struct.unpack("<HI", head[len(MAGIC):])
+    if version > VERSION:
+        raise ValueError(f"{name} has unsupported version {version}")
+    meta = json.loads(f.read(meta_len))
+
+    columns = [c for c, _ in meta["columns"]]
+    types = {c: t for c, t in meta["columns"]}
+    return Schema(columns, types), offset + len(MAGIC) + 6 + meta_len
+
+
+def read_recording(path: str, mmap: bool = True) -> np.ndarray:
+    """Load a binary recording as a numpy structured array (one field per column).
+    With `mmap` the file is mapped read-only instead of being read into memory.
+    A trailing partial record (file still being written) is ignored.
+    """
+    schema, offset = read_header(path)
+    count = (os.path.getsize(path) - offset) // schema.record_size
+    if count <= 0:
+        return np.empty(0, dtype=schema.dtype)
+
+    if mmap:
+        return np.memmap(path, dtype=schema.dtype, mode='r', offset=offset, shape=(count,))
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return np.fromfile(f, dtype=schema.dtype, count=count)
+
+
+def read_csv_recording(path: str, column_types: Dict[str, str] = None) -> np.ndarray:
+    """Parse a CSV recording into the same structured array `read_recording` returns"""
+    with open(path, 'r') as f:
+        return read_csv_from(f, column_types)
+
+
+def read_csv_from(f: TextIO, column_types: Dict[str, str] = None) -> np.ndarray:
+    """`read_csv_recording` of an open (possibly decompressing) text file"""
+    reader = csv.reader(f)
+    schema = Schema(next(reader), column_types)
+    data = schema.pack_rows(row for row in reader if row and row[0] != "dt")
+    return np.frombuffer(data, dtype=schema.dtype)
+
+
+def decode_esense_raw(path: str) -> np.ndarray:
+    """Decode a raw eSense capture (`BLE_eSense(capture_raw=True)`) at once.
+    Returns the same columns the live decoding writes.
+    """
+    raw = read_recording(path)
+    # big-endian int16 words of every packet: [.., .., gx, gy, gz, ax, ay, az]
+    words = np.ascontiguousarray(raw["raw_data"]).view(">i2").reshape(-1, ESENSE_PACKET_SIZE // 2)
+
+    out = np.empty(len(raw), dtype=Schema(["dt", "acceleration_x", "acceleration_y", "acceleration_z",
+                                           "gyro_x", "gyro_y", "gyro_z"]).dtype)
+    out["dt"] = raw["dt"]
+    acc = words[:, 5:8] / ESENSE_ACC_SCALE
+    gyro = words[:, 2:5] / ESENSE_GYRO_SCALE
+    for i, axis in enumerate("xyz"):
+        out[f"acceleration_{axis}"] = acc[:, i]
+        out[f"gyro_{axis}"] = gyro[:, i]
+    return out
+
+
+def csv_to_binary(csv_path: str, bin_path: str = None, column_types: Dict[str, str] = None) -> str:
+    bin_path = bin_path or f"{os.path.splitext(csv_path)[0]}.{FORMAT_BIN}"
+    data = read_csv_recording(csv_path, column_types)
+    schema = Schema(data.dtype.names, {c: data.dtype[c].str for c in data.dtype.names})
+    with open(bin_path, 'wb') as f:
+        f.write(schema.header())
+        f.write(data.tobytes())
+    return bin_path
+
+
+def binary_to_csv(bin_path: str, csv_path: str = None) -> str:
+    csv_path = csv_path or f"{os.path.splitext(bin_path)[0]}.{FORMAT_CSV}"
+    data = read_recording(bin_path)
+    with open(csv_path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(data.dtype.names)
+        writer.writerows(zip(*[_csv_column(data[c]) for c in data.dtype.names]))
+    return csv_path
+
+
+def _csv_column(values: np.ndarray) -> np.ndarray:
+    """Column as CSV text, missing values (NaN, the minimum of signed
+    integers, see `Schema.pack_rows`) as empty fields like the CSV writer
+    """
+    # numpy's str() gives the shortest repr of float32 values
+    text = values.astype(str)
+    if values.dtype.kind == "f":
+        text[np.isnan(values)] = ""
+    elif values.dtype.kind == "i":
+        text[values == np.iinfo(values.dtype).min] = ""
+    return text
+
+
+def convert_session(session_dir: str, to: str = FORMAT_BIN,
+                    column_types: Dict[str, Dict[str, str]] = None) -> List[str]:
+    """Convert every sensor file of a session, keeping the originals.
+    `column_types` maps sensor names to the `column_types` of the sensor,
+    CSV files carry no types (`{s.name: s.consumer.column_types for s in sensors}`)
+    """
+    column_types = column_types or {}
+    converted = []
+    if to == FORMAT_BIN:
+        for path in sorted(glob.glob(f"{session_dir}/*.{FORMAT_CSV}")):
+            target = f"{os.path.splitext(path)[0]}.{FORMAT_BIN}"
+            if not os.path.exists(target):
+                name = os.path.basename(os.path.splitext(path)[0])
+                converted.append(csv_to_binary(path, target, column_types.get(name)))
+    else:
+        for path in sorted(glob.glob(f"{session_dir}/*.{FORMAT_BIN}")):
+            target = f"{os.path.splitext(path)[0]}.{FORMAT_CSV}"
+            if not os.path.exists(target):
+                converted.append(binary_to_csv(path, target))
+    return converted
+
+
+if __name__ == "__main__":
+    # to-bin|to-csv <session dir> [JSON file of the column types by sensor name]
+    command, session_dir = sys.argv[1], sys.argv[2]
+    types = None
+    if len(sys.argv) > 3:
+        with open(sys.argv[3]) as f:
+            types = json.load(f)
+    for path in convert_session(session_dir, to=FORMAT_BIN if command == "to-bin" else FORMAT_CSV,
+                                column_types=types):
+        print(path)
@@ -0,0 +1,197 @@
+"""Replay of finished sessions
+
+A `Replay` plays the recordings of a session back on the server clock at
+`speed` (0.5x to 20x): every tick gives the rows of all sensors from the
+last position up to the new one, so the sensor streams stay merged in `dt`
+order at tick resolution. Rows are read ahead through the shared
+`cache.BlockCache`, a seek reads from the time index (see `timeindex.py`)
+and never scans the files.
+
+Labelled bruxism episodes are read from `out/labels.json`, the `labels`
+of the notebook dumped as JSON,
+
+    {"<subject>": {"timeranges": [[ms, ms], ...], ...}, ...}
+
+ms relative to the first sample of a session `<subject>@<ts>`. Seeking to
+an episode starts `PREROLL_S` before it, the blocks around every episode
+are read into the cache when the replay opens.
+"""
+import asyncio
+import json
+import logging
+import os
+from time import monotonic
+from typing import Dict, List
+
+import numpy as np
+
+from cache import BlockCache
+from pyramid import recording_paths
+from timeindex import NS, time_bounds
+
+LABELS_FILE = "./out/labels.json"
+MIN_SPEED = 0.5
+MAX_SPEED = 20.0
+# played seconds read ahead per 1x of speed, in reads of `AHEAD_S`
+AHEAD_S = 2.0
+# samples shown before a seek position and an episode
+LEAD_S = 1.0
+PREROLL_S = 2.0
+
+
+def subject(session_name: str) -> str:
+    return session_name.split("@")[0]
+
+
+def load_episodes(session_name: str, start: int, labels_path: str = LABELS_FILE) -> List[List[int]]:
+    """Labelled episodes of a session as `[t0, t1]` in ns of `dt`, ordered by start"""
+    if not os.path.exists(labels_path):
+        return []
+    with open(labels_path) as f:
+        labels = json.load(f).get(subject(session_name), {})
+    return sorted([start + int(t0) * 1_000_000, start + int(t1) * 1_000_000] for t0, t1 in labels.get("timeranges", []))
+
+
+class Replay:
+    def __init__(self, session_name: str, cache: BlockCache, speed: float = 1.0):
+        self.name = session_name
+        self.cache = cache
+        self.paths: Dict[str, str] = recording_paths(f"./out/{session_name}")
+        self.speed = min(MAX_SPEED, max(MIN_SPEED, float(speed)))
+        self.start = self.end = self.position = 0
+        self.episodes: List[List[int]] = []
+        self.playing = False
+        self.ready = False
+        # bumped by every change a client is told about, see `state`
+        self.revision = 0
+        self._clock = monotonic()
+        # rows read ahead of the position, by sensor, and the time they reach
+        self._buffers: Dict[str, np.ndarray] = {}
+        self._loaded_to = 0
+        self._loading = None
+        self._prefetch = None
+
+    async def open(self, t: int = None):
+        """Finds the span and the start of the session, then plays from `t`
+        (by default the start)
+        """
+        bounds = {}
+        for name, path in self.paths.items():
+            bounds[name] = time_bounds(path)
+            if bounds[name] is None:
+                raise ValueError(f"{path} has no time index, see timeindex.py")
+        if not bounds:
+            raise ValueError(f"no recordings in {self.name}")
+        # the first second of every recording has the first sample
+        firsts = await asyncio.gather(*[self.cache.read(path, bounds[name][0], bounds[name][0] + NS)
+                                        for name, path in self.paths.items()])
+        self.start = min(int(rows["dt"][0]) if len(rows) else b[0] for rows, b in zip(firsts, bounds.values()))
+        self.end = max(b[1] for b in bounds.values())
+        self.episodes = load_episodes(self.name, self.start)
+        self.ready = True
+        self.playing = True
+        self.seek(self.start if t is None else t)
+        self._prefetch = asyncio.ensure_future(self._read_episodes())
+
+    def seek(self, t: int):
+        self.position = min(self.end, max(self.start, int(t)))
+        self._buffers = {}
+        self._loaded_to = self._read_from(self.position)
+        if self._loading is not None:
+            self._loading.cancel()
+            self._loading = None
+        self._clock = monotonic()
+        self.revision += 1
+        self._read_ahead()
+
+    def _read_from(self, position: int) -> int:
+        """First `dt` read for a seek to `position`"""
+        return max(self.start, position - int(LEAD_S * NS))
+
+    def seek_episode(self, i: int):
+        t0, _ = self.episodes[i]
+        self.seek(t0 - int(PREROLL_S * NS))
+
+    def pause(self):
+        self._move()
+        self.playing = False
+        self.revision += 1
+
+    def resume(self):
+        self._clock = monotonic()
+        self.playing = self.position < self.end
+        self.revision += 1
+
+    def set_speed(self, speed: float):
+        self._move()
+        self.speed = min(MAX_SPEED, max(MIN_SPEED, float(speed)))
+        self.revision += 1
+
+    def _move(self) -> bool:
+        """Moves the position on by the time played since the last move,
+        False while the rows of a seek are read
+        """
+        now = monotonic()
+        elapsed, self._clock = now - self._clock, now
+        if not self.ready or self._loaded_to < self.position:
+            return False
+        if self.playing:
+            self.position = min(self.end, self._loaded_to, self.position + int(elapsed * self.speed * NS))
+            if self.position >= self.end:
+                self.playing = False
+                self.revision += 1
+        return True
+
+    def advance(self) -> Dict[str, np.ndarray]:
+        """Rows of every sensor played since the last call"""
+        if not self._move():
+            return {}
+        played = {}
+        for name, rows in self._buffers.items():
+            i = int(np.searchsorted(rows["dt"], self.position, side='left'))
+            if i:
+                played[name], self._buffers[name] = rows[:i], rows[i:]
+        self._read_ahead()
+        return played
+
+    def _read_ahead(self):
+        ahead = int(AHEAD_S * max(1.0, self.speed) * NS)
+        if self._loading is None and self._loaded_to < self.end and self._loaded_to - self.position < ahead:
+            self._loading = asyncio.ensure_future(self._read(self._loaded_to, self._loaded_to + int(AHEAD_S * NS)))
+
+    async def _read(self, t0: int, t1: int):
+        try:
+            parts = await asyncio.gather(*[self.cache.read(path, t0, t1) for path in self.paths.values()])
+        except Exception as e:
+            logging.error(f"Reading {self.name} for the replay failed: {e!r}")
+            self.playing = False
+            self.revision += 1
+            return
+        finally:
+            # a seek replaces the read it cancels
+            if self._loading is asyncio.current_task():
+                self._loading = None
+        for name, rows in zip(self.paths, parts):
+            pending = self._buffers.get(name)
+            self._buffers[name] = rows if pending is None or not len(pending) else np.concatenate((pending, rows))
+        self._loaded_to = t1
+        self._read_ahead()
+
+    async def _read_episodes(self):
+        try:
+            for t0, _ in self.episodes:
+                # what `seek_episode` reads first
+                start = self._read_from(t0 - int(PREROLL_S * NS))
+                await asyncio.gather(*[self.cache.read(path, start, t0)
+                                       for path in self.paths.values()])
+        except (OSError, ValueError) as e:
+            logging.error(f"Reading the episodes of {self.name} failed: {e!r}")
+
+    def state(self) -> dict:
+        return {"dir": self.name, "start": self.start, "end": self.end, "position": self.position,
+                "speed": self.speed, "playing": self.playing, "episodes": self.episodes}
+
+    def close(self):
+        for task in (self._loading, self._prefetch):
+            if task is not None:
+                task.cancel()
@@ -0,0 +1,138 @@
+"""Shared-memory ring buffer of live samples
+
+One memory-mapped file per sensor (in /dev/shm, so it never touches the
+SD card) holding the last `capacity` records with the fixed schema of the
+binary recording format:
+
+    b"BRXRING\\0" | u64 capacity | u64 write_seq | u64 data offset | recording header | records...
+
+`write_seq` counts every record ever written and is updated after the
+records are in place. Any number of reader processes can map the file and
+ask for the last N samples or the samples since a sequence number.
+"""
+import glob
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from typing import List, Tuple
+
+import numpy as np
+
+from recording import Schema, read_header
+
+MAGIC = b"BRXRING\0"
+_FIXED = struct.Struct("<8sQQQ")
+_SEQ_OFFSET = 16
+RING_ROOT = os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(), "bruxbench")
+DEFAULT_CAPACITY = 1 << 16
+
+
+def ring_dir(session: str) -> str:
+    """Directory of the rings of a session, `session` is the `out/` directory name"""
+    return os.path.join(RING_ROOT, os.path.basename(session.rstrip("/")))
+
+
+def session_rings(session: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(ring_dir(session), "*.ring")))
+
+
+def remove_session_rings(session: str):
+    shutil.rmtree(ring_dir(session), ignore_errors=True)
+
+
+class RingWriter:
+    """Acquisition side, written by the `Producer` of a sensor, see `Producer.publish`"""
+
+    def __init__(self, path: str, schema: Schema, capacity: int = DEFAULT_CAPACITY):
+        self.path = path
+        self.schema = schema
+        self.capacity = capacity
+
+        header = schema.header()
+        data_offset = _FIXED.size + len(header)
+        data_offset += -data_offset % 8
+        size = data_offset + capacity * schema.record_size
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.truncate(size)
+            f.write(_FIXED.pack(MAGIC, capacity, 0, data_offset))
+            f.write(header)
+
+        self._f = open(path, 'r+b')
+        self._mm = mmap.mmap(self._f.fileno(), size)
+        self._records = np.frombuffer(self._mm, dtype=np.uint8, count=capacity * schema.record_size,
+                                      offset=data_offset).reshape(capacity, schema.record_size)
+        self.write_seq = 0
+
+    def write(self, rows: list):
+        """Append sample dicts (or value tuples), oldest records are overwritten"""
+        if not rows:
+            return
+        rows = rows[-self.capacity:]
+        data = self.schema.pack_array(rows).view(np.uint8).reshape(len(rows), self.schema.record_size)
+
+        start = self.write_seq % self.capacity
+        first = min(len(rows), self.capacity - start)
+        self._records[start:start + first] = data[:first]
+        if first < len(rows):
+            self._records[:len(rows) - first] = data[first:]
+
+        self.write_seq += len(rows)
+        struct.pack_into("<Q", self._mm, _SEQ_OFFSET, self.write_seq)
+
+    def close(self):
+        self._records = None
+        self._mm.close()
+        self._f.close()
+
+
+class RingReader:
+    """Reader side, attaches to a ring of another process"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._f = open(path, 'rb')
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.capacity, _, data_offset = _FIXED.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a ring buffer")
+
+        self.schema, _ = read_header(path, offset=_FIXED.size)
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self._records = np.frombuffer(self._mm, dtype=self.schema.dtype, count=self.capacity, offset=data_offset)
+
+    @property
+    def write_seq(self) -> int:
+        return struct.unpack_from("<Q", self._mm, _SEQ_OFFSET)[0]
+
+    def since(self, seq: int) -> Tuple[np.ndarray, int]:
+        """Records with sequence number >= `seq` still in the ring and the
+        sequence number to ask for next time
+        """
+        head = self.write_seq
+        start = max(seq, head - self.capacity, 0)
+        if start >= head:
+            return self._records[:0].copy(), head
+
+        first, last = start % self.capacity, head % self.capacity
+        if first < last:
+            data = self._records[first:last].copy()
+        else:
+            data = np.concatenate((self._records[first:], self._records[:last]))
+
+        # the writer may have lapped us while copying, drop what got overwritten
+        overwritten = self.write_seq - self.capacity - start
+        if overwritten > 0:
+            data = data[overwritten:]
+        return data, head
+
+    def last(self, n: int) -> np.ndarray:
+        return self.since(self.write_seq - n)[0]
+
+    def close(self):
+        self._records = None
+        self._mm.close()
+        self._f.close()
@@ -0,0 +1,124 @@
+import asyncio
+import heapq
+from logging import getLogger
+from math import sqrt
+from typing import Dict, List
+
+logger = getLogger("scheduler")
+
+
+class PollStats:
+    """Achieved rate and timing jitter of a polled sensor"""
+
+    def __init__(self, period_s: float):
+        self.period_s = period_s
+        self.ticks = 0
+        self.skipped = 0
+        self.started_at = None
+        self.last_fired_at = None
+        # running mean/variance (Welford) of the lateness behind the deadline
+        self._lateness_mean = 0.0
+        self._lateness_m2 = 0.0
+        self.lateness_max_s = 0.0
+
+    def add_tick(self, deadline: float, fired_at: float):
+        if self.started_at is None:
+            self.started_at = fired_at
+        self.last_fired_at = fired_at
+        self.ticks += 1
+
+        lateness = fired_at - deadline
+        delta = lateness - self._lateness_mean
+        self._lateness_mean += delta / self.ticks
+        self._lateness_m2 += delta * (lateness - self._lateness_mean)
+        self.lateness_max_s = max(self.lateness_max_s, lateness)
+
+    def as_dict(self) -> dict:
+        elapsed = (self.last_fired_at - self.started_at) if self.ticks > 1 else 0
+        return {
+            "target_hz": round(1 / self.period_s, 2),
+            "achieved_hz": round((self.ticks - 1) / elapsed, 2) if elapsed > 0 else 0,
+            "ticks": self.ticks,
+            "skipped": self.skipped,
+            "jitter_ms": round(1000 * sqrt(self._lateness_m2 / self.ticks), 3) if self.ticks else 0,
+            "mean_lateness_ms": round(1000 * self._lateness_mean, 3),
+            "max_lateness_ms": round(1000 * self.lateness_max_s, 3),
+        }
+
+
+class PollScheduler:
+    """Fires `get_data` of polled sensors on absolute deadlines.
+
+    All sensors share one timer: deadlines advance by exactly one period on
+    the monotonic loop clock, so read times and loop jitter don't accumulate
+    into drift. A tick is skipped (and counted) when the previous read of
+    the sensor is still running or the loop fell more than one period
+    behind; with `catch_up` the missed ticks are read right away instead.
+    """
+
+    def __init__(self, sensors: List = None, catch_up: bool = False, max_catch_up: int = 10):
+        self.catch_up = catch_up
+        self.max_catch_up = max_catch_up
+        self.sensors = []
+        self.stats: Dict[str, PollStats] = {}
+        for s in sensors or []:
+            self.add(s)
+
+    def add(self, sensor):
+        self.sensors.append(sensor)
+        self.stats[sensor.name] = PollStats(sensor.sample_rate_s)
+
+    async def run(self):
+        """Runs until the producers of all sensors finished"""
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        heap = [(start + s.sample_rate_s, i) for i, s in enumerate(self.sensors)]
+        heapq.heapify(heap)
+        in_flight = {}
+
+        while heap:
+            deadline, i = heap[0]
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            deadline, i = heapq.heappop(heap)
+            sensor = self.sensors[i]
+            if sensor.producer.finished_execution.is_set():
+                continue
+
+            stats = self.stats[sensor.name]
+            period = sensor.sample_rate_s
+            fired_at = loop.time()
+            missed = int((fired_at - deadline) // period)
+
+            caught_up = 0
+            task = in_flight.get(i)
+            if task is not None and not task.done():
+                stats.skipped += 1
+            else:
+                caught_up = min(missed, self.max_catch_up) if self.catch_up else 0
+                in_flight[i] = asyncio.ensure_future(self._sample(sensor, 1 + caught_up))
+                stats.add_tick(deadline, fired_at)
+
+            if missed > 0:
+                stats.skipped += missed - caught_up
+                deadline += missed * period
+            heapq.heappush(heap, (deadline + period, i))
+
+        pending = [t for t in in_flight.values() if not t.done()]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _sample(self, sensor, reads: int):
+        for _ in range(reads):
+            try:
+                data = await sensor.get_data()
+            except Exception as e:
+                logger.info(f"ERROR: {sensor.name} - {e}")
+                return
+            await sensor.queue(data)
+
+    def log_stats(self):
+        for name, stats in self.stats.items():
+            logger.info(f"{name} polling: {stats.as_dict()}")
@@ -0,0 +1,298 @@
+"""Time-based segment rotation and background compression of recordings
+
+With a `segment_s` a consumer writes `<sensor>.0000.csv`, `<sensor>.0001.csv`,
+... instead of one `<sensor>.csv`, starting a new segment every `segment_s`
+seconds. Closed segments are compressed (`gzip` or `zstd`) on a single
+low-priority background thread and the original is removed. The segments
+of a sensor are listed in order in `<sensor>.manifest.json`:
+
+    {"columns": [...], "format": "csv", "segment_s": 300, "compression": "gzip",
+     "segments": [{"file": "emg.0000.csv.gz", "rows": 76800, "first_dt": ..., "last_dt": ..., "closed": true}, ...]}
+
+`read_segments` opens the whole session of a sensor as one array again.
+"""
+import gzip
+import io
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from time import monotonic, perf_counter
+from typing import Dict, List
+
+import numpy as np
+
+from recording import FORMAT_BIN, Schema, read_csv_from, read_header_from, row_dt
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = getLogger("segments")
+
+COMPRESSION_GZIP = "gzip"
+COMPRESSION_ZSTD = "zstd"
+EXTENSIONS = {COMPRESSION_GZIP: ".gz", COMPRESSION_ZSTD: ".zst"}
+MANIFEST_SUFFIX = ".manifest.json"
+_CHUNK = 1 << 20
+
+
+def _lower_priority():
+    # Linux applies the nice value to the calling thread only
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+    except (AttributeError, OSError):
+        pass
+
+
+class Compressor:
+    """One background thread compressing closed segments"""
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compress",
+                                            initializer=_lower_priority)
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.busy_s = 0.0
+
+    def submit(self, path: str, compression: str, done=None):
+        """Compress `path` to `path` + extension, remove it and call `done(new_path)`"""
+        with self._lock:
+            self.pending += 1
+        return self._executor.submit(self._compress, path, compression, done)
+
+    def _compress(self, path: str, compression: str, done):
+        start = perf_counter()
+        target = path + EXTENSIONS[compression]
+        try:
+            with open(path, 'rb') as src, open(target + ".tmp", 'wb') as raw:
+                if compression == COMPRESSION_ZSTD:
+                    dst = zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False)
+                else:
+                    dst = gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=5)
+                with dst:
+                    while True:
+                        chunk = src.read(_CHUNK)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(target + ".tmp", target)
+            size_in, size_out = os.path.getsize(path), os.path.getsize(target)
+            os.remove(path)
+            if done:
+                done(target)
+            with self._lock:
+                self.compressed += 1
+                self.bytes_in += size_in
+                self.bytes_out += size_out
+        except Exception as e:
+            # the uncompressed segment stays as it is
+            logger.info(f"Compressing {path} failed: {e!r}")
+        finally:
+            with self._lock:
+                self.pending -= 1
+                self.busy_s += perf_counter() - start
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": self.pending,
+                "compressed": self.compressed,
+                "busy_s": round(self.busy_s, 3),
+                "ratio": round(self.bytes_in / self.bytes_out, 2) if self.bytes_out else 0,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+_COMPRESSOR = None
+
+
+def compressor() -> Compressor:
+    """The compressor shared by all consumers of the process"""
+    global _COMPRESSOR
+    if _COMPRESSOR is None:
+        _COMPRESSOR = Compressor()
+    return _COMPRESSOR
+
+
+def compressor_stats() -> Dict:
+    return _COMPRESSOR.stats() if _COMPRESSOR is not None else None
+
+
+def shutdown_compressor():
+    """Waits for the pending segments"""
+    global _COMPRESSOR
+    if _COMPRESSOR is not None:
+        _COMPRESSOR.shutdown()
+        _COMPRESSOR = None
+
+
+class SegmentedWriter:
+    """Record writer (see `recording.WRITERS`) rotating into segments.
+    Same interface as the writer it wraps, rotation happens on batch
+    boundaries in `write_rows`.
+    """
+
+    def __init__(self, writer_cls, path: str, columns: List[str], column_types: Dict[str, str],
+                 segment_s: float, compression: str = None):
+        if compression is not None and compression not in EXTENSIONS:
+            raise ValueError(f"Unknown compression {compression}")
+        if compression == COMPRESSION_ZSTD and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+
+        self.writer_cls = writer_cls
+        self.stem, self.extension = os.path.splitext(path)
+        self.columns = columns
+        self.column_types = column_types
+        self.segment_s = segment_s
+        self.compression = compression
+        self.manifest_path = self.stem + MANIFEST_SUFFIX
+        self.manifest = {
+            "columns": columns,
+            "format": self.extension.lstrip("."),
+            "segment_s": segment_s,
+            "compression": compression,
+            "segments": [],
+        }
+        self._lock = threading.Lock()
+        self.writer = None
+        self.segment = None
+        self._started_at = None
+
+    def _segment_path(self, index: int) -> str:
+        return f"{self.stem}.{index:04d}{self.extension}"
+
+    def _new_segment(self):
+        path = self._segment_path(len(self.manifest["segments"]))
+        self.writer = self.writer_cls(path, self.columns, self.column_types)
+        self.writer.create()
+        self.segment = {"file": os.path.basename(path), "rows": 0, "first_dt": None, "last_dt": None,
+                        "closed": False}
+        with self._lock:
+            self.manifest["segments"].append(self.segment)
+        self._write_manifest()
+        self._started_at = monotonic()
+
+    def create(self):
+        self._new_segment()
+
+    def open(self):
+        self.writer.open()
+
+    def write_rows(self, batch: list):
+        if not batch:
+            return
+        if monotonic() - self._started_at >= self.segment_s and self.segment["rows"]:
+            self.rotate()
+
+        self.writer.write_rows(batch)
+        if self.segment["first_dt"] is None:
+            self.segment["first_dt"] = row_dt(batch[0])
+        self.segment["last_dt"] = row_dt(batch[-1])
+        self.segment["rows"] += len(batch)
+
+    def rotate(self):
+        self._close_segment()
+        self._new_segment()
+        self.writer.open()
+
+    def _close_segment(self):
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        self.writer.close()
+        segment = self.segment
+        with self._lock:
+            segment["closed"] = True
+        self._write_manifest()
+
+        if self.compression:
+            def done(path, segment=segment):
+                with self._lock:
+                    segment["file"] = os.path.basename(path)
+                self._write_manifest()
+            compressor().submit(self.writer.path, self.compression, done)
+
+    def flush(self):
+        self.writer.flush()
+
+    def fileno(self) -> int:
+        return self.writer.fileno()
+
+    def close(self):
+        self._close_segment()
+
+    def _write_manifest(self):
+        # also called from the compressor thread
+        with self._lock:
+            tmp = self.manifest_path + ".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(self.manifest, f, indent=2)
+            os.replace(tmp, self.manifest_path)
+
+
+def open_segment(path: str):
+    """Binary file object of a segment, decompressing if needed"""
+    if path.endswith(EXTENSIONS[COMPRESSION_GZIP]):
+        return gzip.open(path, 'rb')
+    if path.endswith(EXTENSIONS[COMPRESSION_ZSTD]):
+        if zstandard is None:
+            raise ValueError(f"{path} needs the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return open(path, 'rb')
+
+
+def read_segment(path: str, file_format: str, column_types: Dict[str, str] = None) -> np.ndarray:
+    """One (possibly compressed) segment as a structured array"""
+    with open_segment(path) as f:
+        if file_format == FORMAT_BIN:
+            schema, _ = read_header_from(f, path)
+            data = f.read()
+            count = len(data) // schema.record_size
+            return np.frombuffer(data, dtype=schema.dtype, count=count)
+        return read_csv_from(io.TextIOWrapper(f, encoding='utf8'), column_types)
+
+
+def read_manifest(manifest_path: str) -> dict:
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def segment_path(directory: str, manifest: dict, segment: dict) -> str:
+    """Path of a segment listed in `manifest`, as it is on disk now"""
+    path = os.path.join(directory, segment["file"])
+    if not os.path.exists(path) and manifest["compression"]:
+        # compressed since the manifest was read
+        path += EXTENSIONS[manifest["compression"]]
+    return path
+
+
+def manifest_dtype(directory: str, manifest: dict, column_types: Dict[str, str] = None) -> np.dtype:
+    """Row type of a segmented recording, from the header of its first
+    segment for binary ones
+    """
+    if manifest["format"] == FORMAT_BIN and manifest["segments"]:
+        path = segment_path(directory, manifest, manifest["segments"][0])
+        with open_segment(path) as f:
+            return read_header_from(f, path)[0].dtype
+    return Schema(manifest["columns"], column_types).dtype
+
+
+def read_segments(manifest_path: str, column_types: Dict[str, str] = None) -> np.ndarray:
+    """All segments of a sensor, in order, as one structured array"""
+    manifest = read_manifest(manifest_path)
+    directory = os.path.dirname(manifest_path)
+    parts = []
+    for segment in manifest["segments"]:
+        parts.append(read_segment(segment_path(directory, manifest, segment), manifest["format"], column_types))
+    if not parts:
+        return np.empty(0, dtype=manifest_dtype(directory, manifest, column_types))
+    return np.concatenate(parts)
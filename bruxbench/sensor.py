@@ -1,13 +1,27 @@
+import csv
 import serial
+import numpy as np
 from time import time_ns
 from logging import getLogger
-from typing import List
-from asyncio import sleep
+from typing import Dict, List
+from asyncio import sleep, gather, wait_for, get_running_loop, Event, TimeoutError
 from bleak import BleakClient, BleakScanner
 from bleak.backends.device import BLEDevice
-from reactor import Producer, Consumer
-from grovepi import analogRead, pinMode
+from reactor import Producer, Consumer, OVERFLOW_SPILL
+from recording import FORMAT_CSV, FORMAT_BIN, ESENSE_PACKET_SIZE, read_recording, read_csv_recording
+from segments import MANIFEST_SUFFIX, read_manifest, read_segments
+try:
+    from grovepi import analogRead, pinMode
+except ImportError:
+    # Raspberry Pi only, everything but `GSR_Grovepi` works without it
+    analogRead = pinMode = None
 from serial_asyncio import open_serial_connection
+from scheduler import PollScheduler
+from drivers import run_on_bus
+from framing import FrameParser, EMG_PAYLOAD, BNO_PAYLOAD, SEQ_MODULO
+
+PROTOCOL_TEXT = "text"
+PROTOCOL_BINARY = "binary"
 
 logger = getLogger("sensor")
 
@@ -18,16 +32,92 @@ def now():
     return time_ns()
 
 
+async def scan_ble(names: List[str], timeout_s: float = 10.0) -> Dict[str, BLEDevice]:
+    """One BLE scan for all `names`, stops as soon as every device was seen"""
+    found = {}
+    wanted = set(names)
+    all_found = Event()
+
+    def on_detection(device, _advertisement):
+        if device.name in wanted and device.name not in found:
+            found[device.name] = device
+            if len(found) == len(wanted):
+                all_found.set()
+
+    scanner = BleakScanner(detection_callback=on_detection)
+    await scanner.start()
+    try:
+        await wait_for(all_found.wait(), timeout_s)
+    except TimeoutError:
+        logger.info(f"BLE scan timed out, missing {sorted(wanted - set(found))}")
+    finally:
+        await scanner.stop()
+    return found
+
+
+async def resolve_ble_devices(sensors: List["Sensor"]):
+    """Find the devices of all BLE sensors of `sensors` with a single scan"""
+    ble_sensors = [s for s in sensors if isinstance(s, BLE_eSense) and s.device is None]
+    if not ble_sensors:
+        return
+
+    start = get_running_loop().time()
+    devices = await scan_ble([s.ble_device_name for s in ble_sensors])
+    for s in ble_sensors:
+        # False: not found, `_init` doesn't scan again
+        s.device = devices.get(s.ble_device_name, False)
+    logger.info(f"BLE scan found {len(devices)}/{len(ble_sensors)} devices in "
+                f"{get_running_loop().time() - start:.2f}s")
+
+
+async def init_sensors(sensors: List["Sensor"], timeout_s: float = 30.0) -> Dict[str, float]:
+    """Initialize `sensors` concurrently, every one within `timeout_s`.
+    The BLE devices are resolved by one shared scan first. A sensor that
+    fails or times out is logged and its producer stopped, the others
+    continue. Returns the startup time of every sensor in seconds.
+    """
+    loop = get_running_loop()
+    start = loop.time()
+    await resolve_ble_devices(sensors)
+
+    startup = {}
+
+    async def init(sensor):
+        try:
+            await wait_for(sensor._init(), timeout_s)
+        except Exception as e:
+            logger.info(f"{sensor.name} failed to initialize, skipping it: {e!r}")
+            sensor.producer.stop_producer()
+        startup[sensor.name] = round(loop.time() - start, 3)
+
+    await gather(*[init(s) for s in sensors])
+    logger.info(f"Sensors initialized in {loop.time() - start:.2f}s: {startup}")
+    return startup
+
+
 class Sensor:
     """Interface to ease the data collection"""
 
-    def __init__(self, name: str, sample_rate_s: float = 0.01, csv_headers: List[str] = ["dt", "column0"]):
+    # Hardware bus of blocking driver calls, see `run_blocking`
+    bus = None
+    # link and queue counters of the worker process streaming the sensor, see `workers.SensorGroup`
+    worker_stats = None
+
+    def __init__(self, name: str, sample_rate_s: float = 0.01, csv_headers: List[str] = ["dt", "column0"],
+                 output_format: str = FORMAT_CSV, column_types: Dict[str, str] = None,
+                 queue_capacity: int = 100_000, overflow: str = OVERFLOW_SPILL):
+        """`output_format` selects the recording format (`csv` or `bin`),
+        `column_types` maps column names to numpy dtypes for the binary format
+        (`dt` is int64 and everything else float32 by default).
+        `queue_capacity` and `overflow` bound the in-memory queue, see `reactor.SampleQueue`
+        """
         self.name = name
         self.sample_rate_s = sample_rate_s
-        self.producer = Producer()
+        self.producer = Producer(capacity=queue_capacity, overflow=overflow)
         self.csv_headers = csv_headers
-        self.consumer = Consumer(filename=f"{self.name}.csv", queue=self.producer.queue,
-                                 finished_execution=self.producer.finished_execution, csv_headers=csv_headers)
+        self.consumer = Consumer(filename=f"{self.name}.{output_format}", queue=self.producer.queue,
+                                 finished_execution=self.producer.finished_execution, csv_headers=csv_headers,
+                                 output_format=output_format, column_types=column_types)
 
     async def _init(self):
         """Keep the bleak BLE initialisation style
@@ -36,6 +126,17 @@ class Sensor:
         """
         pass
 
+    async def run_blocking(self, fn, *args):
+        """Run a blocking driver call (e.g. an I2C transaction) on the worker
+        thread of `self.bus`, so it never blocks the event loop
+        """
+        return await run_on_bus(self.bus or self.name, fn, *args)
+
+    def link_stats(self) -> Dict[str, int]:
+        """Malformed/lost packet counters of the sensor link, see `telemetry.py`
+        """
+        return {}
+
     async def get_data(self):
         """Override this method with proper pyshical sensor read
         """
@@ -44,15 +145,34 @@ class Sensor:
             "column0": 42.0
         }
 
+    @property
+    def expected_rate_hz(self) -> float:
+        """Nominal sample rate, None if the sensor has none"""
+        return 1 / self.sample_rate_s if self.sample_rate_s > 0 else None
+
+    async def reconnect(self):
+        """Bring the sensor back after its stream died, see `supervisor.py`
+        """
+        await self._init()
+
+    @property
+    def polled(self) -> bool:
+        """Sensors read with `get_data` every `sample_rate_s`,
+        these can share one `PollScheduler`
+        """
+        return self.sample_rate_s > 0 and type(self).start_stream is Sensor.start_stream
+
     async def start_stream(self):
         """Start streaming sensor data
         Should call `self.queue(data)`
         """
-        while not self.producer.finished_execution.is_set():
-            # Simulate N-Hz sample rate
-            if self.sample_rate_s > 0:
-                await sleep(self.sample_rate_s)
+        if self.sample_rate_s > 0:
+            scheduler = PollScheduler([self])
+            await scheduler.run()
+            scheduler.log_stats()
+            return
 
+        while not self.producer.finished_execution.is_set():
             data = await self.get_data()
 
             await self.queue(data)
@@ -69,73 +189,109 @@ class BLE_eSense(Sensor):
     IMU_DATA_UUID = "0000ff08-0000-1000-8000-00805f9b34fb"
     IMU_SCALE_RANGE_UUID = "0000ff0e-0000-1000-8000-00805f9b34fb"
 
-    def __init__(self, name: str, ble_device_name: str, sample_rate: int = 100):
+    def __init__(self, name: str, ble_device_name: str, sample_rate: int = 100, output_format: str = FORMAT_CSV,
+                 capture_raw: bool = False, connect_retries: int = 5):
+        """With `capture_raw` only the arrival time and the raw notification
+        bytes are recorded (binary format), decode them offline with
+        `recording.decode_esense_raw`
+        """
         self.ble_device_name = ble_device_name
         self.sample_rate = sample_rate
+        self.capture_raw = capture_raw
+        self.connect_retries = connect_retries
         self.client = None
+        self.device = None
+        self.malformed = 0
+        self.lost_packets = 0
+        self._packet_index = None
+        if capture_raw:
+            super().__init__(name=name, csv_headers=[
+                "dt",
+                "raw_data",
+            ], column_types={"raw_data": f"|S{ESENSE_PACKET_SIZE}"}, output_format=FORMAT_BIN)
+            return
+
         super().__init__(name=name, csv_headers=[
             "dt",
-            # "raw_data",
             'acceleration_x',
             'acceleration_y',
             'acceleration_z',
             'gyro_x',
             'gyro_y',
             'gyro_z',
-        ])
+        ], output_format=output_format)
 
     async def _init(self) -> None:
         """Setup the eSense device. If connection was succesfull,
-        it will listen for IMU notifications
+        it will listen for IMU notifications.
+        `self.device` may already be resolved by a shared scan, see `scan_ble`.
+        Connecting is retried `connect_retries` times with exponential backoff.
         """
-        self.device = await self._find_device()
-        if self.device:
-            should_retry = True
-
-            while should_retry:
-                try:
-                    # Connect
-                    self.client = BleakClient(self.device)
-                    await self.client.connect()
-                    logger.info(
-                        f"Connected {self.client.address}: {self.client.is_connected}")
-
-                    # Configure
-                    await self.client.write_gatt_char(self.IMU_ENABLE_UUID, bytearray([0x57, 0x2d, 0x08, 0x00, 0xc8, 0x01, 0x2c, 0x00, 0x10, 0x00, 0x20]))
-                    logger.info(f"Configured for 100Hz {self.client.address}")
-
-                    # logger.info(f"Disconnecting {self.client.address}")
-                    # await self.client.disconnect()
-
-                    logger.info(f"Sleeping.. {self.client.address}")
-                    await sleep(3)
-
-                    # await self.client.connect()
-                    # logger.info(
-                    #     f"Reconnected {self.client.address}: {self.client.is_connected}")
-                    # await sleep(3)
-
-                    # Config check
-                    await self._check_scale_range()
-
-                    # Prepare streaming
-                    await self.client.write_gatt_char(
-                        self.IMU_ENABLE_UUID,
-                        self._enable_imu_payload()
-                    )
-
-                    logger.info(
-                        f"Enabled stream of {self.sample_rate}Hz {self.client.address}")
-                    should_retry = False
-                except Exception as e:
-                    logger.info(
-                        f"\nRETRY {self.client.address} {e} \n")
-                    should_retry = True
-            
-        else:
+        if self.device is None:
+            self.device = await self._find_device()
+        if not self.device:
             logger.info(f"{self.ble_device_name} not found!")
             # Kill the producer if device not available!
             self.producer.stop_producer()
+            return
+
+        backoff_s = 0.5
+        for attempt in range(1, self.connect_retries + 1):
+            try:
+                await self._connect()
+                return
+            except Exception as e:
+                logger.info(f"RETRY {attempt}/{self.connect_retries} {self.ble_device_name} in {backoff_s}s: {e}")
+                await self._disconnect()
+                if attempt == self.connect_retries:
+                    raise
+                await sleep(backoff_s)
+                backoff_s = min(2 * backoff_s, 8)
+
+    async def _connect(self) -> None:
+        # Connect
+        self.client = BleakClient(self.device)
+        await self.client.connect()
+        logger.info(
+            f"Connected {self.client.address}: {self.client.is_connected}")
+
+        # Configure
+        await self.client.write_gatt_char(self.IMU_ENABLE_UUID, bytearray([0x57, 0x2d, 0x08, 0x00, 0xc8, 0x01, 0x2c, 0x00, 0x10, 0x00, 0x20]))
+        logger.info(f"Configured for 100Hz {self.client.address}")
+
+        # Config check, as soon as the earable applied it
+        await self._wait_ready()
+
+        # Prepare streaming
+        await self.client.write_gatt_char(
+            self.IMU_ENABLE_UUID,
+            self._enable_imu_payload()
+        )
+
+        logger.info(
+            f"Enabled stream of {self.sample_rate}Hz {self.client.address}")
+
+    async def _disconnect(self) -> None:
+        if self.client is None:
+            return
+        try:
+            await self.client.disconnect()
+        except Exception as e:
+            logger.info(f"Error on disconnect {self.ble_device_name} {e}")
+
+    async def _wait_ready(self, timeout_s: float = 3.0, poll_s: float = 0.1) -> None:
+        """Poll the scale range until the configuration is readable and
+        correct, instead of sleeping a fixed time
+        """
+        deadline = get_running_loop().time() + timeout_s
+        while True:
+            try:
+                await self._check_scale_range()
+                return
+            except Exception:
+                if get_running_loop().time() >= deadline:
+                    raise
+            await sleep(poll_s)
 
     async def _check_scale_range(self) -> None:
         """The data would make 0 sens if wrong scaling factors will be used
@@ -173,9 +329,35 @@ class BLE_eSense(Sensor):
 
         return a, g
 
+    def link_stats(self) -> Dict[str, int]:
+        return {"malformed": self.malformed, "lost_packets": self.lost_packets}
+
+    @property
+    def expected_rate_hz(self) -> float:
+        return self.sample_rate
+
+    async def reconnect(self):
+        await self._disconnect()
+        self.client = None
+        self._packet_index = None
+        await self._init()
+
+    def _check_packet(self, raw_data) -> bool:
+        """Count short packets and gaps in the packet index (byte 1)"""
+        if len(raw_data) < ESENSE_PACKET_SIZE:
+            self.malformed += 1
+            return False
+        index = raw_data[1]
+        if self._packet_index is not None:
+            self.lost_packets += (index - self._packet_index - 1) % 256
+        self._packet_index = index
+        return True
+
     async def _queue(self, _, raw_data) -> None:
         """Wrapper to comply with the Bleak BLE callback format
         """
+        if not self._check_packet(raw_data):
+            return
         [[ax, ay, az], [gx, gy, gz]] = self._decode(raw_data)
         data = {
             "dt": now(),
@@ -189,13 +371,22 @@ class BLE_eSense(Sensor):
         }
         await self.queue(data)
 
+    def _queue_raw(self, _, raw_data) -> None:
+        """Raw capture callback, keeps the Bleak callback path minimal
+        """
+        self.producer.produce_nowait({"dt": now(), "raw_data": bytes(raw_data)})
+
     async def _start_notifications(self) -> None:
         """Start listen to notifications"""
-        await self.client.start_notify(self.IMU_DATA_UUID, self._queue)
+        await self.client.start_notify(self.IMU_DATA_UUID, self._queue_raw if self.capture_raw else self._queue)
 
         while not self.producer.finished_execution.is_set():
             # Check every 10ms if stream was stopped
             await sleep(0.01)
+            if not self.client.is_connected:
+                # hand over to the supervisor
+                logger.info(f"Connection lost {self.client.address}")
+                return
 
         try:
             await self.client.stop_notify(self.IMU_DATA_UUID)
@@ -214,10 +405,7 @@ class BLE_eSense(Sensor):
             2. Hard reset (put in the case, hold case button for 15-20s)
             3. Power cycle rpi (on very rare ocasions)
         """
-        devices = await BleakScanner.discover()
-        for device in devices:
-            if device.name == self.ble_device_name:
-                return device
+        return (await scan_ble([self.ble_device_name])).get(self.ble_device_name)
 
     def _enable_imu_payload(self) -> bytearray:
         """Refer to eSense BLE specifications.
@@ -240,6 +428,7 @@ class BLE_eSense(Sensor):
 
 # class IMU_BNO055(Sensor):
 #     """Abstract API to read data from BNO055"""
+#     bus = "i2c-1"
 
 #     # I2C singleton interface
 #     i2c = I2C(SCL, SDA)
@@ -274,8 +463,13 @@ class BLE_eSense(Sensor):
 #         ])
 
 #     async def get_data(self):
+#         dt = now()
+#         # every property is an I2C transaction, read them all in one go on the bus thread
+#         data = await self.run_blocking(self._read)
+#         return {'dt': dt, **data}
+
+#     def _read(self):
 #         return {
-#             'dt': now(),
 #             'acceleration_x': self.sensor.acceleration[0],
 #             'acceleration_y': self.sensor.acceleration[1],
 #             'acceleration_z': self.sensor.acceleration[2],
@@ -303,50 +497,164 @@ class BLE_eSense(Sensor):
 
 class GSR_Grovepi(Sensor):
     """Abstract API to read data from the Grove GSR"""
+    bus = "i2c-1"
 
     # Maps port name to physical pin number
     PORT_TO_PIN = {
         "A0": 14
     }
 
-    def __init__(self, name: str, port: str = "A0"):
+    def __init__(self, name: str, port: str = "A0", output_format: str = FORMAT_CSV):
         self.pin = self.PORT_TO_PIN[port]
         super().__init__(name=name, sample_rate_s=0.05, csv_headers=[
             'dt',
             'gsr'
-        ])
+        ], column_types={'gsr': '<i2'}, output_format=output_format)
 
-    def _setup_read(self):
+    async def _init(self):
         """Sets the grovepi+ hat board to input mode"""
-
-        pinMode(self.pin, "INPUT")
-
-    def _gsr(self):
-        """Reads the gsr value"""
-
-        self._setup_read()
-        return analogRead(self.pin)
+        if pinMode is None:
+            raise RuntimeError("grovepi is not installed")
+        await self.run_blocking(pinMode, self.pin, "INPUT")
 
     async def get_data(self):
         return {
             'dt': now(),
-            'gsr': self._gsr(),
+            'gsr': await self.run_blocking(analogRead, self.pin),
         }
 
 
-class EMG_Olimex_x4(Sensor):
-    def __init__(self, name: str):
+class SerialSensor(Sensor):
+    """Arduino streaming over USB serial.
+    `text` protocol: one comma separated line per sample.
+    `binary` protocol: sync word framed packets, see `framing.py`.
+    """
+    PAYLOAD_FORMAT = None
+
+    def __init__(self, name: str, url: str, baudrate: int, csv_headers: List[str], protocol: str = PROTOCOL_TEXT,
+                 output_format: str = FORMAT_CSV, column_types: Dict[str, str] = None,
+                 bulk_read: bool = True, nominal_rate_hz: float = None, chunk_size: int = 4096):
+        """With `bulk_read` all available bytes are read at once and every
+        complete record in them is queued as one batch (always the case for
+        the binary protocol). Sample timestamps are then reconstructed backwards
+        from the arrival time using `nominal_rate_hz` (and the frame counter
+        for the binary protocol), or spread over the time since the previous
+        chunk if the device has no fixed rate.
+        """
+        if protocol not in (PROTOCOL_TEXT, PROTOCOL_BINARY):
+            raise ValueError(f"Unknown serial protocol {protocol}")
+        self.url = url
+        self.baudrate = baudrate
+        self.protocol = protocol
+        self.bulk_read = bulk_read or protocol == PROTOCOL_BINARY
+        self.nominal_rate_hz = nominal_rate_hz
+        self.chunk_size = chunk_size
         self.reader = None
-        super().__init__(name=name, sample_rate_s=0, csv_headers=[
-            'dt',
-            'masseter_left',
-            'masseter_right',
-            'temporalis_left',
-            'temporalis_right',
-        ])
+        self.writer = None
+        self.parser = FrameParser(self.PAYLOAD_FORMAT) if protocol == PROTOCOL_BINARY else None
+        self.malformed = 0
+        self._line_buffer = b""
+        self._last_arrival = None
+        self._last_dt = 0
+        super().__init__(name=name, sample_rate_s=0, csv_headers=csv_headers,
+                         column_types=column_types, output_format=output_format)
 
     async def _init(self):
-        self.reader, _ = await open_serial_connection(url='/dev/ttyUSB0', baudrate=115200)
+        self.reader, self.writer = await open_serial_connection(url=self.url, baudrate=self.baudrate)
+
+    @property
+    def expected_rate_hz(self) -> float:
+        return self.nominal_rate_hz
+
+    async def reconnect(self):
+        """Reopen the port, e.g. after the USB device was reset"""
+        if self.writer is not None:
+            self.writer.close()
+        if self.parser:
+            self.parser.reset()
+        self._line_buffer = b""
+        self._last_arrival = None
+        await self._init()
+
+    async def start_stream(self):
+        if not self.bulk_read:
+            return await super().start_stream()
+
+        while not self.producer.finished_execution.is_set():
+            data = await self.reader.read(self.chunk_size)
+            if not data:
+                break
+
+            arrival = now()
+            if self.protocol == PROTOCOL_BINARY:
+                rows = self._rows_from_frames(data, arrival)
+            else:
+                rows = self._rows_from_lines(data, arrival)
+
+            if rows:
+                await self.producer.produce_batch(rows)
+
+        if self.parser:
+            logger.info(f"{self.name} frames: {self.parser.stats()}")
+        logger.info(f"{self.name} malformed records: {self.malformed}")
+
+    def link_stats(self) -> Dict[str, int]:
+        stats = {"malformed": self.malformed}
+        if self.parser:
+            parser_stats = self.parser.stats()
+            stats["lost_frames"] = parser_stats["lost_frames"]
+            stats["checksum_errors"] = parser_stats["checksum_errors"]
+        return stats
+
+    def _rows_from_lines(self, data: bytes, arrival: int) -> List[dict]:
+        *lines, self._line_buffer = (self._line_buffer + data).split(b"\n")
+        if not lines:
+            return []
+
+        n_values = len(self.csv_headers) - 1
+        rows = []
+        for dt, line in zip(self._timestamps(arrival, len(lines)), lines):
+            values = line.decode('utf8', 'replace').rstrip().split(',')
+            if len(values) != n_values:
+                self.malformed += 1
+                rows.append({'dt': dt})
+                continue
+            rows.append(dict(zip(self.csv_headers, (dt, *values))))
+        return rows
+
+    def _rows_from_frames(self, data: bytes, arrival: int) -> List[dict]:
+        frames = self.parser.feed(data)
+        if not frames:
+            return []
+
+        # frames lost in between still take their slot in time
+        last_seq = frames[-1][0]
+        offsets = [(last_seq - seq) % SEQ_MODULO for seq, _ in frames]
+        stamps = self._timestamps(arrival, len(frames), offsets)
+        return [dict(zip(self.csv_headers, (dt, *values))) for dt, (_, values) in zip(stamps, frames)]
+
+    def _timestamps(self, arrival: int, count: int, offsets: List[int] = None) -> List[int]:
+        """Per-sample timestamps of `count` samples that arrived together,
+        `offsets` are the distances in samples to the last one
+        """
+        if offsets is None:
+            offsets = range(count - 1, -1, -1)
+
+        if self.nominal_rate_hz:
+            period = 1e9 / self.nominal_rate_hz
+        else:
+            previous = self._last_arrival if self._last_arrival is not None else arrival
+            period = (arrival - previous) / max(offsets[0] + 1, 1)
+        self._last_arrival = arrival
+
+        stamps = []
+        last_dt = self._last_dt
+        for offset in offsets:
+            # arrival jitter must never make time go backwards
+            last_dt = max(arrival - int(offset * period), last_dt + 1)
+            stamps.append(last_dt)
+        self._last_dt = last_dt
+        return stamps
 
     async def get_data(self):
         try:
@@ -359,6 +667,7 @@ class EMG_Olimex_x4(Sensor):
         dt = now()
 
         if len(data) != len(self.csv_headers) - 1:
+            self.malformed += 1
             logger.info(f"{self.name} serial packet length {len(data)} instead of {len(self.csv_headers) - 1}!")
             return {
                 'dt': dt
@@ -370,9 +679,37 @@ class EMG_Olimex_x4(Sensor):
         return payload
 
 
-class BNO055_x2(Sensor):
-    def __init__(self, name: str, baudrate: int = 500000):
-        super().__init__(name=name, sample_rate_s=0, csv_headers=[
+class EMG_Olimex_x4(SerialSensor):
+    PAYLOAD_FORMAT = EMG_PAYLOAD
+    # SAMPFREQ of arduino/emg.ino
+    SAMPFREQ_HZ = 256
+    # 10 bit ADC counts
+    COLUMN_TYPES = {
+        'masseter_left': '<i2',
+        'masseter_right': '<i2',
+        'temporalis_left': '<i2',
+        'temporalis_right': '<i2',
+    }
+
+    def __init__(self, name: str, url: str = '/dev/ttyUSB0', baudrate: int = 115200,
+                 protocol: str = PROTOCOL_TEXT, output_format: str = FORMAT_CSV, bulk_read: bool = True):
+        super().__init__(name=name, url=url, baudrate=baudrate, csv_headers=[
+            'dt',
+            'masseter_left',
+            'masseter_right',
+            'temporalis_left',
+            'temporalis_right',
+        ], column_types=self.COLUMN_TYPES, protocol=protocol, output_format=output_format,
+            bulk_read=bulk_read, nominal_rate_hz=self.SAMPFREQ_HZ)
+
+
+class BNO055_x2(SerialSensor):
+    PAYLOAD_FORMAT = BNO_PAYLOAD
+
+    def __init__(self, name: str, url: str = '/dev/ttyUSB1', baudrate: int = 500000,
+                 protocol: str = PROTOCOL_TEXT, output_format: str = FORMAT_CSV, bulk_read: bool = True):
+        # free running loop on the Arduino, no nominal rate
+        super().__init__(name=name, url=url, baudrate=baudrate, csv_headers=[
             'dt',
             'x28_gyro_x',
             'x28_gyro_y',
@@ -394,28 +731,124 @@ class BNO055_x2(Sensor):
             'x29_quaternion_x',
             'x29_quaternion_y',
             'x29_quaternion_z',
-        ])
+        ], protocol=protocol, output_format=output_format, bulk_read=bulk_read)
 
-    async def _init(self):
-        self.reader, _ = await open_serial_connection(url='/dev/ttyUSB1', baudrate=500000)
 
-    async def get_data(self):
-        try:
-            data = await self.reader.readline()
-            data = data.decode('utf8').rstrip().split(',')
-        except Exception as e:
-            logger.info(f"ERROR: {self.name} - {e}")
-            data = []
+class ReplaySensor(Sensor):
+    """Streams an existing recording (`out/<session>/<sensor>.csv`, `.bin` or
+    the `.manifest.json` of a segmented one) through the pipeline, for load
+    tests without hardware.
 
-        dt = now()
+    Samples are released at their original relative times divided by
+    `speed` and restamped to the replay clock, so the inter-sample timing
+    of the recording is kept. `speed=0` replays as fast as possible (the
+    original spacing of `dt` is kept in the output). With `loop` the
+    recording starts over at its end.
+    """
 
-        if len(data) != len(self.csv_headers) - 1:
-            logger.info(f"{self.name} serial packet length {len(data)} instead of {len(self.csv_headers) - 1}!")
-            return {
-                'dt': dt
-            }
+    def __init__(self, name: str, path: str, speed: float = 1.0, loop: bool = False,
+                 output_format: str = FORMAT_CSV, column_types: Dict[str, str] = None, max_batch: int = 4096):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.max_batch = max_batch
+        if path.endswith(f".{FORMAT_BIN}"):
+            self.data = read_recording(path, mmap=False)
+        elif path.endswith(MANIFEST_SUFFIX):
+            manifest = read_manifest(path)
+            if manifest["format"] != FORMAT_BIN:
+                column_types = column_types or {c: '<f8' for c in manifest["columns"] if c != 'dt'}
+            self.data = read_segments(path, column_types)
+        else:
+            with open(path, 'r') as f:
+                header = next(csv.reader(f))
+            # float64 keeps the CSV values as they were written
+            column_types = column_types or {c: '<f8' for c in header if c != 'dt'}
+            self.data = read_csv_recording(path, column_types)
+        self.columns = list(self.data.dtype.names)
+        self._offsets = (self.data['dt'] - self.data['dt'][0]).astype(np.int64) if len(self.data) else None
+
+        super().__init__(name=name, sample_rate_s=0, csv_headers=self.columns, output_format=output_format,
+                         column_types={c: self.data.dtype[c].str for c in self.columns})
+
+    @property
+    def expected_rate_hz(self) -> float:
+        if not self.speed or len(self.data) < 2 or self._offsets[-1] <= 0:
+            return None
+        return (len(self.data) - 1) / (self._offsets[-1] / 1e9) * self.speed
 
-        payload = dict(zip(self.csv_headers, data))
-        payload['dt'] = dt
+    async def start_stream(self):
+        if not len(self.data):
+            self.producer.stop_producer()
+            return
 
-        return payload
\ No newline at end of file
+        while not self.producer.finished_execution.is_set():
+            await self._replay_once()
+            if not self.loop:
+                # recording done, like a sensor that was switched off
+                self.producer.stop_producer()
+
+    async def _replay_once(self):
+        loop = get_running_loop()
+        start, start_ns = loop.time(), now()
+        stamps = start_ns + (self._offsets / self.speed if self.speed else self._offsets).astype(np.int64)
+        due_s = (stamps - start_ns) / 1e9
+
+        i, n = 0, len(self.data)
+        while i < n and not self.producer.finished_execution.is_set():
+            if self.speed:
+                elapsed = loop.time() - start
+                if due_s[i] > elapsed:
+                    await sleep(due_s[i] - elapsed)
+                    elapsed = loop.time() - start
+                # at least one sample, the sleep may return a hair early
+                end = min(max(int(np.searchsorted(due_s, elapsed, side='right')), i + 1), i + self.max_batch)
+            else:
+                end = min(i + self.max_batch, n)
+
+            chunk = self.data[i:end]
+            columns = [stamps[i:end].tolist()] + [chunk[c].tolist() for c in self.columns[1:]]
+            await self.producer.produce_batch(list(zip(*columns)))
+            i = end
+            if not self.speed:
+                # as fast as possible, but let the consumers run
+                await sleep(0)
+
+
+class SyntheticSensor(Sensor):
+    """Generates `channels` columns of noisy sine waves at `rate_hz`,
+    emitted in batches every `batch_interval_s`, for load tests at kHz rates
+    """
+
+    def __init__(self, name: str, rate_hz: float = 1000, channels: int = 8, batch_interval_s: float = 0.01,
+                 output_format: str = FORMAT_CSV, column_types: Dict[str, str] = None, seed: int = None):
+        self.rate_hz = rate_hz
+        self.channels = channels
+        self.batch_interval_s = batch_interval_s
+        self._rng = np.random.default_rng(seed)
+        self._frequencies = self._rng.uniform(0.5, 50, channels)
+        super().__init__(name=name, sample_rate_s=0,
+                         csv_headers=['dt'] + [f'channel{i}' for i in range(channels)],
+                         output_format=output_format, column_types=column_types)
+
+    @property
+    def expected_rate_hz(self) -> float:
+        return self.rate_hz
+
+    async def start_stream(self):
+        loop = get_running_loop()
+        start, start_ns = loop.time(), now()
+        period_ns = 1e9 / self.rate_hz
+        emitted = 0
+        while not self.producer.finished_execution.is_set():
+            await sleep(self.batch_interval_s)
+            due = int((loop.time() - start) * self.rate_hz)
+            if due <= emitted:
+                continue
+
+            t = np.arange(emitted, due) / self.rate_hz
+            values = np.sin(2 * np.pi * np.outer(t, self._frequencies)) \
+                + 0.1 * self._rng.standard_normal((len(t), self.channels))
+            stamps = start_ns + (np.arange(emitted, due) * period_ns).astype(np.int64)
+            await self.producer.produce_batch(list(zip(stamps.tolist(), *values.T.tolist())))
+            emitted = due
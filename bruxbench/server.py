@@ -3,68 +3,30 @@ import json
 import logging
 import websockets
 import os
-import glob
-import itertools
-import io
+import numpy as np
+from time import monotonic, time_ns
+from decimate import MinMaxView
+from cache import BlockCache
+from outbox import Outbox
+from protocol import (PROTOCOL_BINARY, PROTOCOL_JSON, encode_samples, encode_summary, merge_samples, metrics_message,
+                      replay_message, schema_message, value_columns)
+from pyramid import has_pyramid, pick_level, pyramid_dir_of, read_level, samples_summary
+from recording import FORMAT_BIN, FORMAT_CSV
+from replay import Replay
+from ringbuffer import RingReader, session_rings
+from segments import MANIFEST_SUFFIX
+from tail import JsonlTail, SessionTail
 
 logging.basicConfig()
 
 
-class ReverseFile(io.IOBase):
-    def __init__(self, filename, headers=1):
-        self.fp = open(filename)
-        self.headers = headers
-        self.reverse = self.reversed_lines()
-        self.end_position = -1
-        self.current_position = -1
-
-    def readline(self, size=-1):
-        if self.headers > 0:
-            self.headers -= 1
-            raw = self.fp.readline(size)
-            self.end_position = self.fp.tell()
-            return raw
-
-        raw = next(self.reverse)
-        if self.current_position > self.end_position:
-            return raw
-
-        raise StopIteration
-
-    def reversed_lines(self):
-        """Generate the lines of file in reverse order.
-        """
-        part = ''
-        for block in self.reversed_blocks():
-            block = block + part
-            block = block.split('\n')
-            block.reverse()
-            part = block.pop()
-            if block[0] == '':
-                block.pop(0)
-
-            for line in block:
-                yield line + '\n'
-
-        if part:
-            yield part
-
-    def reversed_blocks(self, blocksize=0xFFFF):
-        "Generate blocks of file's contents in reverse order."
-        file = self.fp
-        file.seek(0, os.SEEK_END)
-        here = file.tell()
-        while 0 < here:
-            delta = min(blocksize, here)
-            here -= delta
-            file.seek(here, os.SEEK_SET)
-            self.current_position = file.tell()
-            yield file.read(delta)
-
-
 CONNECTIONS = set()
-DIR_TO_STREAM = None
-HEADERS_MAP = {}
+# stream state of every connection, by websocket
+CLIENTS = {}
+# sessions watched by at least one connection, by directory name
+SESSIONS = {}
+# recorded samples decoded for views and range requests, shared by all connections
+CACHE = BlockCache()
 LINE_COLORS = [
     "#3366CC",
     "#DC3912",
@@ -88,82 +50,537 @@ LINE_COLORS = [
     "#3B3EAC"
 ]
 BACKGROUND_COLORS = [line_color + "99" for line_color in LINE_COLORS]
+# bounds of the decimated views clients can ask for
+MAX_SPAN_S = 3600
+MAX_WIDTH = 8192
+
+
+class Series:
+    """Newest `size` samples of a sensor, numbered by a sequence number
+    that keeps counting whichever source (ring or file) they came from.
+    Samples a source delivered before (by its own sequence numbers) are
+    skipped, timestamps are not compared: the wall clock may step back.
+    """
+
+    def __init__(self, sensor_id, dtype, size):
+        self.id = sensor_id
+        self.size = size
+        self.window = np.empty(0, dtype=dtype)
+        # sequence number of the next sample
+        self.seq = 0
+        self._chart = None
+        self._chart_seq = None
+        # decimated views clients subscribed to, by (span_ns, width)
+        self.views = {}
+        # raw samples have no recorded history to wait for, see `MinMaxView.seed`
+        self.seeding = False
+        # sequence number of the next sample of every source, e.g. a ring or file path
+        self._source_seqs = {}
+
+    @property
+    def revision(self):
+        return self.seq
+
+    @property
+    def stable_seq(self):
+        return self.seq
+
+    def append(self, rows, source=None, first_seq=0):
+        """`first_seq` numbers `rows` among the samples of `source`"""
+        if source is not None:
+            expected = self._source_seqs.get(source, first_seq)
+            self._source_seqs[source] = max(expected, first_seq + len(rows))
+            rows = rows[max(0, expected - first_seq):]
+        if len(rows) == 0:
+            return
+        if rows.dtype != self.window.dtype:
+            rows = rows.astype(self.window.dtype)
+        self.window = np.concatenate((self.window, rows[-self.size:]))[-self.size:]
+        self.seq += len(rows)
+        for view in self.views.values():
+            view.append(rows)
+
+    def since(self, seq):
+        """Sequence number of the first sample from `seq` on still in the window, and the samples"""
+        first = self.seq - len(self.window)
+        start = max(seq, first)
+        return start, self.window[start - first:]
+
+    def chart(self):
+        """Chart data of the window (protocol 1), rebuilt only after new samples"""
+        if self._chart_seq != self.seq:
+            self._chart = chart_data(self.window)
+            self._chart_seq = self.seq
+        return self._chart
+
+    def schema(self):
+        columns = value_columns(self.window.dtype)
+        return {
+            "id": self.id,
+            "columns": columns,
+            "colors": LINE_COLORS[:len(columns)],
+            "background_colors": BACKGROUND_COLORS[:len(columns)],
+        }
+
+
+class Session:
+    """Live state of a session directory: its rings, followed files,
+    telemetry and the series of its sensors. One per session, shared by
+    all connections watching it
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.metrics_seq = 0
+        # newest samples of every sensor, by name
+        self.series = {}
+        self.clients = set()
+        self._open()
+
+    def _open(self):
+        """Starts following the files and rings of the session"""
+        self.tail = SessionTail(f"./out/{self.name}", window=self.limit)
+        self.metrics = JsonlTail(f"./out/{self.name}/metrics.jsonl")
+        # live rings and the write_seq read up to, by path
+        self.ring_readers = {}
+        self.ring_seqs = {}
+        # sensors that had a ring, their files are followed once it is gone
+        self.ringed = set()
+
+    def update(self):
+        """Reads what is new, returns False once the session has neither files nor rings"""
+        ring_names = self._update_rings()
+        self._update_files(ring_names)
+        if self.metrics.poll():
+            self.metrics_seq += 1
+        return len(self.tail) > 0 or len(ring_names) > 0
+
+    @property
+    def latest_metrics(self):
+        return self.metrics.latest
+
+    def now(self):
+        """Time of the newest samples, views are seeded up to it"""
+        return time_ns()
+
+    def _add_samples(self, name, rows, source=None, first_seq=0):
+        if name not in self.series:
+            self.series[name] = Series(len(self.series), rows.dtype, self.limit)
+        self.series[name].append(rows, source, first_seq)
+
+    def _update_rings(self):
+        """New samples straight from the shared-memory rings of a running session,
+        returns the names of the sensors that have a ring
+        """
+        names = set()
+        paths = session_rings(self.name)
+        for path in paths:
+            try:
+                if path not in self.ring_readers:
+                    self.ring_readers[path] = RingReader(path)
+                reader = self.ring_readers[path]
+                names.add(reader.name)
+                self.ringed.add(reader.name)
+                self._read_ring(path, reader)
+            except (OSError, ValueError) as e:
+                # session ended and the rings are being removed
+                logging.error(e)
+                self.ring_readers.pop(path, None)
+
+        for path in set(self.ring_readers) - set(paths):
+            # removed, the mapping still holds the last samples
+            reader = self.ring_readers.pop(path)
+            self._read_ring(path, reader)
+            reader.close()
+        return names
+
+    def _read_ring(self, path, reader):
+        seq = self.ring_seqs.get(path, reader.write_seq - self.limit)
+        if seq == reader.write_seq:
+            return
+        data, self.ring_seqs[path] = reader.since(seq)
+        if len(data) > 0:
+            self._add_samples(reader.name, data, path, self.ring_seqs[path] - len(data))
+
+    def _update_files(self, ring_names):
+        """New samples from the files of the session, only the bytes appended
+        since the last tick are read. Files of sensors with a ring are not
+        read, once the ring is gone they are followed from their end: the
+        ring gets every batch before the file does
+        """
+        for name, rows in self.tail.poll(skip=ring_names, from_end=self.ringed).items():
+            tail = self.tail.tails[name]
+            self._add_samples(name, rows, tail.path, tail.seq - len(rows))
+
+    def view(self, name, view):
+        """The samples of a sensor a client asked for, raw or a decimated view.
+        A new view is filled with the recorded span, read through the cache.
+        """
+        series = self.series[name]
+        if view is None:
+            return series
+        if view not in series.views:
+            span_ns, width = view
+            decimated = series.views[view] = MinMaxView(series.id, series.window.dtype, span_ns, width)
+            path = recording_path(self.name, name)
+            decimated.seeding = path is not None
+            # the newest samples may not be flushed to the file yet
+            decimated.append(series.window)
+            if path is not None:
+                end = self.now()
+                history = asyncio.ensure_future(CACHE.read(path, end - span_ns, end))
+                history.add_done_callback(lambda f: seed_view(decimated, f))
+        return series.views[view]
+
+    def prune_views(self):
+        """Drops the views no client looks at anymore"""
+        used = {c.view for c in self.clients}
+        for series in self.series.values():
+            for view in list(series.views):
+                if view not in used:
+                    del series.views[view]
+
+    def close(self):
+        for reader in self.ring_readers.values():
+            reader.close()
+        self.ring_readers.clear()
+        self.tail.close()
+        self.metrics.close()
+
+
+class ReplaySession(Session):
+    """Series of a finished session played back for one connection, see `replay.py`"""
+
+    def __init__(self, replay, limit, client):
+        self.replay = replay
+        super().__init__(replay.name, limit)
+        self.clients.add(client)
+
+    def _open(self):
+        # the rows come from the replay
+        pass
+
+    def update(self):
+        for name, rows in self.replay.advance().items():
+            self._add_samples(name, rows)
+        return True
+
+    @property
+    def latest_metrics(self):
+        return None
+
+    def now(self):
+        return self.replay.position
+
+    def close(self):
+        pass
+
+
+class Client:
+    """What a connection asked for and what it has been sent"""
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        # frames waiting to be written, see `outbox.py`
+        self.outbox = Outbox(websocket)
+        self.protocol = PROTOCOL_JSON
+        # directory name of the session it watches
+        self.session_name = None
+        # finished session it plays back instead, its series and the state sent
+        self.replay = None
+        self.replay_session = None
+        self.replay_revision = None
+        # (span_ns, width) of a decimated view, None for the raw samples
+        self.view = None
+        self.reset()
+
+    def reset(self):
+        # sequence number to send from and revision sent, by sensor
+        self.seqs = {}
+        self.revisions = {}
+        self.metrics_seq = 0
+        # samples (or points) of a sensor the client keeps, from the schema
+        self.window = 0
+        self.outbox.clear()
+
+    def send(self, message, key=None):
+        self.outbox.put(key, message)
+
+    def send_samples(self, name, frame):
+        # a frame not written yet is extended instead of queueing another
+        self.outbox.put(("samples", name), frame, lambda pending, new: merge_samples(pending, new, self.window))
+
+    def stats(self):
+        session = self.replay.name if self.replay is not None else self.session_name
+        return {"remote": str(self.websocket.remote_address), "session": session, "replay": self.replay is not None,
+                "protocol": self.protocol, "view": self.view, **self.outbox.stats()}
+
+    def set_view(self, span_s, width):
+        if not span_s:
+            self.view = None
+        else:
+            span_s = min(float(span_s), MAX_SPAN_S)
+            self.view = (int(span_s * 1e9), max(2, min(int(width), MAX_WIDTH)))
+        self.reset()
+        if self.session_name in SESSIONS:
+            SESSIONS[self.session_name].prune_views()
+        if self.replay_session is not None:
+            self.replay_session.prune_views()
 
 
 def get_dirs():
     return json.dumps({"type": "dirs", "dirs": next(os.walk('./out'))[1]})
 
 
-def start_stream(dir_to_stream):
-    global DIR_TO_STREAM
-    global HEADERS_MAP
-    DIR_TO_STREAM = dir_to_stream
-
-    list_of_files = glob.glob(f"./out/{DIR_TO_STREAM}/*")
-    HEADERS_MAP = {file_path.split('/')[-1].split('.')[0]: next(open(
-        file_path, 'r')).replace('\n', '').split(',') for file_path in list_of_files}
-
+def start_stream(client, dir_to_stream):
+    """Subscribes a connection to a session, the others are not affected"""
+    stop_stream(client)
+    client.session_name = dir_to_stream
+    client.reset()
     return json.dumps({"success": {"message": f"Starting streaming {dir_to_stream}"}})
 
 
-def stop_stream():
-    global DIR_TO_STREAM
-    DIR_TO_STREAM = None
+def stop_stream(client):
+    client.session_name = None
+    if client.replay is not None:
+        client.replay.close()
+        client.replay = client.replay_session = client.replay_revision = None
+    sync_sessions(None)
     return json.dumps({"success": {"message": "Stoping streaming"}})
 
 
+def start_replay(client, dir_to_replay, speed, t):
+    """Plays a finished session back to a connection alone"""
+    stop_stream(client)
+    client.replay = Replay(dir_to_replay, CACHE, speed)
+    client.reset()
+    asyncio.ensure_future(open_replay(client, client.replay, t))
+    return json.dumps({"success": {"message": f"Starting replay of {dir_to_replay}"}})
+
+
+async def open_replay(client, replay, t):
+    try:
+        await replay.open(t)
+    except (OSError, ValueError) as e:
+        logging.error(e)
+        if client.replay is replay:
+            client.send(stop_stream(client))
+            client.send(error_event(f"replay failed: {e!r}"))
+
+
+def control_replay(client, event):
+    """Seek, pause, resume and speed of the replay of a connection"""
+    replay = client.replay
+    if replay is None or not replay.ready:
+        raise ValueError("no replay is playing")
+    if event["action"] == "seek":
+        if "episode" in event:
+            replay.seek_episode(int(event["episode"]))
+        else:
+            replay.seek(int(event["t"]))
+        # samples before the new position are sent from scratch
+        client.replay_session = None
+        client.reset()
+    elif event["action"] == "pause":
+        replay.pause()
+    elif event["action"] == "resume":
+        replay.resume()
+    elif event["action"] == "speed":
+        replay.set_speed(float(event["speed"]))
+
+
+def update_replays(limit, now):
+    """Plays every replay on to the current time and sends it to its connection"""
+    for client in list(CLIENTS.values()):
+        if client.replay is None or not client.replay.ready:
+            continue
+        if client.replay_session is None:
+            client.replay_session = ReplaySession(client.replay, limit, client)
+        session = client.replay_session
+        session.update()
+        if client.replay_revision != client.replay.revision:
+            client.send(replay_message(client.replay.state()), key="replay")
+            client.replay_revision = client.replay.revision
+        if client.outbox.due(now):
+            if client.protocol == PROTOCOL_BINARY:
+                send_binary_updates(session, [client])
+            else:
+                send_json_updates(session, [client])
+
+
+def sync_sessions(limit):
+    """Opens the sessions connections subscribed to, closes the ones nobody
+    watches anymore and assigns the clients to them
+    """
+    wanted = {c.session_name for c in CLIENTS.values() if c.session_name is not None}
+    for name in list(SESSIONS):
+        if name not in wanted:
+            SESSIONS.pop(name).close()
+    if limit is None:
+        return
+    for name in wanted:
+        if name not in SESSIONS:
+            SESSIONS[name] = Session(name, limit)
+    for session in SESSIONS.values():
+        session.clients = {c for c in CLIENTS.values() if c.session_name == session.name}
+
+
+def json_values(column):
+    # missing values (NaN, int minimum) are not valid JSON
+    if column.dtype.kind == 'f':
+        missing = np.isnan(column)
+    else:
+        missing = column == np.iinfo(column.dtype).min
+    return np.where(missing, None, column).tolist()
+
+
+def chart_data(data):
+    columns = value_columns(data.dtype)
+    return {
+        'labels': data['dt'].tolist(),
+        'datasets': [
+            {
+                'label': column,
+                'data': json_values(data[column]),
+                'backgroundColor': BACKGROUND_COLORS[col_i],
+                'borderColor': LINE_COLORS[col_i]
+            } for col_i, column in enumerate(columns)
+        ]
+    }
+
+
+def recording_path(session_name, name):
+    """Manifest of a segmented recording or the file of a sensor"""
+    stem = f"./out/{session_name}/{name}"
+    for path in (stem + MANIFEST_SUFFIX, f"{stem}.{FORMAT_CSV}", f"{stem}.{FORMAT_BIN}"):
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def seed_view(view, history):
+    if history.exception() is not None:
+        logging.error(f"Reading the history of a view failed: {history.exception()!r}")
+        view.seed(None)
+    else:
+        view.seed(history.result())
+
+
+def send_json_updates(session, clients):
+    """Protocol 1: the complete chart data, to clients missing any of it"""
+    series = session.series
+    behind = [c for c in clients if c.metrics_seq != session.metrics_seq or
+              any(c.seqs.get(name) != s.seq for name, s in series.items())]
+    if not behind or not series:
+        return
+    message = json.dumps(
+        {"success": {"message": "Streaming.."}, "payload": {name: s.chart() for name, s in series.items()},
+         "metrics": session.latest_metrics, "type": "payload"})
+    for client in behind:
+        # the complete state, a pending one is outdated
+        client.send(message, key="payload")
+    for client in clients:
+        client.seqs = {name: s.seq for name, s in series.items()}
+        client.metrics_seq = session.metrics_seq
+
+
+def send_binary_updates(session, clients):
+    """Protocol 2: the schema once, then only the samples (or decimated points)
+    a client has not seen. Clients at the same sequence number of the same
+    view share one encoded frame
+    """
+    series = session.series
+    new = [c for c in clients if any(name not in c.seqs for name in series)]
+    for client in new:
+        client.window = session.limit if client.view is None else 2 * max(1, client.view[1] // 2)
+        client.send(schema_message({name: s.schema() for name, s in series.items()}, client.window), key="schema")
+        for name in series:
+            client.seqs.setdefault(name, 0)
+
+    frames = {}
+    for client in clients:
+        for name in series:
+            source = session.view(name, client.view)
+            if source.seeding or client.revisions.get(name) == source.revision:
+                continue
+            key = (name, client.view, client.seqs[name], source.revision)
+            if key not in frames:
+                first, data = source.since(client.seqs[name])
+                frames[key] = (encode_samples(source.id, first, data), [])
+            frames[key][1].append(client)
+            client.seqs[name] = source.stable_seq
+            client.revisions[name] = source.revision
+    for (name, *_), (frame, receivers) in frames.items():
+        for client in receivers:
+            client.send_samples(name, frame)
+
+    behind = [c for c in clients if c.metrics_seq != session.metrics_seq]
+    if behind and session.latest_metrics is not None:
+        message = metrics_message(session.latest_metrics)
+        for client in behind:
+            client.send(message, key="metrics")
+            client.metrics_seq = session.metrics_seq
+
+
+async def send_range(client, event):
+    """Answers a range request from the summary pyramid, samples are read
+    through the cache. See `protocol.py`
+    """
+    # by default the session the client watches, live or played back
+    replaying = client.replay is not None
+    session_name = event.get("dir", client.replay.name if replaying else client.session_name)
+    path = recording_path(session_name, event["sensor"])
+    try:
+        if path is None:
+            raise ValueError(f"no recording of {event['sensor']}")
+        t0, t1 = int(event["t0"]), int(event["t1"])
+        level = pick_level(t0, t1, int(event.get("points", 1000)))
+        if level >= 0 and has_pyramid(path):
+            records = await asyncio.get_running_loop().run_in_executor(
+                None, read_level, pyramid_dir_of(path), level, t0, t1)
+        else:
+            level, records = -1, samples_summary(await CACHE.read(path, t0, t1))
+        session = client.replay_session if replaying and session_name == client.replay.name else \
+            SESSIONS.get(session_name)
+        series = session.series.get(event["sensor"]) if session else None
+        client.send(encode_summary(series.id if series else 0, int(event.get("id", 0)), level, records))
+    except (OSError, ValueError, KeyError) as e:
+        logging.error(e)
+        client.send(error_event(f"range request failed: {e!r}"))
+
+
 def error_event(msg):
     return json.dumps({"error": {"message": msg}})
 
 
+def stats_message():
+    """Queue and lag of every connection and the cache, see `outbox.py`"""
+    return json.dumps({"type": "stats", "clients": [c.stats() for c in CLIENTS.values()], "cache": CACHE.stats()})
+
+
+def send_dirs():
+    message = get_dirs()
+    for client in CLIENTS.values():
+        client.send(message, key="dirs")
+
+
 async def stream(limit, halt_event):
     while not halt_event.is_set():
-        if DIR_TO_STREAM != None:
-            list_of_files = glob.glob(f"./out/{DIR_TO_STREAM}/*")
-
-            if len(list_of_files) > 0:
-                payload = {}
-                for sensor_file in list_of_files:
-                    sensor_file_hash = sensor_file.split('/')[-1].split('.')[0]
-                    chart_data = {
-                        'labels': [],
-                        'datasets': []
-                    }
-
-                    rev = ReverseFile(sensor_file)
-                    lines = list(itertools.islice(rev, limit))[::-1]
-                    if len(lines) == 0:
-                        continue
-
-                    rows = [row.rstrip('\n').split(',') for row in lines]
-                    if 'dt' == rows[0][0]:
-                        rows = rows[1:]
-
-                    # X axis
-                    chart_data['labels'] = [row[0] for row in rows]
-
-                    # line data per column
-                    try:
-                        chart_data['datasets'] = [
-                            {
-                                'label': HEADERS_MAP[sensor_file_hash][col_i],
-                                'data': [row[col_i] for row in rows],
-                                'backgroundColor': BACKGROUND_COLORS[col_i - 1],
-                                'borderColor': LINE_COLORS[col_i - 1]
-                            } for col_i in range(1, len(HEADERS_MAP[sensor_file_hash]))
-                        ]
-                    except Exception as e:
-                        logging.error(e)
-                        chart_data['datasets'] = []
-
-                    payload[sensor_file_hash] = chart_data
-
-                message = json.dumps(
-                    {"success": {"message": "Streaming.."}, "payload": payload, "type": "payload"})
-                websockets.broadcast(CONNECTIONS, message)
-
+        sync_sessions(limit)
+        now = monotonic()
+        for session in list(SESSIONS.values()):
+            if session.update():
+                # nothing is sent while no sensor has new samples, except the
+                # current state once to new connections. Clients that can't
+                # keep up are updated less often
+                clients = [c for c in session.clients if c.outbox.due(now)]
+                send_json_updates(session, [c for c in clients if c.protocol == PROTOCOL_JSON])
+                send_binary_updates(session, [c for c in clients if c.protocol == PROTOCOL_BINARY])
             else:
-                websockets.broadcast(CONNECTIONS, stop_stream())
+                for client in list(session.clients):
+                    client.send(stop_stream(client))
+        update_replays(limit, now)
 
         # 60Hz polling rate
         await asyncio.sleep(0.0166)
@@ -175,22 +592,42 @@ async def event_listener(websocket):
     try:
         # Register user
         CONNECTIONS.add(websocket)
+        client = CLIENTS[websocket] = Client(websocket)
+        sender = asyncio.ensure_future(client.outbox.run())
 
-        websockets.broadcast(CONNECTIONS, get_dirs())
+        send_dirs()
 
         # Manage state changes
         async for message in websocket:
             event = json.loads(message)
             if event["action"] == "dirs":
-                websockets.broadcast(CONNECTIONS, get_dirs())
+                send_dirs()
             elif event["action"] == "stream":
                 dir_to_stream = event["dir"]
-                websockets.broadcast(CONNECTIONS, start_stream(dir_to_stream))
+                client.protocol = event.get("protocol", PROTOCOL_JSON)
+                client.set_view(event.get("span_s"), event.get("width", 0))
+                client.send(start_stream(client, dir_to_stream))
+            elif event["action"] == "replay":
+                client.protocol = event.get("protocol", PROTOCOL_JSON)
+                client.set_view(event.get("span_s"), event.get("width", 0))
+                client.send(start_replay(client, event["dir"], event.get("speed", 1.0), event.get("t")))
+            elif event["action"] in ("seek", "pause", "resume", "speed"):
+                try:
+                    control_replay(client, event)
+                except (ValueError, KeyError, IndexError) as e:
+                    client.send(error_event(f"{event['action']} failed: {e!r}"))
+            elif event["action"] == "view":
+                # span and chart width of the decimated view, no span for the raw samples
+                client.set_view(event.get("span_s"), event.get("width", 0))
             elif event["action"] == "stop":
-                websockets.broadcast(CONNECTIONS, stop_stream())
+                client.send(stop_stream(client))
+            elif event["action"] == "range":
+                asyncio.ensure_future(send_range(client, event))
+            elif event["action"] == "stats":
+                client.send(stats_message())
             else:
                 error_msg = f"unsupported event: {event}"
-                websockets.broadcast(CONNECTIONS, error_event(error_msg))
+                client.send(error_event(error_msg))
                 logging.error(error_msg)
 
         await websocket.wait_closed()
@@ -199,6 +636,9 @@ async def event_listener(websocket):
     finally:
         # Unregister user
         CONNECTIONS.remove(websocket)
+        CLIENTS.pop(websocket, None)
+        sender.cancel()
+        stop_stream(client)
 
 
 async def main(halt_event):
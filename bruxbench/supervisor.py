@@ -0,0 +1,135 @@
+import asyncio
+from logging import getLogger
+from time import time_ns
+
+logger = getLogger("supervisor")
+
+
+class Supervisor:
+    """Keeps the streams of BLE and serial sensors alive.
+
+    `supervise` runs `start_stream` of a sensor under a watchdog. The stream
+    is considered dead when it ended (or raised) before the producer
+    finished, or when no sample arrived for `stall_periods` periods of the
+    expected rate (at least `min_stall_s`). The sensor is then reconnected
+    with `Sensor.reconnect`, retried with exponential backoff up to
+    `max_backoff_s`, and streamed again; the other sensors are not touched.
+
+    Every outage is written to the recording as a gap record (a row with
+    only `dt`, at the time the next sample was due) and listed with its
+    recovery time in the `gaps` of the sensor's `.stats.json`.
+    """
+
+    def __init__(self, check_interval_s: float = 0.25, stall_periods: int = 50, min_stall_s: float = 2.0,
+                 reconnect_timeout_s: float = 30.0, max_backoff_s: float = 30.0):
+        self.check_interval_s = check_interval_s
+        self.stall_periods = stall_periods
+        self.min_stall_s = min_stall_s
+        self.reconnect_timeout_s = reconnect_timeout_s
+        self.max_backoff_s = max_backoff_s
+
+    def stall_timeout_s(self, sensor) -> float:
+        rate = sensor.expected_rate_hz
+        if not rate:
+            return self.min_stall_s
+        return max(self.min_stall_s, self.stall_periods / rate)
+
+    async def supervise(self, sensor):
+        """Runs until the producer of `sensor` finished"""
+        finished = sensor.producer.finished_execution
+        while not finished.is_set():
+            stream = asyncio.ensure_future(sensor.start_stream())
+            reason = await self._watch(sensor, stream)
+            if reason is None:
+                break
+            await self._recover(sensor, reason)
+
+    async def _watch(self, sensor, stream) -> str:
+        """Waits for the stream to end or stall, returns why it has to be
+        restarted or None if it finished regularly
+        """
+        loop = asyncio.get_running_loop()
+        producer = sensor.producer
+        timeout_s = self.stall_timeout_s(sensor)
+        samples, progress_at = producer.samples, loop.time()
+
+        while True:
+            await asyncio.wait([stream], timeout=self.check_interval_s)
+            if producer.finished_execution.is_set():
+                await asyncio.gather(stream, return_exceptions=True)
+                return None
+
+            if stream.done():
+                e = stream.exception()
+                return f"stream ended: {e!r}" if e else "stream ended"
+
+            if producer.samples != samples:
+                samples, progress_at = producer.samples, loop.time()
+            elif loop.time() - progress_at > timeout_s:
+                stream.cancel()
+                await asyncio.gather(stream, return_exceptions=True)
+                return f"no samples for {timeout_s:.1f}s"
+
+    async def _recover(self, sensor, reason: str):
+        loop = asyncio.get_running_loop()
+        detected_at = loop.time()
+        producer = sensor.producer
+
+        gap_start = self._gap_start(sensor)
+        # gap record, all values missing, kept whatever the overflow policy
+        producer.queue.force({'dt': gap_start})
+        logger.info(f"{sensor.name} lost: {reason}, reconnecting..")
+
+        backoff_s = 0.5
+        attempts = 0
+        while not producer.finished_execution.is_set():
+            attempts += 1
+            try:
+                if await self._unless_finished(producer, sensor.reconnect(), self.reconnect_timeout_s):
+                    break
+            except Exception as e:
+                logger.info(f"{sensor.name} reconnect {attempts} failed, next in {backoff_s}s: {e!r}")
+            await self._unless_finished(producer, asyncio.sleep(backoff_s), backoff_s + 1)
+            backoff_s = min(2 * backoff_s, self.max_backoff_s)
+
+        gap_end = time_ns()
+        gap = {
+            "start": gap_start,
+            "end": gap_end,
+            # from the last sample, detection included
+            "outage_s": round((gap_end - gap_start) / 1e9, 3),
+            "reason": reason,
+            "attempts": attempts,
+            # from the detection
+            "recovery_s": round(loop.time() - detected_at, 3),
+        }
+        sensor.consumer.gaps.append(gap)
+        logger.info(f"{sensor.name} recovered: {gap}")
+
+    @staticmethod
+    async def _unless_finished(producer, aw, timeout_s: float) -> bool:
+        """Awaits `aw` for at most `timeout_s`, cancelled as soon as the
+        producer finished (halt). Returns whether it completed, raises its
+        exception and `asyncio.TimeoutError`
+        """
+        task = asyncio.ensure_future(aw)
+        finished = asyncio.ensure_future(producer.finished_execution.wait())
+        await asyncio.wait([task, finished], timeout=timeout_s, return_when=asyncio.FIRST_COMPLETED)
+        finished.cancel()
+        if task.done():
+            task.result()
+            return True
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        if producer.finished_execution.is_set():
+            return False
+        raise asyncio.TimeoutError()
+
+    @staticmethod
+    def _gap_start(sensor) -> int:
+        """When the first missing sample was due"""
+        last_dt = sensor.producer.intervals.last_dt
+        if last_dt is None:
+            return time_ns()
+        rate = sensor.expected_rate_hz
+        return last_dt + (int(1e9 / rate) if rate else 1)
@@ -0,0 +1,280 @@
+"""Incremental tail-follow of the recordings of a running session
+
+`SessionTail` keeps one open handle and byte offset per sensor file and on
+every `poll` reads only the bytes appended since the last one (a `fstat`
+when nothing changed), parses only those rows and keeps the newest
+`window` rows of every sensor in memory. CSV and binary recordings are
+followed, and a sensor moves on to its next segment (see `segments.py`)
+once the current one is drained. The segments of a sensor are found
+through its manifest, a compressed one (of a finished session) is complete
+and is read once.
+"""
+import csv
+import glob
+import io
+import json
+import os
+import struct
+from time import monotonic
+from typing import Dict, Set
+
+import numpy as np
+
+from recording import FORMAT_BIN, FORMAT_CSV, Schema, read_header_from
+from segments import EXTENSIONS, MANIFEST_SUFFIX, open_segment, read_manifest, read_segment, segment_path
+
+_CHUNK = 1 << 20
+
+
+def sensor_name(path: str) -> str:
+    """`emg` of `emg.csv` and of the segment `emg.0003.csv`"""
+    return os.path.basename(path).split('.')[0]
+
+
+class FileTail:
+    """Follows one growing CSV or binary recording, or reads a compressed segment"""
+
+    def __init__(self, path: str, window: int, column_types: Dict[str, str] = None, from_end: bool = False):
+        """With `from_end` only rows appended after the first poll are read"""
+        self.path = path
+        self.name = sensor_name(path)
+        self.window_size = window
+        self.column_types = column_types
+        self.compressed = path.endswith(tuple(EXTENSIONS.values()))
+        plain = os.path.splitext(path)[0] if self.compressed else path
+        self.format = FORMAT_BIN if plain.endswith(f".{FORMAT_BIN}") else FORMAT_CSV
+        self._f = open_segment(path) if self.compressed else open(path, 'rb')
+        self.offset = 0
+        self.schema = None
+        self.window = None
+        # rows parsed so far, the sequence number of the next row
+        self.seq = 0
+        self._partial = b""
+        self.from_end = from_end
+
+    def _read_schema(self) -> bool:
+        self._f.seek(0)
+        if self.format == FORMAT_BIN:
+            try:
+                self.schema, self.offset = read_header_from(self._f, self.path)
+            except (ValueError, struct.error):
+                # header not completely written yet
+                return False
+        else:
+            line = self._f.readline()
+            if not line.endswith(b"\n"):
+                return False
+            self.schema = Schema(line.decode('utf8').rstrip('\r\n').split(','), self.column_types)
+            self.offset = len(line)
+        self.window = np.empty(0, dtype=self.schema.dtype)
+        return True
+
+    def _skip_to_window(self):
+        """On the first poll only the last `window` rows are parsed"""
+        size = os.fstat(self._f.fileno()).st_size
+        if self.format == FORMAT_BIN:
+            rows = (size - self.offset) // self.schema.record_size
+            skipped = max(0, rows - self.window_size)
+            self.offset += skipped * self.schema.record_size
+            self.seq = skipped
+        else:
+            # a block holding at least `window` lines, rows before it are not counted
+            start = max(self.offset, size - self.window_size * 512)
+            if start > self.offset:
+                self._f.seek(start)
+                self._f.readline()
+                self.offset = self._f.tell()
+
+    def _skip_to_end(self):
+        """Past the last complete row"""
+        size = os.fstat(self._f.fileno()).st_size
+        if self.format == FORMAT_BIN:
+            self.offset += (size - self.offset) // self.schema.record_size * self.schema.record_size
+            return
+        start = max(self.offset, size - _CHUNK)
+        self._f.seek(start)
+        end = self._f.read(size - start).rfind(b"\n")
+        if end >= 0:
+            self.offset = start + end + 1
+
+    def _read_compressed(self) -> np.ndarray:
+        """The last `window` rows of a compressed segment, nothing is appended to it"""
+        self._f.close()
+        rows = read_segment(self.path, self.format, self.column_types)
+        self.seq = len(rows)
+        self.window = rows[-self.window_size:].copy()
+        return self.window[:0] if self.from_end else self.window
+
+    def poll(self) -> np.ndarray:
+        """Rows appended since the last poll, they are also added to `window`"""
+        if self.compressed:
+            return self._read_compressed() if self.window is None else self.window[:0]
+        if self.schema is None:
+            if not self._read_schema():
+                return None
+            if self.from_end:
+                self._skip_to_end()
+            else:
+                self._skip_to_window()
+
+        size = os.fstat(self._f.fileno()).st_size
+        if size <= self.offset:
+            return self.window[:0]
+
+        self._f.seek(self.offset)
+        if self.format == FORMAT_BIN:
+            count = (size - self.offset) // self.schema.record_size
+            data = self._f.read(count * self.schema.record_size)
+            self.offset += len(data)
+            rows = np.frombuffer(data, dtype=self.schema.dtype, count=len(data) // self.schema.record_size)
+        else:
+            data = self._partial + self._f.read(size - self.offset)
+            self.offset = size
+            # the last line may still be being written
+            end = data.rfind(b"\n") + 1
+            data, self._partial = data[:end], data[end:]
+            lines = csv.reader(io.StringIO(data.decode('utf8')))
+            rows = np.frombuffer(self.schema.pack_rows(row for row in lines if row and row[0] != "dt"),
+                                 dtype=self.schema.dtype)
+
+        if len(rows):
+            self.seq += len(rows)
+            self.window = np.concatenate((self.window, rows[-self.window_size:]))[-self.window_size:]
+        return rows
+
+    def drained(self) -> bool:
+        if self.compressed:
+            return self.window is not None
+        return os.fstat(self._f.fileno()).st_size <= self.offset
+
+    def close(self):
+        self._f.close()
+
+
+class SessionTail:
+    """Follows every sensor file of a session directory. New files and
+    segments are looked for every `rescan_s`, not on every poll.
+    """
+
+    def __init__(self, session_dir: str, window: int, rescan_s: float = 1.0):
+        self.session_dir = session_dir
+        self.window = window
+        self.rescan_s = rescan_s
+        self.tails: Dict[str, FileTail] = {}
+        self._newest: Dict[str, str] = {}
+        self._scanned_at = None
+
+    def _scan(self):
+        paths = sorted(glob.glob(f"{self.session_dir}/*.{FORMAT_CSV}") +
+                       glob.glob(f"{self.session_dir}/*.{FORMAT_BIN}"))
+        # sorted: of rotated segments the newest one wins
+        self._newest = {sensor_name(p): p for p in paths}
+        for path in glob.glob(f"{self.session_dir}/*{MANIFEST_SUFFIX}"):
+            # segments may be compressed, the manifest lists them all
+            try:
+                manifest = read_manifest(path)
+            except (OSError, ValueError):
+                continue
+            if manifest["segments"]:
+                newest = segment_path(self.session_dir, manifest, manifest["segments"][-1])
+                self._newest[sensor_name(path)] = newest
+        self._scanned_at = monotonic()
+
+    def poll(self, skip: Set[str] = frozenset(), from_end: Set[str] = frozenset()) -> Dict[str, np.ndarray]:
+        """New rows of every sensor that has some. Sensors in `skip` are not
+        followed, the files of the ones in `from_end` only from the end they
+        have when they are first followed
+        """
+        if self._scanned_at is None or monotonic() - self._scanned_at >= self.rescan_s:
+            self._scan()
+
+        updates = {}
+        for name, path in self._newest.items():
+            if name in skip:
+                if name in self.tails:
+                    self.tails.pop(name).close()
+                continue
+            tail = self.tails.get(name)
+            if tail is None:
+                try:
+                    tail = self.tails[name] = FileTail(path, self.window, from_end=name in from_end)
+                except (OSError, ValueError):
+                    # compressed away since the scan, or zstd without the zstandard package
+                    continue
+
+            rows = tail.poll()
+            # a segment compressed after it was drained holds nothing new
+            if tail.path != path and tail.drained() and not path.startswith(f"{tail.path}."):
+                # next segment, the window carries over
+                tail = self._next_segment(tail, path)
+                more = tail.poll() if tail is not None else None
+                if more is not None and len(more):
+                    rows = more if rows is None or not len(rows) else np.concatenate((rows, more))
+
+            if rows is not None and len(rows):
+                updates[name] = rows
+        return updates
+
+    def _next_segment(self, tail: FileTail, path: str) -> FileTail:
+        try:
+            following = FileTail(path, self.window)
+        except (OSError, ValueError):
+            return None
+        tail.close()
+        if tail.window is not None and not following.compressed and following._read_schema():
+            # the new segment is read from its start
+            following.window = tail.window.astype(following.schema.dtype)
+            following.seq = tail.seq
+        self.tails[tail.name] = following
+        return following
+
+    def windows(self) -> Dict[str, FileTail]:
+        return {name: tail for name, tail in self.tails.items() if tail.window is not None}
+
+    def __len__(self) -> int:
+        return len(self._newest)
+
+    def close(self):
+        for tail in self.tails.values():
+            tail.close()
+        self.tails.clear()
+
+
+class JsonlTail:
+    """Newest complete line of a growing JSON lines file, e.g. `metrics.jsonl`"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._f = None
+        self.offset = 0
+        self._partial = b""
+        self.latest = None
+
+    def poll(self) -> bool:
+        """Whether `latest` changed"""
+        if self._f is None:
+            if not os.path.exists(self.path):
+                return False
+            self._f = open(self.path, 'rb')
+            # only the end is of interest
+            self.offset = max(0, os.fstat(self._f.fileno()).st_size - _CHUNK)
+
+        size = os.fstat(self._f.fileno()).st_size
+        if size <= self.offset:
+            return False
+        self._f.seek(self.offset)
+        data = self._partial + self._f.read(size - self.offset)
+        self.offset = size
+        lines = data.split(b"\n")
+        self._partial = lines.pop()
+        for line in reversed(lines):
+            try:
+                self.latest = json.loads(line)
+                return True
+            except ValueError:
+                continue
+        return False
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
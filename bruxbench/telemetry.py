@@ -0,0 +1,182 @@
+import asyncio
+import json
+import os
+from logging import getLogger
+from math import sqrt
+from time import time_ns, process_time
+from typing import Dict, List
+
+from segments import compressor_stats
+
+logger = getLogger("telemetry")
+
+METRICS_FILE = "metrics.jsonl"
+
+
+class IntervalStats:
+    """Running mean/variance (Welford) of the time between samples,
+    reset at the start of every telemetry window
+    """
+
+    def __init__(self):
+        self.last_dt = None
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, dt: int, samples: int = 1):
+        """`dt` is the timestamp of the newest of `samples` samples, produced
+        together the interval is averaged over them
+        """
+        if self.last_dt is not None and samples > 0:
+            interval = (dt - self.last_dt) / samples
+            self.count += 1
+            delta = interval - self._mean
+            self._mean += delta / self.count
+            self._m2 += delta * (interval - self._mean)
+        self.last_dt = dt
+
+    def as_dict(self) -> dict:
+        return {
+            "interval_ms": round(self._mean / 1e6, 3),
+            "jitter_ms": round(sqrt(self._m2 / self.count) / 1e6, 3) if self.count else 0,
+        }
+
+
+class Telemetry:
+    """Health of a running session, sampled every `interval_s`.
+
+    Per sensor: effective sample rate and inter-sample jitter (from the `dt`
+    of the produced samples), queue depth, dropped/spilled samples, link
+    errors of the sensor (`Sensor.link_stats`, forwarded by the worker for
+    sensors of process groups) and write latency of the consumer. For the process: lag of the event loop, probed every
+    `lag_probe_s`. Only counters are read, nothing is added to the sample path
+    beyond what `Producer` already counts.
+
+    Every snapshot is appended as a JSON line to `metrics.jsonl` in the
+    session directory (the dashboard shows the newest one) and a summary is
+    logged every `log_interval_s`.
+    """
+
+    def __init__(self, sensors: List, session_dir: str, interval_s: float = 1.0, log_interval_s: float = 30.0,
+                 lag_probe_s: float = 0.05):
+        self.sensors = sensors
+        self.path = os.path.join(session_dir, METRICS_FILE)
+        self.interval_s = interval_s
+        self.log_interval_s = log_interval_s
+        self.lag_probe_s = lag_probe_s
+        self.latest = None
+        self._previous: Dict[str, dict] = {}
+        self._lag_max_s = 0.0
+        self._lag_total_s = 0.0
+        self._lag_probes = 0
+        self._cpu_s = process_time()
+
+    def finished(self) -> bool:
+        return all(s.producer.finished_execution.is_set() for s in self.sensors)
+
+    async def run(self):
+        """Runs until the producers of all sensors finished"""
+        loop = asyncio.get_running_loop()
+        window_start = last_log = loop.time()
+        with open(self.path, 'a') as f:
+            while not self.finished():
+                expected = loop.time() + self.lag_probe_s
+                await asyncio.sleep(self.lag_probe_s)
+                self._add_lag(max(0.0, loop.time() - expected))
+
+                now = loop.time()
+                if now - window_start < self.interval_s:
+                    continue
+
+                self.latest = self.snapshot(now - window_start)
+                window_start = now
+                f.write(json.dumps(self.latest) + "\n")
+                f.flush()
+                self.warn()
+
+                if now - last_log >= self.log_interval_s:
+                    last_log = now
+                    self.log()
+
+    def _add_lag(self, lag_s: float):
+        self._lag_probes += 1
+        self._lag_total_s += lag_s
+        self._lag_max_s = max(self._lag_max_s, lag_s)
+
+    def snapshot(self, elapsed_s: float) -> dict:
+        loop_stats = {
+            "lag_avg_ms": round(1000 * self._lag_total_s / self._lag_probes, 3) if self._lag_probes else 0,
+            "lag_max_ms": round(1000 * self._lag_max_s, 3),
+        }
+        self._lag_max_s = self._lag_total_s = 0.0
+        self._lag_probes = 0
+
+        # all threads of the process: event loop, writers, buses, compression
+        cpu_s = process_time()
+        process_stats = {"cpu_percent": round(100 * (cpu_s - self._cpu_s) / elapsed_s, 1)}
+        self._cpu_s = cpu_s
+        compression = compressor_stats()
+        if compression is not None:
+            process_stats["compression"] = compression
+
+        return {
+            "t": time_ns(),
+            "loop": loop_stats,
+            "process": process_stats,
+            "sensors": {s.name: self._sensor_snapshot(s, elapsed_s) for s in self.sensors},
+        }
+
+    def _sensor_snapshot(self, sensor, elapsed_s: float) -> dict:
+        producer, queue, writer = sensor.producer, sensor.producer.queue, sensor.consumer.stats
+        # samples of worker sensors also wait in (and are dropped from) the queue of the worker
+        remote = sensor.worker_stats or {}
+        remote_queue = remote.get("queue", {})
+        dropped = queue.dropped + remote_queue.get("dropped", 0)
+        previous = self._previous.get(sensor.name, {})
+        current = {
+            "samples": producer.samples,
+            "dropped": dropped,
+            "rows": writer.rows,
+            "batches": writer.batches,
+            "latency_s": writer.batch_latency_total_s,
+        }
+        self._previous[sensor.name] = current
+
+        def delta(key):
+            return current[key] - previous.get(key, 0)
+
+        batches = delta("batches")
+        stats = {
+            "rate_hz": round(delta("samples") / elapsed_s, 2),
+            **producer.intervals.as_dict(),
+            "queue_depth": queue.depth() + remote_queue.get("depth", 0),
+            "queue_high_water_mark": max(queue.high_water_mark, remote_queue.get("high_water_mark", 0)),
+            "dropped": dropped,
+            "dropped_in_window": delta("dropped"),
+            "spilled": queue.spilled + remote_queue.get("spilled", 0),
+            "written_hz": round(delta("rows") / elapsed_s, 2),
+            "write_latency_avg_ms": round(1000 * delta("latency_s") / batches, 3) if batches else 0,
+            "write_latency_max_ms": round(1000 * writer.take_recent_max(), 3),
+            "gaps": len(sensor.consumer.gaps),
+            **(remote["link"] if "link" in remote else sensor.link_stats()),
+        }
+        producer.intervals.reset()
+        return stats
+
+    def log(self):
+        if self.latest is None:
+            return
+        logger.info(f"event loop: {self.latest['loop']}, process: {self.latest['process']}")
+        for name, stats in self.latest["sensors"].items():
+            logger.info(f"{name}: {stats['rate_hz']} Hz, jitter {stats['jitter_ms']} ms, "
+                        f"queue {stats['queue_depth']}, dropped {stats['dropped']}, "
+                        f"write {stats['write_latency_avg_ms']} ms")
+
+    def warn(self):
+        for name, stats in self.latest["sensors"].items():
+            if stats["dropped_in_window"]:
+                logger.warning(f"{name} dropped {stats['dropped_in_window']} samples!")
@@ -0,0 +1,259 @@
+"""Sparse time index of recordings
+
+Next to every sensor file (or segment) the consumer writes `<file>.idx`:
+one fixed record per second of `dt` that has samples,
+
+    i8 second (dt // 1e9) | i8 byte offset of its first row | i8 number of rows before it
+
+so `read_range` can seek straight to `[t0, t1)` and only reads the rows of
+that range, however long the session is. A row whose `dt` steps back (wall
+clock adjustments) counts as the newest `dt` before it, as in the pyramid,
+so the index stays sorted and such rows are read with their neighbours. Works for CSV and binary files
+and for the segments of `segments.py` (compressed ones are decompressed up
+to the offset, bounded by the segment length).
+
+Usage to index existing sessions:
+    python timeindex.py out/<dir>@<ts>
+"""
+import glob
+import io
+import os
+import sys
+from typing import Dict, List
+
+import numpy as np
+
+from recording import FORMAT_BIN, FORMAT_CSV, Schema, read_csv_from, read_header, read_header_from, row_dt
+from segments import EXTENSIONS, MANIFEST_SUFFIX, manifest_dtype, read_manifest, open_segment, segment_path
+
+INDEX_SUFFIX = ".idx"
+INDEX_DTYPE = np.dtype([("second", "<i8"), ("offset", "<i8"), ("row", "<i8")])
+NS = 1_000_000_000
+
+
+class IndexedWriter:
+    """Record writer (see `recording.WRITERS`) that also maintains the index
+    of its file. Only the batches that cross a second boundary cost a
+    pass over their `dt` and a `tell` per second.
+    """
+
+    def __init__(self, writer_cls, path: str, columns: List[str], column_types: Dict[str, str] = None):
+        self.writer = writer_cls(path, columns, column_types)
+        self.path = path
+        self.index_path = path + INDEX_SUFFIX
+        self.rows = 0
+        self._second = None
+        self._index = None
+
+    def create(self):
+        self.writer.create()
+        if not os.path.exists(self.index_path):
+            open(self.index_path, 'wb').close()
+
+    def open(self):
+        self.writer.open()
+        entries = read_index(self.index_path)
+        if len(entries):
+            # appending to an existing recording
+            self._second = int(entries["second"][-1])
+            self.rows = count_rows(self.path)
+        self._index = open(self.index_path, 'ab')
+
+    def write_rows(self, batch: list):
+        if not batch:
+            return
+        seconds = _clamped(np.fromiter((row_dt(row) for row in batch), np.int64, len(batch)) // NS, self._second)
+        if seconds[-1] == self._second:
+            self.writer.write_rows(batch)
+            self.rows += len(batch)
+            return
+
+        entries = []
+        written = 0
+        previous = seconds[0] - 1 if self._second is None else self._second
+        for start in np.flatnonzero(np.diff(seconds, prepend=previous)):
+            if start > written:
+                self.writer.write_rows(batch[written:start])
+                self.rows += int(start) - written
+            entries.append((int(seconds[start]), self.writer.tell(), self.rows))
+            written = int(start)
+        self.writer.write_rows(batch[written:])
+        self.rows += len(batch) - written
+        self._second = int(seconds[-1])
+        self._index.write(np.array(entries, dtype=INDEX_DTYPE).tobytes())
+
+    def tell(self) -> int:
+        return self.writer.tell()
+
+    def flush(self):
+        self.writer.flush()
+        self._index.flush()
+
+    def fileno(self) -> int:
+        return self.writer.fileno()
+
+    def close(self):
+        self.writer.close()
+        self._index.close()
+
+
+def _clamped(values: np.ndarray, floor=None) -> np.ndarray:
+    """Running maximum of `values`, at least `floor`"""
+    if floor is not None:
+        values = np.maximum(values, floor)
+    return np.maximum.accumulate(values)
+
+
+def read_index(index_path: str) -> np.ndarray:
+    if not os.path.exists(index_path):
+        return np.empty(0, dtype=INDEX_DTYPE)
+    return np.fromfile(index_path, dtype=INDEX_DTYPE)
+
+
+def count_rows(path: str) -> int:
+    if path.endswith(f".{FORMAT_BIN}"):
+        schema, offset = read_header(path)
+        return (os.path.getsize(path) - offset) // schema.record_size
+    with open(path, 'rb') as f:
+        # minus the header
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b"")) - 1
+
+
+def build_index(path: str) -> str:
+    """Index an existing recording with one sequential pass"""
+    entries = []
+    last = None
+    if path.endswith(f".{FORMAT_BIN}"):
+        schema, offset = read_header(path)
+        data = np.memmap(path, dtype=schema.dtype, mode='r', offset=offset,
+                         shape=((os.path.getsize(path) - offset) // schema.record_size,))
+        seconds = _clamped(data["dt"] // NS)
+        rows = np.flatnonzero(np.diff(seconds, prepend=seconds[:1] - 1) > 0)
+        entries = [(int(seconds[r]), offset + int(r) * schema.record_size, int(r)) for r in rows]
+    else:
+        with open(path, 'rb') as f:
+            f.readline()
+            row = 0
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    second = int(line.split(b",", 1)[0]) // NS
+                except ValueError:
+                    second = None
+                if second is not None and (last is None or second > last):
+                    entries.append((second, offset, row))
+                    last = second
+                row += 1
+
+    index_path = path + INDEX_SUFFIX
+    np.array(entries, dtype=INDEX_DTYPE).tofile(index_path)
+    return index_path
+
+
+def _span(index: np.ndarray, t0: int, t1: int):
+    """Byte range and first row covering `[t0, t1)`, end None is end of file"""
+    if not len(index):
+        return None, None, 0
+    i = max(int(np.searchsorted(index["second"], t0 // NS, side='right')) - 1, 0)
+    j = int(np.searchsorted(index["second"], -(-t1 // NS), side='left'))
+    end = int(index["offset"][j]) if j < len(index) else None
+    return int(index["offset"][i]), end, int(index["row"][i])
+
+
+def _read_span(f, start: int, end: int, file_format: str, schema: Schema, column_types) -> np.ndarray:
+    if start is not None:
+        f.seek(start)
+    data = f.read() if end is None else f.read(end - (start or 0))
+    if file_format == FORMAT_BIN:
+        return np.frombuffer(data, dtype=schema.dtype, count=len(data) // schema.record_size)
+    # the header line makes it a complete CSV again
+    text = ",".join(schema.columns) + "\n" + data.decode('utf8')
+    return read_csv_from(io.StringIO(text), column_types)
+
+
+def _read_file_range(path: str, index_path: str, file_format: str, t0: int, t1: int,
+                     column_types: Dict[str, str] = None) -> np.ndarray:
+    start, end, _ = _span(read_index(index_path), t0, t1)
+    with open_segment(path) as f:
+        if file_format == FORMAT_BIN:
+            schema, header_end = read_header_from(f, path)
+            start = start if start is not None else header_end
+        else:
+            schema = Schema(f.readline().decode('utf8').rstrip('\r\n').split(','), column_types)
+        data = _read_span(f, start, end, file_format, schema, column_types)
+    # a span starts at the newest dt so far, which makes the clamp exact
+    dt = _clamped(data["dt"])
+    if not np.array_equal(dt, data["dt"]):
+        data = data.copy()
+        data["dt"] = dt
+    return data[(dt >= t0) & (dt < t1)]
+
+
+def read_range(path: str, t0: int, t1: int, column_types: Dict[str, str] = None) -> np.ndarray:
+    """Rows of a recording with `t0 <= dt < t1` (ns), as a structured array,
+    `dt` clamped to never decrease. `path` is a sensor file (`.csv`/`.bin`) or the `.manifest.json` of a
+    segmented one. Without an index the file is read completely.
+    """
+    if not path.endswith(MANIFEST_SUFFIX):
+        file_format = FORMAT_BIN if path.endswith(f".{FORMAT_BIN}") else FORMAT_CSV
+        return _read_file_range(path, path + INDEX_SUFFIX, file_format, t0, t1, column_types)
+
+    manifest = read_manifest(path)
+    directory = os.path.dirname(path)
+    file_format = manifest["format"]
+    parts = []
+    for segment in manifest["segments"]:
+        if segment["first_dt"] is not None and segment["closed"] and \
+                (segment["last_dt"] < t0 or segment["first_dt"] >= t1):
+            continue
+        file = segment_path(directory, manifest, segment)
+        parts.append(_read_file_range(file, _segment_index_path(file), file_format, t0, t1, column_types))
+    if not parts:
+        return np.empty(0, dtype=manifest_dtype(directory, manifest, column_types))
+    return np.concatenate(parts)
+
+
+def _segment_index_path(file: str) -> str:
+    """The index of a segment is named after the uncompressed file"""
+    for extension in EXTENSIONS.values():
+        if file.endswith(extension):
+            file = file[:-len(extension)]
+    return file + INDEX_SUFFIX
+
+
+def time_bounds(path: str):
+    """Whole seconds `(first, end)` in ns covering the `dt` of a recording
+    (file or manifest) according to its index, None without one
+    """
+    if path.endswith(MANIFEST_SUFFIX):
+        directory = os.path.dirname(path)
+        files = [os.path.join(directory, segment["file"]) for segment in read_manifest(path)["segments"]]
+        # the newest segment has no index entry yet right after a rotation
+        first = next((index for index in map(_segment_index, files) if len(index)), None)
+        last = next((index for index in map(_segment_index, reversed(files)) if len(index)), None)
+    else:
+        first = last = read_index(path + INDEX_SUFFIX)
+    if first is None or not len(first):
+        return None
+    return int(first["second"][0]) * NS, (int(last["second"][-1]) + 1) * NS
+
+
+def _segment_index(file: str) -> np.ndarray:
+    return read_index(_segment_index_path(file))
+
+
+def index_session(session_dir: str) -> List[str]:
+    """Index every sensor file of a session that has no index yet"""
+    indexed = []
+    for path in sorted(glob.glob(f"{session_dir}/*.csv") + glob.glob(f"{session_dir}/*.{FORMAT_BIN}")):
+        if not os.path.exists(path + INDEX_SUFFIX):
+            indexed.append(build_index(path))
+    return indexed
+
+
+if __name__ == "__main__":
+    for index_path in index_session(sys.argv[1]):
+        print(index_path)
@@ -0,0 +1,226 @@
+import asyncio
+import multiprocessing
+import os
+import pickle
+import shutil
+import tempfile
+from logging import getLogger
+from time import monotonic
+from typing import List
+
+import numpy as np
+
+from reactor import Producer
+from recording import Schema
+from ringbuffer import RING_ROOT, RingReader, RingWriter
+from scheduler import PollScheduler
+from sensor import init_sensors
+from supervisor import Supervisor
+
+logger = getLogger("workers")
+
+
+class SensorGroup:
+    """Runs a group of sensors in a worker process.
+
+    The worker initializes and streams the sensors on its own event loop
+    (and its own GIL) and every `flush_interval_s` copies their samples into
+    one shared-memory ring per sensor (see `ringbuffer.py`), packed in
+    `csv_headers` order. In the parent `receive` reads the records since the
+    last read and hands them to the queues of the sensors, which are
+    consumed as usual. The worker only writes what fits behind the read
+    position of the parent, anything else stays in its own queue, where the
+    overflow policy of the sensor applies.
+
+    Numeric columns cross as float64, whatever their `column_types`: missing
+    and malformed values (and gap records) travel as NaN and are given back
+    to the consumers as None, so they are written as missing values, not as
+    the integer type minimum. Integer columns are restored as integers.
+
+    Link and queue counters and the gaps of the worker are sent over a pipe
+    every `stats_interval_s`. The parent reports them (see
+    `Sensor.worker_stats`) and writes them to the `.stats.json` of the sensor.
+    """
+
+    def __init__(self, sensors: List, flush_interval_s: float = 0.02, supervisor: Supervisor = None,
+                 stats_interval_s: float = 1.0):
+        self.sensors = sensors
+        self.supervisor = supervisor
+        self.flush_interval_s = flush_interval_s
+        self.stats_interval_s = stats_interval_s
+        self.process = None
+        self._conn = None
+        self._halt = None
+        self._done = None
+        self._dir = None
+        self._rings = []
+        self._recorded = []
+        # records of every ring read by the parent, shared with the worker
+        self._read_seqs = None
+
+    @property
+    def name(self) -> str:
+        return "+".join(s.name for s in self.sensors)
+
+    @staticmethod
+    def _schema(sensor, recorded: np.dtype) -> Schema:
+        types = {c: "<f8" if recorded[c].kind in "iuf" else recorded[c].str for c in recorded.names[1:]}
+        return Schema(sensor.csv_headers, types)
+
+    @staticmethod
+    def _rows(recorded: np.dtype, data: np.ndarray) -> list:
+        """Records of a ring as tuples in column order, NaN as None and
+        integer columns as integers again
+        """
+        columns = [data["dt"].tolist()]
+        for c in recorded.names[1:]:
+            values = data[c]
+            if values.dtype.kind != "f":
+                columns.append(values.tolist())
+                continue
+            missing = np.isnan(values)
+            if recorded[c].kind in "iu":
+                values = np.where(missing, 0, values).astype(np.int64)
+            column = values.tolist()
+            for i in np.flatnonzero(missing):
+                column[i] = None
+            columns.append(column)
+        return list(zip(*columns))
+
+    def start(self):
+        # fork: the sensors and the rings are inherited as they are, no pickling needed
+        ctx = multiprocessing.get_context("fork")
+        self._halt = ctx.Event()
+        self._done = ctx.Event()
+        self._read_seqs = ctx.Array('q', len(self.sensors), lock=False)
+        os.makedirs(RING_ROOT, exist_ok=True)
+        # not in the ring directory of a session, the server would show them
+        self._dir = tempfile.mkdtemp(prefix="link-", dir=RING_ROOT)
+        # dtypes of the recordings, the rings carry their numeric columns as float64
+        self._recorded = [Schema(s.csv_headers, s.consumer.column_types).dtype for s in self.sensors]
+        self._rings = [RingWriter(f"{self._dir}/{i}.ring", self._schema(s, recorded))
+                       for i, (s, recorded) in enumerate(zip(self.sensors, self._recorded))]
+        receiver, sender = ctx.Pipe(duplex=False)
+        self.process = ctx.Process(target=self._worker, args=(sender,), name=f"sensors-{self.name}", daemon=True)
+        self.process.start()
+        sender.close()
+        self._conn = receiver
+        paths = [ring.path for ring in self._rings]
+        for ring in self._rings:
+            ring.close()
+        self._rings = [RingReader(path) for path in paths]
+        logger.info(f"Started worker {self.process.pid} for {self.name}")
+
+    def halt(self):
+        self._halt.set()
+
+    async def receive(self):
+        """Parent side: feed the forwarded samples to the consumers until the worker finished"""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # everything is in the rings once the worker is done
+                done = self._done.is_set()
+                exited = not done and not self.process.is_alive()
+                self._receive_stats()
+                for i, ring in enumerate(self._rings):
+                    data, self._read_seqs[i] = ring.since(self._read_seqs[i])
+                    if len(data):
+                        await self.sensors[i].producer.produce_batch(self._rows(self._recorded[i], data))
+                if done:
+                    break
+                if exited:
+                    logger.info(f"Worker {self.name} exited without finishing the stream!")
+                    break
+                await asyncio.sleep(self.flush_interval_s)
+        finally:
+            for s in self.sensors:
+                s.producer.stop_producer()
+            await loop.run_in_executor(None, self.process.join)
+            self._conn.close()
+            for ring in self._rings:
+                ring.close()
+            shutil.rmtree(self._dir, ignore_errors=True)
+
+    def _receive_stats(self):
+        try:
+            while self._conn.poll():
+                for i, stats in pickle.loads(self._conn.recv_bytes()).items():
+                    sensor = self.sensors[i]
+                    sensor.worker_stats = stats
+                    sensor.consumer.gaps = stats["gaps"]
+                    sensor.consumer.worker_queue = stats["queue"]
+        except (EOFError, OSError):
+            pass
+
+    def _worker(self, conn):
+        asyncio.run(self._worker_main(conn))
+
+    async def _worker_main(self, conn):
+        # fresh queues bound to the worker loop, the parent keeps its own
+        for s in self.sensors:
+            queue = s.producer.queue
+            s.producer = Producer(capacity=queue.maxsize, overflow=queue.overflow)
+            s.producer.queue.spill_dir = queue.spill_dir
+
+        await init_sensors(self.sensors)
+
+        scheduler = PollScheduler([s for s in self.sensors if s.polled])
+        streams = [asyncio.ensure_future(self.supervisor.supervise(s) if self.supervisor else s.start_stream())
+                   for s in self.sensors if not s.polled]
+        if scheduler.sensors:
+            streams.append(asyncio.ensure_future(scheduler.run()))
+
+        try:
+            await self._forward(conn, streams)
+        finally:
+            self._done.set()
+            conn.close()
+        scheduler.log_stats()
+
+    async def _forward(self, conn, streams):
+        halted = False
+        # rows taken from a queue that didn't fit in the ring yet
+        pending = [[] for _ in self.sensors]
+        stats_at = monotonic()
+        while True:
+            if not halted and self._halt.is_set():
+                halted = True
+                for s in self.sensors:
+                    s.producer.stop_producer()
+                await asyncio.wait(streams, timeout=5)
+
+            left = 0
+            for i, (s, ring) in enumerate(zip(self.sensors, self._rings)):
+                if not pending[i]:
+                    pending[i] = self._drain(s)
+                free = ring.capacity - (ring.write_seq - self._read_seqs[i])
+                if pending[i] and free > 0:
+                    ring.write(pending[i][:free])
+                    pending[i] = pending[i][free:]
+                left += len(pending[i]) + s.producer.queue.depth()
+
+            if halted and not left:
+                break
+            if monotonic() - stats_at >= self.stats_interval_s:
+                stats_at = monotonic()
+                self._send_stats(conn)
+            await asyncio.sleep(self.flush_interval_s)
+
+        self._send_stats(conn)
+
+    def _send_stats(self, conn):
+        stats = {i: {"link": s.link_stats(), "queue": s.producer.queue.stats(), "gaps": s.consumer.gaps}
+                 for i, s in enumerate(self.sensors)}
+        conn.send_bytes(pickle.dumps(stats, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @staticmethod
+    def _drain(sensor) -> list:
+        queue, columns = sensor.producer.queue, sensor.csv_headers
+        rows = []
+        while not queue.empty():
+            item = queue.get_nowait()
+            queue.task_done()
+            for row in (item if isinstance(item, list) else [item]):
+                rows.append(tuple(row.get(c) for c in columns) if isinstance(row, dict) else tuple(row))
+        return rows
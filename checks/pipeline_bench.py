@@ -0,0 +1,209 @@
+"""End-to-end acquisition benchmark.
+
+Runs Sensor.start_stream -> Producer -> Consumer through `Bruxi` with
+synthetic (or replayed) sensors and reports sustained samples/s, p50/p99
+enqueue-to-disk latency, CPU and RSS. Every comma separated option value is
+a sweep dimension, results are printed and saved as JSON:
+
+    python checks/pipeline_bench.py --sensors 1,4 --rate 1000 --channels 8,32 --format csv,bin
+    python checks/pipeline_bench.py --replay out/<session>/emg.csv --speed 0
+    python checks/pipeline_bench.py --compare old.json new.json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bruxbench"))
+from sensor import Sensor, ReplaySensor, now  # noqa: E402
+from bruxi import Bruxi  # noqa: E402
+
+# latency is measured on at most this many rows of every written batch
+LATENCY_SAMPLES_PER_BATCH = 16
+
+
+class BenchSensor(Sensor):
+    """Emits `rate_hz` samples of `channels` columns in batches every
+    `batch_interval_s`, stamped with the time they are enqueued
+    """
+
+    def __init__(self, name: str, rate_hz: float, channels: int, output_format: str,
+                 batch_interval_s: float = 0.01):
+        self.rate_hz = rate_hz
+        self.channels = channels
+        self.batch_interval_s = batch_interval_s
+        self.generated = 0
+        super().__init__(name=name, sample_rate_s=0, output_format=output_format,
+                         csv_headers=['dt'] + [f'channel{i}' for i in range(channels)])
+
+    @property
+    def expected_rate_hz(self) -> float:
+        return self.rate_hz
+
+    async def start_stream(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        values = tuple(random.random() for _ in range(self.channels))
+        while not self.producer.finished_execution.is_set():
+            await asyncio.sleep(self.batch_interval_s)
+            due = int((loop.time() - start) * self.rate_hz)
+            if due <= self.generated:
+                continue
+            enqueued = now()
+            rows = [(enqueued + i, *values) for i in range(due - self.generated)]
+            self.generated = due
+            await self.producer.produce_batch(rows)
+
+
+def measure_latency(consumer, latencies: list):
+    """Wraps the batch write of `consumer`: enqueue-to-disk latency is the
+    time after the write and flush minus the `dt` the row was enqueued with
+    """
+    write_batch = consumer._write_batch
+
+    def _write_batch(batch):
+        write_batch(batch)
+        done = time.time_ns()
+        step = max(1, len(batch) // LATENCY_SAMPLES_PER_BATCH)
+        for row in batch[::step]:
+            dt = next(iter(row.values())) if isinstance(row, dict) else row[0]
+            latencies.append(done - dt)
+
+    consumer._write_batch = _write_batch
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def make_sensors(config: dict) -> list:
+    if config["replay"]:
+        return [ReplaySensor(f"replay{i}", config["replay"], speed=config["speed"], loop=True,
+                             output_format=config["format"]) for i in range(config["sensors"])]
+    return [BenchSensor(f"bench{i}", config["rate"], config["channels"], config["format"])
+            for i in range(config["sensors"])]
+
+
+async def run(config: dict) -> dict:
+    sensors = make_sensors(config)
+    workers = config["workers"]
+    groups = [sensors[i::workers] for i in range(workers)] if workers else []
+    halt = asyncio.Event()
+    device = Bruxi(dir_name="pipeline_bench", sensors=[] if workers else sensors, halt_event=halt,
+                   writer_threads=config["writer_threads"], process_groups=groups, live_rings=config["rings"])
+
+    latencies = []
+    for s in sensors:
+        measure_latency(s.consumer, latencies)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    asyncio.get_running_loop().call_later(config["duration"], halt.set)
+    start = time.perf_counter()
+    await asyncio.gather(*device.spawn_coroutines())
+    device.close()
+    elapsed = time.perf_counter() - start
+
+    usage_end = resource.getrusage(resource.RUSAGE_SELF)
+    children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_s = (usage_end.ru_utime + usage_end.ru_stime - usage.ru_utime - usage.ru_stime
+             + children_end.ru_utime + children_end.ru_stime - children.ru_utime - children.ru_stime)
+
+    rows = sum(s.consumer.stats.rows for s in sensors)
+    lat = np.array(latencies, dtype=np.float64) / 1e6 if latencies else np.zeros(1)
+    return {
+        "rows": rows,
+        # counted where the sensors run
+        "generated": sum(s.generated for s in sensors) if not (config["replay"] or workers) else None,
+        "dropped": sum(s.producer.queue.dropped for s in sensors),
+        "spilled": sum(s.producer.queue.spilled for s in sensors),
+        "samples_per_s": round(rows / elapsed, 1),
+        "latency_p50_ms": round(float(np.percentile(lat, 50)), 3),
+        "latency_p99_ms": round(float(np.percentile(lat, 99)), 3),
+        "latency_max_ms": round(float(lat.max()), 3),
+        "cpu_percent": round(100 * cpu_s / elapsed, 1),
+        # peak of this process and of the largest worker, in MiB
+        "max_rss_mib": round(usage_end.ru_maxrss / 1024, 1),
+        "max_rss_children_mib": round(children_end.ru_maxrss / 1024, 1),
+    }
+
+
+def sweep(args) -> list:
+    keys = ["sensors", "rate", "channels", "format", "workers", "writer_threads"]
+    values = [args.sensors, args.rate, args.channels, args.format, args.workers, args.writer_threads]
+    for combination in itertools.product(*[v.split(",") for v in values]):
+        config = dict(zip(keys, combination))
+        for key in ("sensors", "channels", "workers", "writer_threads"):
+            config[key] = int(config[key])
+        config["rate"] = float(config["rate"])
+        config.update(duration=args.duration, replay=args.replay, speed=args.speed, rings=not args.no_rings)
+        yield config
+
+
+def compare(old_path: str, new_path: str):
+    """Prints the relative change of every metric of matching configurations"""
+    with open(old_path) as f:
+        old = {json.dumps(r["config"], sort_keys=True): r["results"] for r in json.load(f)["runs"]}
+    with open(new_path) as f:
+        new = json.load(f)["runs"]
+
+    for run_ in new:
+        before = old.get(json.dumps(run_["config"], sort_keys=True))
+        if before is None:
+            continue
+        print(run_["config"])
+        for metric, value in run_["results"].items():
+            if isinstance(value, (int, float)) and before.get(metric):
+                print(f"  {metric}: {before[metric]} -> {value} ({100 * (value / before[metric] - 1):+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sensors", default="4")
+    parser.add_argument("--rate", default="1000", help="samples/s per sensor")
+    parser.add_argument("--channels", default="8", help="columns per sample besides dt")
+    parser.add_argument("--format", default="csv", help="csv and/or bin")
+    parser.add_argument("--workers", default="0", help="worker processes, 0 streams in the main process")
+    parser.add_argument("--writer-threads", default="1")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--replay", help="recording to replay instead of synthetic sensors")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 is as fast as possible")
+    parser.add_argument("--no-rings", action="store_true", help="don't publish to the live ring buffers")
+    parser.add_argument("--out", help="JSON result file, default pipeline_bench-<commit>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    logging.basicConfig(level=logging.WARNING)
+    commit = git_commit()
+    runs = []
+    for config in sweep(args):
+        results = asyncio.run(run(config))
+        print(config, results)
+        runs.append({"config": config, "results": results})
+
+    out = args.out or f"pipeline_bench-{commit or 'unknown'}.json"
+    with open(out, 'w') as f:
+        json.dump({"commit": commit, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+                   "cpus": os.cpu_count(), "runs": runs}, f, indent=2)
+    print(f"Saved {out}")
+
+
+if __name__ == '__main__':
+    main()
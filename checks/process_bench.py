@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import os
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bruxbench"))
+from sensor import Sensor, now  # noqa: E402
+from bruxi import Bruxi  # noqa: E402
+
+# Aggregate sample rate of N_SENSORS CPU heavy synthetic sensors split over
+# 0 (everything in the main process) to 4 worker processes.
+N_SENSORS = 4
+DURATION_S = 10
+BURST = 100
+PACKET = struct.pack(">8h", 0, 0, 1, 2, 3, 4, 5, 6)
+
+
+class SyntheticIMU(Sensor):
+    """Decodes eSense like packets as fast as it can, yielding every `BURST` samples"""
+
+    def __init__(self, name: str):
+        super().__init__(name=name, sample_rate_s=0, csv_headers=[
+            'dt', 'acceleration_x', 'acceleration_y', 'acceleration_z', 'gyro_x', 'gyro_y', 'gyro_z'])
+
+    async def start_stream(self):
+        while not self.producer.finished_execution.is_set():
+            rows = []
+            for _ in range(BURST):
+                _, _, gx, gy, gz, ax, ay, az = struct.unpack(">8h", PACKET)
+                rows.append({'dt': now(),
+                             'acceleration_x': ax / 8192, 'acceleration_y': ay / 8192, 'acceleration_z': az / 8192,
+                             'gyro_x': gx / 65.5, 'gyro_y': gy / 65.5, 'gyro_z': gz / 65.5})
+            await self.producer.produce_batch(rows)
+            await asyncio.sleep(0)
+
+
+async def run(workers):
+    sensors = [SyntheticIMU(f"imu{i}") for i in range(N_SENSORS)]
+    groups = [sensors[i::workers] for i in range(workers)] if workers else []
+    halt = asyncio.Event()
+    device = Bruxi(dir_name=f"process_bench_{workers}", sensors=[] if workers else sensors,
+                   halt_event=halt, process_groups=groups)
+
+    asyncio.get_running_loop().call_later(DURATION_S, halt.set)
+    start = time.perf_counter()
+    await asyncio.gather(*device.spawn_coroutines())
+    device.close()
+    elapsed = time.perf_counter() - start
+
+    rows = sum(s.consumer.stats.rows for s in sensors)
+    print(f"workers={workers}: {rows} rows in {elapsed:.1f}s -> {rows / elapsed:.0f} samples/s")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    for workers in range(0, 5):
+        asyncio.run(run(workers))
@@ -0,0 +1,69 @@
+import asyncio
+import json
+import os
+import sys
+
+import websockets
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bruxbench"))
+import server  # noqa: E402
+from protocol import FRAME_SUMMARY, decode_samples  # noqa: E402
+from reactor import Consumer, Producer  # noqa: E402
+
+# A range request without a "dir" during a replay is answered from the
+# recording played back. Records a short session, replays it and zooms in.
+RATE_HZ = 1000
+DURATION_S = 5
+PORT = 1338
+
+
+async def record() -> str:
+    """`DURATION_S` of a sine at `RATE_HZ`, with its time index and pyramid"""
+    producer = Producer()
+    consumer = Consumer("syn.csv", producer.queue, producer.finished_execution, ["dt", "column0"])
+    consumer.set_dir_name("replay_range")
+    start = 1_700_000_000 * 10 ** 9
+    await producer.produce_batch([{"dt": start + i * 10 ** 9 // RATE_HZ, "column0": float(i % 100)}
+                                  for i in range(DURATION_S * RATE_HZ)])
+    producer.stop_producer()
+    await consumer.consume()
+    return os.path.basename(consumer.dir)
+
+
+async def receive(ws, frame_type: int, timeout_s: float = 5.0):
+    """Next binary frame of a type, or an error message"""
+    async def next_frame():
+        while True:
+            message = await ws.recv()
+            if isinstance(message, bytes):
+                frame = decode_samples(message)
+                if frame["type"] == frame_type:
+                    return frame
+            elif "error" in json.loads(message):
+                return json.loads(message)
+    return await asyncio.wait_for(next_frame(), timeout_s)
+
+
+async def main():
+    session = await record()
+    halt = asyncio.Event()
+    async with websockets.serve(server.event_listener, "127.0.0.1", PORT):
+        stream = asyncio.ensure_future(server.stream(limit=100, halt_event=halt))
+        async with websockets.connect(f"ws://127.0.0.1:{PORT}") as ws:
+            await ws.send(json.dumps({"action": "replay", "dir": session, "protocol": 2}))
+            first = await receive(ws, 1)
+            assert "error" not in first, first
+
+            t0 = int(first["dt"][0])
+            await ws.send(json.dumps({"action": "range", "id": 7, "sensor": "syn",
+                                      "t0": t0, "t1": t0 + 2 * 10 ** 9, "points": 200}))
+            summary = await receive(ws, FRAME_SUMMARY)
+            assert "error" not in summary, summary
+            assert summary["seq"] == 7 and len(summary["dt"]) > 0, summary
+            print(f"range during the replay of {session}: {len(summary['dt'])} points at level {summary['level']}")
+        halt.set()
+        await stream
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bruxbench"))
+from sensor import BNO055_x2  # noqa: E402
+
+# Without a device argument a synthetic BNO055_x2 line stream is replayed
+# as fast as possible; with one (e.g. /dev/ttyUSB1) the real port is read.
+N_LINES = 200_000
+DURATION_S = 30
+LINE = (",".join(["-0.01", "0.02", "9.81"] * 6 + ["1.00", "0.00"]) + "\r\n").encode()
+
+
+async def drain(sensor, counter, expected=None):
+    """Counts queued samples until the sensor was stopped or `expected` were seen"""
+    queue = sensor.producer.queue
+    while counter[0] != expected:
+        if not queue.empty():
+            item = queue.get_nowait()
+            counter[0] += len(item) if isinstance(item, list) else 1
+        elif sensor.producer.finished_execution.is_set():
+            break
+        else:
+            await asyncio.sleep(0.001)
+
+
+async def feed(reader, chunk_size=1024):
+    """Hands the synthetic stream over in chunks, like a serial port would"""
+    data = LINE * N_LINES
+    for i in range(0, len(data), chunk_size):
+        reader.feed_data(data[i:i + chunk_size])
+        await asyncio.sleep(0)
+
+
+async def run(bulk_read, device=None):
+    sensor = BNO055_x2("bno", url=device, bulk_read=bulk_read)
+    if device:
+        await sensor._init()
+        asyncio.get_running_loop().call_later(DURATION_S, sensor.producer.stop_producer)
+    else:
+        sensor.reader = asyncio.StreamReader()
+        asyncio.ensure_future(feed(sensor.reader))
+
+    counter = [0]
+    wall, cpu = time.perf_counter(), time.process_time()
+    stream = asyncio.ensure_future(sensor.start_stream())
+    await drain(sensor, counter, expected=None if device else N_LINES)
+    stream.cancel()
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+
+    print(f"bulk_read={bulk_read}: {counter[0]} lines in {wall:.2f}s -> {counter[0] / wall:.0f} lines/s, "
+          f"CPU {cpu:.2f}s ({100 * cpu / wall:.0f}%), {1e6 * cpu / max(counter[0], 1):.1f}us CPU per line")
+
+
+if __name__ == '__main__':
+    device = sys.argv[1] if len(sys.argv) > 1 else None
+    asyncio.run(run(bulk_read=False, device=device))
+    asyncio.run(run(bulk_read=True, device=device))
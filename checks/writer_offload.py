@@ -0,0 +1,89 @@
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bruxbench"))
+from reactor import Producer, Consumer, WriterPool, FSYNC_BATCH  # noqa: E402
+from recording import Schema  # noqa: E402
+from ringbuffer import RingWriter, remove_session_rings, ring_dir  # noqa: E402
+
+N_SENSORS = 5
+SAMPLE_RATE_HZ = 500
+DURATION_S = 10
+SLOW_DISK_S = 0.02  # simulated SD card stall per flush
+
+
+class SlowDiskConsumer(Consumer):
+    """Adds a fixed stall to every batch write to mimic a slow SD card"""
+
+    def _write_batch(self, batch):
+        time.sleep(SLOW_DISK_S)
+        super()._write_batch(batch)
+
+
+async def produce(producer, rate_hz):
+    period = 1 / rate_hz
+    while not producer.finished_execution.is_set():
+        await producer.produce({"dt": time.time_ns(), "column0": 42.0})
+        await asyncio.sleep(period)
+
+
+async def lag_probe(halt, interval=0.005):
+    """Measures how late the loop wakes up compared to the requested sleep"""
+    loop = asyncio.get_running_loop()
+    lags = []
+    while not halt.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(loop.time() - start - interval)
+    return lags
+
+
+async def run(offload, rings=False):
+    """With `rings` every producer also publishes to a live ring, as `Bruxi(live_rings=True)` does"""
+    pool = WriterPool(workers=2) if offload else None
+    producers = []
+    consumers = []
+    for i in range(N_SENSORS):
+        p = Producer()
+        c = SlowDiskConsumer(f"s{i}.csv", p.queue, p.finished_execution, ["dt", "column0"], fsync=FSYNC_BATCH)
+        c.set_dir_name(f"writer_offload_{'thread' if offload else 'loop'}")
+        if pool:
+            c.executor = pool.assign()
+        if rings:
+            p.ring = RingWriter(f"{ring_dir(c.dir)}/s{i}.ring", Schema(["dt", "column0"]))
+        producers.append(p)
+        consumers.append(c)
+
+    halt = asyncio.Event()
+
+    async def stop():
+        await asyncio.sleep(DURATION_S)
+        halt.set()
+        for p in producers:
+            p.stop_producer()
+
+    results = await asyncio.gather(lag_probe(halt), stop(),
+                                   *[produce(p, SAMPLE_RATE_HZ) for p in producers],
+                                   *[c.consume() for c in consumers],
+                                   *[p.publish() for p in producers if p.ring is not None])
+    if pool:
+        pool.shutdown()
+    for p, c in zip(producers, consumers):
+        if p.ring is not None:
+            p.ring.close()
+            remove_session_rings(c.dir)
+
+    lags = sorted(results[0])
+    rows = sum(c.stats.rows for c in consumers)
+    print(f"offload={offload} rings={rings}: rows={rows} "
+          f"lag p50={1000 * lags[len(lags) // 2]:.2f}ms "
+          f"p99={1000 * lags[int(len(lags) * 0.99)]:.2f}ms "
+          f"max={1000 * lags[-1]:.2f}ms")
+
+
+if __name__ == '__main__':
+    for rings in (False, True):
+        asyncio.run(run(offload=False, rings=rings))
+        asyncio.run(run(offload=True, rings=rings))